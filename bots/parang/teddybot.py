@@ -85,16 +85,8 @@ class TeddyBot(Player):
         spaces = self.map.spaces
         for source in spaces:
             for sink in spaces:
-                distance[(source, sink)] = Infinity
-            distance[source, source] = 0
-            for border in spaces[source].borders_out:
-                distance[(source, border)] = 1
-        for mid in spaces:
-            for source in spaces:
-                for sink in spaces:
-                    dist = distance[(source, mid)] + distance[(mid, sink)]
-                    if dist < distance[(source, sink)]:
-                        distance[(source, sink)] = dist
+                distance[(source, sink)] = \
+                    self.map.province_distance(source, sink)
         
         return distance
     
@@ -0,0 +1,317 @@
+r'''Parlance adjudication benchmarks
+    Copyright (C) 2009  Eric Wald
+    
+    This module times the judge, both on the DATC test cases and on stress
+    boards full of randomly ordered units, to show whether a change to the
+    judge has slowed down turn processing.  Results can be saved as a
+    baseline, and later runs compared against it.
+    
+    Parlance may be used, modified, and/or redistributed under the terms of
+    the Artistic License 2.0, as published by the Perl Foundation.
+'''#'''
+
+import gc
+from random    import Random
+from sys       import exit
+from time      import time
+from unittest  import TestResult, TestSuite, defaultTestLoader
+
+from config    import Configuration, GameOptions, variants
+from fallbacks import any
+from gameboard import Turn
+from main      import Program
+from tokens    import MTO, NOW, SPR, SUB, SUP
+
+class Measurement(object):
+    ''' Totals for the judge runs of one phase type in one benchmark case.
+        Variables:
+            - runs          The number of times Judge.run() was called
+            - seconds       The total time spent in those calls
+            - decisions     Movement decisions created
+            - calculations  Movement decisions calculated
+            - paradoxes     Paradoxes resolved
+            - allocations   Net growth in objects tracked by the collector
+    '''#'''
+    fields = ('runs', 'seconds', 'decisions', 'calculations',
+        'paradoxes', 'allocations')
+    
+    def __init__(self, *values):
+        for name in self.fields: setattr(self, name, 0)
+        for name, value in zip(self.fields, values):
+            setattr(self, name, value)
+    def add(self, other):
+        for name in self.fields:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+    def values(self):
+        return [getattr(self, name) for name in self.fields]
+
+class Benchmark(Program):
+    r'''Times the judge on a set of adjudication scenarios.
+        Each case is named by its source; each DATC test case is its own,
+        and each stress board is named after its variant.  Within a case,
+        runs are totalled by phase: movement, retreat, or build.
+    '''#'''
+    
+    __section__ = 'benchmark'
+    __options__ = (
+        ('repeat', int, 3, None,
+            'Number of times to run each case; the fastest run is kept.'),
+        ('threshold', float, 0.25, None,
+            'Fraction by which a total may exceed its baseline time',
+            'before it counts as a regression.'),
+        ('baseline', str, '', None,
+            'File of earlier results to compare against.'),
+        ('save_file', str, '', 'save',
+            'File in which to record the results, for use as a baseline.'),
+        ('stress_variants', str, 'standard, modern, chaos', None,
+            'Variants on which to build randomized stress boards.',
+            'Maps with large connected oceans, such as world3, can take',
+            'a very long time to list convoy routes when fully packed.'),
+        ('stress_turns', int, 6, None,
+            'Number of phases to adjudicate on each stress board.'),
+    )
+    
+    phase_names = {
+        Turn.move_phase: 'movement',
+        Turn.retreat_phase: 'retreat',
+        Turn.build_phase: 'build',
+    }
+    
+    class Recorder(object):
+        ''' Stands in for a client connection, from the judge's side.'''
+        def __init__(self, country):
+            self.country = country
+            self.replies = []
+        def send(self, message): self.replies.append(message)
+        def send_list(self, messages): self.replies.extend(messages)
+        def accept(self, message): pass
+        def reject(self, message): pass
+    
+    @classmethod
+    def run_program(cls, args):
+        r'''Run the benchmarks, optionally saving or comparing results.
+            Any arguments restrict the cases to those whose names
+            start with one of them.
+        '''#'''
+        bench = cls()
+        results = bench.run_all(args)
+        bench.report(results)
+        if bench.options.save_file:
+            bench.save(bench.options.save_file, results)
+        if bench.options.baseline:
+            baseline = bench.load(bench.options.baseline)
+            if bench.compare(baseline, results): exit(1)
+    
+    def __init__(self):
+        self.__super.__init__()
+        self.results = None
+    
+    def run_all(self, selections=()):
+        ''' Runs each case the configured number of times.
+            Returns a dict of case name -> phase name -> Measurement,
+            keeping the fastest run of each case.
+        '''#'''
+        best = {}
+        for repetition in range(max(self.options.repeat, 1)):
+            for name, phases in self.run_once(selections).iteritems():
+                seconds = sum([m.seconds for m in phases.itervalues()])
+                if name in best:
+                    fastest = sum([m.seconds for m in best[name].itervalues()])
+                    if fastest <= seconds: continue
+                best[name] = phases
+        return best
+    def run_once(self, selections=()):
+        self.results = {}
+        self.selections = selections
+        self.run_datc()
+        for name in self.options.stress_variants.replace(',', ' ').split():
+            self.run_stress(name)
+        return self.results
+    def selected(self, name):
+        return (not self.selections or
+            any(name.startswith(prefix) for prefix in self.selections))
+    
+    # Measurement
+    def instrument(self, judge, name):
+        ''' Replaces the judge's run() method with one that measures it.'''
+        run = judge.run
+        def measured_run():
+            phase = self.phase_names.get(judge.phase, 'other')
+            enabled = gc.isenabled()
+            gc.collect(0)
+            gc.disable()
+            try:
+                start = time()
+                result = run()
+                seconds = time() - start
+                allocations = gc.get_count()[0]
+            finally:
+                if enabled: gc.enable()
+            metrics = judge.metrics
+            measurement = Measurement(1, seconds, metrics.decision_count(),
+                metrics.calculations, metrics.paradoxes, allocations)
+            phases = self.results.setdefault(name, {})
+            phases.setdefault(phase, Measurement()).add(measurement)
+            return result
+        judge.run = measured_run
+    
+    # Benchmark cases
+    def datc_cases(self):
+        ''' Collects the test cases from the DATC module.'''
+        from parlance.test import datc
+        cases = []
+        suites = [defaultTestLoader.loadTestsFromModule(datc)]
+        while suites:
+            for test in suites.pop(0):
+                if isinstance(test, TestSuite): suites.append(test)
+                else: cases.append(test)
+        return cases
+    def run_datc(self):
+        ''' Replays each DATC case, whether or not it passes.'''
+        saved = dict(Configuration._cache)
+        result = TestResult()
+        try:
+            for case in self.datc_cases():
+                name = case.id().split('.', 3)[-1]
+                if not self.selected(name): continue
+                def setUp(case=case, setUp=case.setUp, name=name):
+                    setUp()
+                    self.instrument(case.judge, name)
+                case.setUp = setUp
+                case.run(result)
+        finally:
+            Configuration._cache.clear()
+            Configuration._cache.update(saved)
+        self.log.info('%d DATC cases failed and %d had errors',
+            len(result.failures), len(result.errors))
+    def run_stress(self, variant_name, seed=0):
+        ''' Fills every province of the map with a unit,
+            then adjudicates several phases of random orders.
+        '''#'''
+        name = 'stress.' + variant_name
+        if not self.selected(name): return
+        variant = variants[variant_name]
+        judge = variant.new_judge(GameOptions())
+        judge.start()
+        self.instrument(judge, name)
+        
+        rand = Random(seed)
+        powers = sorted(judge.map.powers)
+        units = []
+        for key in sorted(judge.map.spaces):
+            location = rand.choice(judge.map.spaces[key].locations)
+            units.append([rand.choice(powers), location.unit_type,
+                location.site])
+        judge.map.handle_NOW(NOW(SPR, variant.start[1]) % units)
+        judge.init_turn()
+        
+        for phase in range(self.options.stress_turns):
+            if judge.phase is None: break
+            if judge.phase == Turn.move_phase:
+                self.submit_random(judge, rand)
+            judge.run()
+    def submit_random(self, judge, rand):
+        ''' Orders each unit either to move or to support a neighbour.'''
+        units = list(judge.map.units)
+        moves = {}
+        for unit in units:
+            if unit.location.borders_out and rand.random() < 0.5:
+                border = rand.choice(unit.location.borders_out)
+                moves[unit] = judge.map.locs[border]
+        
+        orders = dict((power, []) for power in judge.map.powers)
+        for unit in units:
+            if unit in moves:
+                order = [unit.key, MTO, moves[unit].site]
+            else:
+                nearby = [other for other in units if other is not unit
+                    and unit.can_move_to(other.location.province)]
+                if not nearby: continue
+                other = rand.choice(nearby)
+                order = [unit.key, SUP, other.key]
+                if other in moves:
+                    target = moves[other].province
+                    if target != unit.location.province and unit.can_move_to(target):
+                        order += [MTO, target.key]
+            orders[unit.nation.key].append(order)
+        
+        for power, power_orders in orders.iteritems():
+            if power_orders:
+                judge.handle_SUB(self.Recorder(power), SUB % power_orders)
+    
+    # Output
+    def rows(self, results):
+        ''' Flattens results into (case, phase, Measurement) tuples,
+            with a total for each phase across all cases.
+        '''#'''
+        totals = {}
+        rows = []
+        for name in sorted(results):
+            for phase in sorted(results[name]):
+                measurement = results[name][phase]
+                rows.append((name, phase, measurement))
+                totals.setdefault(phase, Measurement()).add(measurement)
+        for phase in sorted(totals):
+            rows.append(('total', phase, totals[phase]))
+        return rows
+    def report(self, results):
+        print '%-48s %-8s %5s %9s %9s %9s %5s %9s' % (('case', 'phase')
+            + Measurement.fields)
+        for name, phase, measurement in self.rows(results):
+            print '%-48s %-8s %5d %9.4f %9d %9d %5d %9d' % ((name, phase)
+                + tuple(measurement.values()))
+    def save(self, filename, results):
+        stream = open(filename, 'w')
+        try:
+            for name, phase, measurement in self.rows(results):
+                values = [name, phase] + [str(value)
+                    for value in measurement.values()]
+                stream.write(str.join('\t', values) + '\n')
+        finally: stream.close()
+    def load(self, filename):
+        ''' Reads a file written by save().
+            Returns a dict of (case, phase) -> Measurement.
+        '''#'''
+        baseline = {}
+        stream = open(filename)
+        try:
+            for line in stream:
+                fields = line.split()
+                if len(fields) != len(Measurement.fields) + 2: continue
+                name, phase = fields[:2]
+                values = [int(fields[2]), float(fields[3])]
+                values.extend([int(value) for value in fields[4:]])
+                baseline[(name, phase)] = Measurement(*values)
+        finally: stream.close()
+        return baseline
+    def compare(self, baseline, results):
+        ''' Checks the results against a baseline from load().
+            Individual cases are too short to time reliably, so only
+            the total time for each phase, over the cases in both,
+            can count as a regression.  Returns a list of
+            (phase, old seconds, new seconds) for each phase
+            that is slower than the threshold allows.
+        '''#'''
+        old_totals = {}
+        new_totals = {}
+        for name in sorted(results):
+            for phase, measurement in results[name].iteritems():
+                old = baseline.get((name, phase))
+                if not old: continue
+                old_totals[phase] = old_totals.get(phase, 0) + old.seconds
+                new_totals[phase] = (new_totals.get(phase, 0)
+                    + measurement.seconds)
+                counts = measurement.values()[2:5]
+                if old.values()[2:5] != counts:
+                    self.log.info('Counts changed for %s %s: %s -> %s',
+                        name, phase, old.values()[2:5], counts)
+        
+        regressions = []
+        limit = 1 + self.options.threshold
+        for phase in sorted(new_totals):
+            old, new = old_totals[phase], new_totals[phase]
+            if new > old * limit:
+                regressions.append((phase, old, new))
+                self.log.warning('Regression in %s phases: '
+                    '%.4f seconds, up from %.4f', phase, new, old)
+        return regressions
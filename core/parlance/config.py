@@ -36,6 +36,7 @@ def number(value):
     try: result = float(value)
     except ValueError:
         raise ValueError('Unrecognized numeric value')
+    return result
 def integer(value):
     # Recognize an integer in any supported base, particularly with 0x prefix.
     try:
@@ -306,7 +307,7 @@ class GameOptions(Configuration):
     def parse_message(self, message):
         ''' Collects the information from a HLO or LST message.'''
         from language import Time
-        for var_opt in message.fold()[-1]:
+        for var_opt in message.folded()[-1]:
             text = var_opt[0].text
             if len(var_opt) == 1: setattr(self, text, True)
             elif text[1:3] == 'TL': setattr(self, text, int(Time(*var_opt[1:])))
@@ -438,11 +439,17 @@ class VerboseObject(Configurable):
         handler.setLevel(self.options.verbosity)
         self.log.addHandler(handler)
         self.log.setLevel(1)
-    def log_debug(self, level, line, *args):
-        '''Deprecated: Use self.log.debug() instead.'''
+    def debug_level(self, level):
+        '''Converts a log_debug() level into a logging level.'''
         # The old log_debug() had level semantics reversed.
         # It never used more than 20, though.
-        self.log.log(25 - level, line, *args)
+        return 25 - level
+    def log_debug(self, level, line, *args):
+        '''Deprecated: Use self.log.debug() instead.'''
+        self.log.log(self.debug_level(level), line, *args)
+    def debugging(self, level):
+        '''Whether log_debug() would record lines at the given level.'''
+        return self.log.isEnabledFor(self.debug_level(level))
     @settable_property
     def prefix(self): return self.__class__.__name__
 
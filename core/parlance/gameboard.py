@@ -9,6 +9,7 @@ r'''Parlance gameboard classes
     the Artistic License 2.0, as published by the Perl Foundation.
 '''#'''
 
+from array import array
 from itertools import chain, count
 from pkg_resources import split_sections
 
@@ -274,6 +275,8 @@ class Map(VerboseObject):
             - spaces:   A map of Provinces (Token -> Province)
             - locs:     A map of Locations ((unit,province,coast) -> Location)
             - neutral:  A Power representing the neutral supply centers
+            - convoy_index: A ConvoyIndex of the convoyable seas
+            - topology: A Topology of integer ids and adjacency arrays
     '''#'''
     
     def __init__(self, variant):
@@ -298,12 +301,13 @@ class Map(VerboseObject):
         power_names = self.variant.powers
         province_names = self.variant.provinces
         
-        (mdf, powers, provinces, adjacencies) = message.fold()
+        (mdf, powers, provinces, adjacencies) = message.folded()
         (centres, non_centres) = provinces
         pow_homes = dict((p, []) for p in powers)
         prov_homes = {}
         for dist in centres:
-            pow_list = dist.pop(0)
+            pow_list = dist[0]
+            dist = dist[1:]
             if pow_list == UNO:
                 for prov in dist:
                     if prov in prov_homes:
@@ -327,7 +331,8 @@ class Map(VerboseObject):
         provs = {}
         locations = {}
         for adj in adjacencies:
-            prov = adj.pop(0)
+            prov = adj[0]
+            adj = adj[1:]
             is_sc = prov_homes.has_key(prov)
             non_sc = prov in non_centres
             if is_sc == non_sc:
@@ -345,6 +350,14 @@ class Map(VerboseObject):
                 provs[other[1]].borders_in.add(key[1])
         self.spaces = provs
         self.locs = locations
+        self.convoy_index = ConvoyIndex(provs)
+        self.topology = topology = Topology(provs, locations)
+        for key, index in topology.province_ids.iteritems():
+            provs[key].id = index
+        for key, index in topology.location_ids.iteritems():
+            locations[key].id = index
+            locations[key].topology = topology
+        self.distances = None
         
         for prov in provs.itervalues():
             if not prov.is_valid(): return 'Invalid province: ' + str(prov)
@@ -568,27 +581,62 @@ class Map(VerboseObject):
             unit, site, location, datc.datc_4b1,
             datc.datc_4b2, datc.datc_4b3, datc.datc_4b6)
         return location
-    #@Memoize  # Cache results; doesn't work for list args
     def distance(self, location, provs):
         ''' Returns the location's distance from the nearest of the provinces,
             particularly for use in determining civil disorder retreats.
+            >>> print standard_map.distance(standard_map.locs[(AMY, MOS, None)],
+            ...     standard_map.powers[ENG].homes)
+            4
         '''#'''
         # Todo: Count army and fleet movements differently?
-        result = 0
-        rank = seen = [location.province.key]
-        while rank:
-            if any(place in provs for place in rank): return result
-            new_rank = []
-            for here in rank:
-                new_rank.extend([key
-                    for key in self.spaces[here].borders_out
-                    if key not in seen and key not in new_rank
-                ])
-            seen.extend(new_rank)
-            rank = new_rank
-            result += 1
-        # Inaccessible island
-        return Infinity
+        table = self.distance_table()
+        ids = self.topology.province_ids
+        start = ids[location.province.key] * len(ids)
+        result = min([table[start + ids[key]] for key in provs if key in ids]
+            or [self.unreachable])
+        if result == self.unreachable:
+            # Inaccessible island
+            return Infinity
+        return result
+    def province_distance(self, source, sink):
+        ''' Returns the number of moves from one province to another,
+            ignoring unit types, or Infinity if there is no way there.
+            Both provinces are given by their tokens.
+        '''#'''
+        ids = self.topology.province_ids
+        result = self.distance_table()[ids[source] * len(ids) + ids[sink]]
+        if result == self.unreachable: return Infinity
+        return result
+    
+    unreachable = 0xFFFF
+    def distance_table(self):
+        ''' All-pairs province distances, calculated the first time needed.
+            Returns a flat array of distances from each province to each,
+            indexed by source id times the number of provinces plus sink id,
+            using the topology's province ids.  Pairs with no path between them
+            hold the unreachable value.
+        '''#'''
+        if self.distances is None:
+            topology = self.topology
+            size = len(topology.provinces)
+            borders = [topology.adjacent(index) for index in range(size)]
+            table = array('H', [self.unreachable]) * (size * size)
+            for source in range(size):
+                row = source * size
+                table[row + source] = 0
+                rank = [source]
+                distance = 0
+                while rank:
+                    distance += 1
+                    new_rank = []
+                    for here in rank:
+                        for there in borders[here]:
+                            if table[row + there] == self.unreachable:
+                                table[row + there] = distance
+                                new_rank.append(there)
+                    rank = new_rank
+            self.distances = table
+        return self.distances
     @property
     def units(self):
         return chain(*[country.units for country in self.powers.values()])
@@ -612,16 +660,16 @@ class Map(VerboseObject):
             England
         '''#'''
         if self.valid:
-            sc_dist = message.fold()[1:]
+            sc_dist = message.folded()[1:]
             on_board = set(self.current_powers())
             for country in [self.neutral] + self.powers.values():
                 country.centers = []
             for dist in sc_dist:
-                country = dist.pop(0)
+                country = dist[0]
                 on_board.discard(country)
                 power = self.powers.get(country, self.neutral)
-                power.centers = dist
-                for prov in dist: self.spaces[prov].owner = power
+                power.centers = dist[1:]
+                for prov in power.centers: self.spaces[prov].owner = power
             
             year = self.current_turn.year
             for country in on_board:
@@ -636,7 +684,7 @@ class Map(VerboseObject):
             >>> print ' '.join(['( %s )' % unit for unit in English])
             ( ENG AMY LVP ) ( ENG FLT EDI ) ( ENG FLT LON )
         '''#'''
-        folded = message.fold()
+        folded = message.folded()
         if self.valid:
             try: self.current_turn = self.current_turn.next(*folded[1])
             except ValueError, err:
@@ -657,10 +705,50 @@ class Map(VerboseObject):
                 power = self.powers[nation]
                 unit = Unit(power, location)
                 unit.build()
-                if len(unit_spec) > 3: unit.retreat(unit_spec[4])
+                if len(unit_spec) > 3: unit.retreat(list(unit_spec[4]))
     def advance(self):
         self.current_turn = self.current_turn.next()
         return self.current_turn
+    
+    # Position snapshots
+    def snapshot(self):
+        ''' Records the current turn, units, and supply center ownership.
+            The Position shares the Units and Locations of this map,
+            instead of copying them, so it is cheap to take;
+            restore() brings the same Unit instances back to their places.
+            
+            >>> position = standard_map.snapshot()
+            >>> Rome = standard_map.spaces[ROM].unit
+            >>> Rome.move_to(standard_map.locs[(AMY, TUN, None)])
+            >>> print Rome.takeover(), standard_map.spaces[TUN].owner
+            Nobody Italy
+            >>> print standard_map.advance(), Rome, standard_map.spaces[ROM].units
+            Summer 1901 ITA AMY TUN []
+            
+            >>> standard_map.restore(position)
+            >>> print standard_map.current_turn, Rome, standard_map.spaces[ROM].units
+            Spring 1901 ITA AMY ROM [Unit(Italy, Location(AMY, ROM, None))]
+            >>> print standard_map.spaces[TUN].owner
+            Nobody
+        '''#'''
+        return Position(self)
+    def restore(self, position):
+        ''' Returns the map to a Position recorded by snapshot().'''
+        self.current_turn = position.turn
+        for unit in self.units:
+            del unit.location.province.units[:]
+        for power, units in position.units:
+            power.units[:] = units
+        for unit, location, dislodged, retreats in position.states:
+            unit.location = location
+            unit.dislodged = dislodged
+            unit.retreats = retreats
+        for province, units in position.occupied:
+            province.units[:] = units
+        for power, centers, eliminated in position.centers:
+            power.centers[:] = centers
+            power.eliminated = eliminated
+            for prov in centers: self.spaces[prov].owner = power
     def adjust_ownership(self):
         ''' Lets units take over supply centers they occupy.
             Returns a list of countries that gained supply centers.
@@ -691,6 +779,36 @@ class Map(VerboseObject):
         return [token for token,net in net_growth.iteritems() if net > 0]
 
 
+class Position(Immutable):
+    ''' The changeable parts of a Map, as recorded by Map.snapshot().
+        The provinces, locations, and borders are never copied;
+        everything else is held in tuples, so a Position never changes
+        and can be restored any number of times.
+        Variables:
+            - turn      The current Turn
+            - units     (power, units) for each Power
+            - states    (unit, location, dislodged, retreats) for each Unit
+            - occupied  (province, units) for each occupied Province
+            - centers   (power, centers, eliminated) for each Power,
+                        including the neutral one
+    '''#'''
+    __slots__ = ('turn', 'units', 'states', 'occupied', 'centers')
+    
+    def __init__(self, board):
+        powers = board.powers.values()
+        self.turn = board.current_turn
+        self.units = tuple([(power, tuple(power.units)) for power in powers])
+        self.states = tuple([(unit, unit.location, unit.dislodged, unit.retreats)
+                for power in powers for unit in power.units])
+        occupied = {}
+        for unit, location, dislodged, retreats in self.states:
+            province = location.province
+            occupied[province] = tuple(province.units)
+        self.occupied = tuple(occupied.items())
+        self.centers = tuple([(power, tuple(power.centers), power.eliminated)
+                for power in powers + [board.neutral]])
+
+
 class Turn(Comparable, Immutable):
     ''' Represents a single turn, consisting of season and year.
         Turns are immutable and hashable, so they can be used as keys.
@@ -954,6 +1072,7 @@ class Province(Comparable):
             - borders_in   The provinces that can reach this one
             - borders_out  The provinces that can be reached from here
             - units        A list of Units here
+            - id           The index of this province in the map's Topology
         
         Prefered variable names:
             - province  A Province instance
@@ -966,10 +1085,12 @@ class Province(Comparable):
         self.locations   = []
         self.units       = []
         self.owner       = None
+        self.id          = None
         self.borders_in  = set()
         self.borders_out = set()
         for unit_adjacency in adjacencies:
-            unit = unit_adjacency.pop(0)
+            unit = unit_adjacency[0]
+            unit_adjacency = unit_adjacency[1:]
             if isinstance(unit, list):
                 coast = unit[1]
                 unit_type = unit[0]
@@ -988,7 +1109,7 @@ class Province(Comparable):
     def is_coastal(self):
         if self.key.is_coastal(): return location_key(AMY, self.key)
         else: return None
-    def can_convoy(self): return self.key.category_name() in ('Sea SC', 'Sea non-SC')
+    def can_convoy(self): return self.key.is_sea()
     def __str__(self): return self.name
     def __repr__(self): return "Province('%s')" % self.name
     def tokenize(self): return [self.key]
@@ -1019,6 +1140,8 @@ class Location(Comparable, VerboseObject):
             - borders_out  A list of keys for locations to which this unit could move
             - key          A tuple that uniquely specifies this location
             - site         (province, coast) for bicoastal provinces, province for others
+            - id           The index of this location in the map's Topology
+            - topology     That Topology, or None for locations not on the map
         
         Prefered variable names:
             - location  A Location instance
@@ -1031,6 +1154,8 @@ class Location(Comparable, VerboseObject):
         self.coastline   = coastline
         self.province    = province
         self.key         = (unit_type, province.key, coastline)
+        self.id          = None
+        self.topology    = None
         self.borders_in  = set()
         self.borders_out = [location_key(unit_type, adj) for adj in adjacencies]
         if coastline:
@@ -1090,37 +1215,256 @@ class Location(Comparable, VerboseObject):
             dest must be a Province.
             Each route is a tuple of Province instances.
             Now collects only routes that currently have fleets.
+            The result is a ConvoyRoutes; see that class for details.
         '''#'''
         self.log_debug(11, 'Collecting convoy routes to %s', dest.name)
-        path_list = []
-        if self.province != dest and dest.is_coastal():
-            possible = [(p,)
-                for p in [board.spaces[key] for key in self.province.borders_out]
-                if p.can_convoy() and len(p.units) > 0
-            ]
-            while possible:
-                route = possible.pop()
-                self.log_debug(12, 'Considering %s',
-                        ' -> '.join([prov.name for prov in route]))
-                here = route[-1]
-                if dest.key in here.borders_out: path_list.append(route)
-                seen = [p.key for p in route]
-                possible.extend([route + (p,)
-                    for p in [board.spaces[key]
-                        for key in here.borders_out
-                        if key not in seen]
-                    if p.can_convoy() and len(p.units) > 0
-                ])
-            # Sort shorter paths to the front, to speed up checking
-            path_list.sort(key=len)
-        self.log_debug(11, 'Routes found: %s', path_list)
-        return path_list
+        possible = self.province != dest and dest.is_coastal()
+        return ConvoyRoutes(board, self.province, dest, possible)
     def matches(self, key):
         self.log_debug(20, 'matches(%s, %s)', self.key, key)
         return (self.key == key) or (self.unit_type is None
                 and self.key[1] == key[1])
 
 
+class Topology(object):
+    ''' A compact, integer-indexed copy of a map's adjacencies.
+        Provinces and locations get dense ids, in sorted key order,
+        so the same map always numbers them the same way.
+        Borders are stored as compressed rows: one flat array of
+        neighbour ids, and another giving where each row starts.
+        Province flags, and the provinces and locations each location
+        can reach, are bit masks with one bit per id.
+        
+        Variables:
+            - provinces          Province keys, in id order
+            - province_ids       Province key -> id
+            - locations          Location keys, in id order
+            - location_ids       Location key -> id
+            - location_province  Location id -> province id
+            - location_starts    Location id -> start of its border row
+            - location_borders   Location rows of neighbouring location ids
+            - province_starts    Province id -> start of its border row
+            - province_borders   Province rows of neighbouring province ids
+            - location_reach     Location id -> mask of reachable provinces
+            - location_adjacent  Location id -> mask of reachable locations
+            - coastal            Mask of provinces with a coast
+            - seas               Mask of provinces that can hold a convoy
+            - supply             Mask of supply centers
+    '''#'''
+    def __init__(self, provinces, locations):
+        self.provinces = sorted(provinces)
+        self.province_ids = prov_ids = dict((key, index)
+            for index, key in enumerate(self.provinces))
+        self.locations = sorted(locations)
+        self.location_ids = loc_ids = dict((key, index)
+            for index, key in enumerate(self.locations))
+        self.location_province = array('H',
+            [prov_ids[key[1]] for key in self.locations])
+        
+        location_rows = [[loc_ids[key] for key in locations[loc].borders_out]
+            for loc in self.locations]
+        self.location_starts, self.location_borders = self.pack(location_rows)
+        self.province_starts, self.province_borders = self.pack(
+            [sorted([prov_ids[key] for key in provinces[prov].borders_out])
+                for prov in self.provinces])
+        
+        self.location_adjacent = [self.mask(row) for row in location_rows]
+        self.location_reach = [
+            self.mask([self.location_province[index] for index in row])
+            for row in location_rows]
+        self.coastal = self.mask([prov_ids[key] for key in self.provinces
+            if provinces[key].is_coastal()])
+        self.seas = self.mask([prov_ids[key] for key in self.provinces
+            if provinces[key].can_convoy()])
+        self.supply = self.mask([prov_ids[key] for key in self.provinces
+            if provinces[key].is_supply()])
+    
+    @staticmethod
+    def pack(rows):
+        ''' Flattens lists of ids into an array of starting offsets,
+            one longer than the list of rows, and an array of the ids.
+            >>> starts, items = Topology.pack([[3, 1], [], [2]])
+            >>> print list(starts), list(items)
+            [0, 2, 2, 3] [3, 1, 2]
+        '''#'''
+        starts = array('i', [0])
+        items = array('H')
+        for row in rows:
+            items.extend(row)
+            starts.append(len(items))
+        return starts, items
+    @staticmethod
+    def mask(ids):
+        ''' Collects a list of ids into a bit mask.'''
+        result = 0
+        for index in ids:
+            result |= 1 << index
+        return result
+    
+    def neighbours(self, location_id):
+        ''' The ids of the locations reachable from the given one,
+            in the order listed in the map definition.
+            >>> topology = standard_map.topology
+            >>> here = topology.location_ids[(FLT, LON, None)]
+            >>> print ' '.join([str(topology.locations[there][1])
+            ...     for there in topology.neighbours(here)])
+            ECH NTH WAL YOR
+        '''#'''
+        starts = self.location_starts
+        return self.location_borders[starts[location_id]:
+            starts[location_id + 1]]
+    def adjacent(self, province_id):
+        ''' The ids of the provinces reachable from the given one.'''
+        starts = self.province_starts
+        return self.province_borders[starts[province_id]:
+            starts[province_id + 1]]
+    def can_reach(self, location_id, province_id):
+        ''' Whether a unit at the location can move into the province.'''
+        return bool(self.location_reach[location_id] >> province_id & 1)
+    def is_coastal(self, province_id):
+        return bool(self.coastal >> province_id & 1)
+    def is_sea(self, province_id):
+        return bool(self.seas >> province_id & 1)
+    def is_supply(self, province_id):
+        return bool(self.supply >> province_id & 1)
+
+class ConvoyIndex(object):
+    ''' Connectivity of the convoyable seas of a map, as bit masks.
+        Each sea gets its own bit, so a set of seas is a single integer,
+        and whether a convoy can get through is a quick flood fill
+        instead of a search through every possible path.
+        
+        Variables:
+            - seas      The convoyable Provinces, in bit order
+            - bits      Province key -> the bit for that sea
+            - borders   Sea bit -> seas reachable from that sea
+            - landings  Province key -> seas that can reach that province
+    '''#'''
+    def __init__(self, provinces):
+        self.seas = sorted([province for province in provinces.itervalues()
+                if province.can_convoy()])
+        self.bits = bits = {}
+        for index, sea in enumerate(self.seas):
+            bits[sea.key] = 1 << index
+        self.borders = {}
+        self.landings = landings = defaultdict(int)
+        for sea in self.seas:
+            self.borders[bits[sea.key]] = self.mask(sea.borders_out)
+            for key in sea.borders_out:
+                landings[key] |= bits[sea.key]
+    
+    def mask(self, keys):
+        ''' Collects the bits for any seas among the province keys.'''
+        result = 0
+        for key in keys:
+            result |= self.bits.get(key, 0)
+        return result
+    def occupied(self):
+        ''' The seas that currently hold at least one unit.'''
+        result = 0
+        for sea in self.seas:
+            if sea.units: result |= self.bits[sea.key]
+        return result
+    def reach(self, start, allowed):
+        ''' Finds every sea reachable from the start seas,
+            passing only through the allowed ones.
+            >>> index = standard_map.convoy_index
+            >>> start = index.bits[NAO]
+            >>> allowed = index.mask([NAO, NWG, BAR, MAO])
+            >>> reached = index.reach(start, allowed)
+            >>> print ' '.join([str(sea.key) for sea in index.seas
+            ...     if reached & index.bits[sea.key]])
+            BAR MAO NAO NWG
+        '''#'''
+        result = frontier = start & allowed
+        while frontier:
+            low = frontier & -frontier
+            frontier ^= low
+            new = self.borders[low] & allowed & ~result
+            result |= new
+            frontier |= new
+        return result
+
+class ConvoyRoutes(object):
+    ''' The convoy routes between two provinces, through occupied seas.
+        The fleets are taken as they stand when this is created.
+        Whether any route exists, and whether a given path is one of them,
+        can be answered from the map's ConvoyIndex; the routes themselves
+        are only listed when somebody iterates or indexes this.
+        
+        Once listed, the routes are tuples of Provinces,
+        with shorter routes before longer ones.
+    '''#'''
+    def __init__(self, board, source, dest, possible=True):
+        self.board = board
+        self.source = source
+        self.dest = dest
+        self.index = index = board.convoy_index
+        self.fleets = fleets = 0
+        if possible: self.fleets = fleets = index.occupied()
+        self.starts = index.mask(source.borders_out) & fleets
+        self.ends = index.landings.get(dest.key, 0) & fleets
+        self.routes = None
+    
+    def __nonzero__(self):
+        return bool(self.index.reach(self.starts, self.fleets) & self.ends)
+    def __len__(self): return len(self.route_list())
+    def __iter__(self): return iter(self.route_list())
+    def __getitem__(self, index): return self.route_list()[index]
+    def __eq__(self, other): return self.route_list() == other
+    def __ne__(self, other): return self.route_list() != other
+    def __repr__(self): return repr(self.route_list())
+    def __contains__(self, route):
+        ''' Checks a single route without listing them all.
+            The route can be a sequence of Provinces or their tokens.
+        '''#'''
+        if not route: return False
+        bits = self.index.bits
+        seen = 0
+        allowed = self.starts
+        for prov in route:
+            step = bits.get(getattr(prov, 'key', prov), 0) & allowed & ~seen
+            if not step: return False
+            seen |= step
+            allowed = self.index.borders[step] & self.fleets
+        return bool(step & self.ends)
+    
+    def route_list(self):
+        ''' Lists every route, in the order of the original path search.
+            Branches that can no longer reach the destination are skipped,
+            so the search only spends time on routes that get returned.
+        '''#'''
+        if self.routes is None:
+            self.routes = self.search()
+            self.board.log_debug(11, 'Routes found: %s', self.routes)
+        return self.routes
+    def search(self):
+        index = self.index
+        spaces = self.board.spaces
+        bits = index.bits
+        fleets = self.fleets
+        ends = self.ends
+        def viable(key, seen):
+            bit = bits.get(key, 0)
+            return index.reach(bit, fleets & ~seen) & ends
+        
+        path_list = []
+        if not (self.starts and ends): return path_list
+        possible = [((spaces[key],), bits[key])
+            for key in self.source.borders_out
+            if viable(key, 0)]
+        while possible:
+            route, seen = possible.pop()
+            here = route[-1]
+            if self.dest.key in here.borders_out: path_list.append(route)
+            possible.extend([(route + (spaces[key],), seen | bits[key])
+                for key in here.borders_out
+                if viable(key, seen)])
+        
+        # Sort shorter paths to the front, to speed up checking
+        path_list.sort(key=len)
+        return path_list
+
 class Unit(Comparable):
     ''' A unit on the board.
         Technically, units don't track past state, but these can.
@@ -1194,7 +1538,14 @@ class Unit(Comparable):
     # Confirmation queries
     def can_move_to(self, place):
         #print '\tQuery: %s -> %s' % (self, place)
-        if isinstance(place, Location):
+        topology = self.location.topology
+        if topology and getattr(place, 'id', None) is not None:
+            # Real places on the map can be checked against the bit masks
+            if isinstance(place, Location):
+                masks = topology.location_adjacent
+            else: masks = topology.location_reach
+            return bool(masks[self.location.id] >> place.id & 1)
+        elif isinstance(place, Location):
             # Check whether it can move to any coastline
             return any(place.matches(prov)
                 for prov in self.location.borders_out)
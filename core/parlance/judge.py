@@ -10,15 +10,18 @@ r'''Parlance adjudication system
     the Artistic License 2.0, as published by the Perl Foundation.
 '''#'''
 
+from copy import copy
+from heapq import heapify, heappop, heappush
 from itertools import chain
+from time import time
 
-from config import Configuration, VerboseObject
+from config import Configuration, GameOptions, VerboseObject, variants
 from fallbacks import all, any, defaultdict
 from gameboard import Map, Turn
 from orders import DisbandOrder, HoldOrder, OrderSet, \
         RemoveOrder, WaiveOrder, createUnitOrder
 from tokens import *
-from util import Infinity, s
+from util import Infinity, s, strongly_connected
 
 
 class DatcOptions(Configuration):
@@ -309,15 +312,19 @@ class JudgeInterface(VerboseObject):
             - unready:  True until each power has a set of valid orders.
             - phase:    Indicates the phase of the current turn.
             - game_result: The message indicating how the game ended, if it has.
+            - metrics:  A JudgeMetrics describing the latest run, if any.
         
         phase will be a Turn.phase() result for a game in progress,
         None for games ended or not yet started.
     '''#'''
     
-    def __init__(self, variant, game_opts):
-        ''' Initializes instance variables.'''
+    def __init__(self, variant, game_opts, board=None):
+        ''' Initializes instance variables.
+            A Map for the variant may be passed in as the board,
+            to adjudicate positions on a map used elsewhere.
+        '''#'''
         self.__super.__init__()
-        self.map = Map(variant)
+        self.map = board or Map(variant)
         assert self.map.valid
         self.mdf = variant.mdf()
         self.map_name = variant.mapname
@@ -326,6 +333,7 @@ class JudgeInterface(VerboseObject):
         self.game_result = None
         self.unready = True
         self.phase = None
+        self.metrics = None
     def reset(self):
         ''' Prepares the judge to begin a fresh game with the same map.
         '''#'''
@@ -341,6 +349,17 @@ class JudgeInterface(VerboseObject):
             At the end of the game, returns SLO/DRW and SMY messages.
         '''#'''
         raise NotImplementedError
+    def export(self):
+        ''' Describes the pending turn for run_exported(),
+            so that it can be adjudicated in another process.
+            Returns None if the turn must be run in this one.
+        '''#'''
+        return None
+    def load_results(self, outcome):
+        ''' Brings the judge up to date with the result of run_exported().
+            Returns the same messages that run() would have.
+        '''#'''
+        raise NotImplementedError
     
     # Interaction with players
     def handle_MAP(self, client, message): client.send(MAP(self.map_name))
@@ -417,9 +436,9 @@ class Judge(JudgeInterface):
             'Can slow down the game, particularly when syntax-checked by each client.'),
     )
     
-    def __init__(self, variant, game_opts):
+    def __init__(self, variant, game_opts, board=None):
         ''' Initializes instance variables.'''
-        self.__super.__init__(variant, game_opts)
+        self.__super.__init__(variant, game_opts, board)
         self.datc = DatcOptions()
         self.last_orders = [REJ(ORD)]
         self.next_orders = OrderSet()
@@ -459,20 +478,7 @@ class Judge(JudgeInterface):
             for tlist in params:
                 power = self.map.powers[country]
                 order = createUnitOrder(tlist, power, self.map, self.datc)
-                note = order.order_note(power, phase, orders)
-                self.log_debug(14, ' SUB: %s => %s', order, note)
-                order.__note = note
-                if note == MBV:
-                    order.__result = None
-                    orders.add(order, country)
-                elif self.game_opts.AOA:
-                    if order.is_moving() and self.illegal(order):
-                        # Make it act like it's holding
-                        self.log_debug(13, ' Changing behavior of "%s" (%s) to hold', order, order.__note)
-                        order.is_moving = lambda: False
-                    order.__result = note
-                    orders.add(order, country)
-                    note = MBV
+                note = self.submit(order, power, phase, orders)
                 client.send(THX(order)(note))
             missing = self.missing_orders(country)
             if missing: client.send(missing)
@@ -529,6 +535,25 @@ class Judge(JudgeInterface):
         else: client.reject(message)
     
     # Support functions for the above
+    def submit(self, order, power, phase, orders):
+        ''' Adds the order to the order set, if it should be adjudicated.
+            Returns the note to report back to the power.
+        '''#'''
+        note = order.order_note(power, phase, orders)
+        self.log_debug(14, ' SUB: %s => %s', order, note)
+        order.__note = note
+        if note == MBV:
+            order.__result = None
+            orders.add(order, power.key)
+        elif self.game_opts.AOA:
+            if order.is_moving() and self.illegal(order):
+                # Make it act like it's holding
+                self.log_debug(13, ' Changing behavior of "%s" (%s) to hold', order, order.__note)
+                order.is_moving = lambda: False
+            order.__result = note
+            orders.add(order, power.key)
+            note = MBV
+        return note
     def missing_orders(self, country):
         self.log.debug("Finding missing orders for %s from %s",
             country, str(self.next_orders))
@@ -566,7 +591,11 @@ class Judge(JudgeInterface):
         ''' Process orders, whether or not the powers are all ready.
             Returns applicable ORD, NOW, and SCO messages.
             At the end of the game, returns SLO/DRW and SMY messages.
+            Records the cost of the run in self.metrics.
         '''#'''
+        start = time()
+        self.metrics = metrics = JudgeMetrics(self.variant_name,
+            self.map.current_turn.key, self.phase)
         msg = self.check_draw()
         if msg:
             results = [msg]
@@ -614,6 +643,7 @@ class Judge(JudgeInterface):
                     if self.unready:
                         results.append(self.map.create_NOW())
                         break
+        metrics.seconds = time() - start
         return results
     def create_SUBs(self, turn):
         return [SUB(nation)(turn) % [([order], [order.__note])
@@ -666,17 +696,115 @@ class Judge(JudgeInterface):
             self.win_condition -= self.options.variation
         return None
     
+    # Adjudication in other processes
+    def export(self):
+        ''' Describes the pending turn in plain strings and numbers.
+            Agreed draws are quick enough to be handled here.
+        '''#'''
+        if self.check_draw(): return None
+        return (self.variant_name,
+            str(HLO(UNO)(0)(self.game_opts)),
+            self.export_state(),
+            [(str(country), str(SUB % self.next_orders.order_list(country)))
+                for country in self.map.powers],
+            [str(country) for country in self.unready])
+    def export_state(self):
+        ''' Describes the parts of the game that outlast a turn.'''
+        # Units are listed in their current order, not the sorted one,
+        # so that default orders come out in the same order as run().
+        units = sum([power.units for power in self.map.powers.values()], [])
+        now = NOW(self.map.current_turn) % units
+        return (str(self.map.create_SCO()), str(now),
+            [(str(country), power.eliminated)
+                for country, power in self.map.powers.iteritems()],
+            [str(message) for message in self.last_orders],
+            self.static, self.win_condition,
+            self.game_result and str(self.game_result))
+    def resume(self, state, submissions, unready):
+        ''' Takes over the turn described by export().
+            The judge should be fresh, or at least not in a game.
+        '''#'''
+        self.start()
+        self.import_state(state)
+        rep = self.map.variant.rep
+        for name, text in submissions:
+            power = self.map.powers[rep[name]]
+            for tlist in rep.translate(text).fold()[1:]:
+                order = createUnitOrder(tlist, power, self.map, self.datc)
+                self.submit(order, power, self.phase, self.next_orders)
+        self.unready.clear()
+        self.unready.update([rep[name] for name in unready])
+    def import_state(self, state):
+        ''' Loads a description created by export_state().'''
+        (sco, now, eliminated, last_orders,
+            self.static, self.win_condition, result) = state
+        rep = self.map.variant.rep
+        self.map.handle_NOW(rep.translate(now))
+        self.map.handle_SCO(rep.translate(sco))
+        for name, year in eliminated:
+            self.map.powers[rep[name]].eliminated = year
+        self.last_orders = [rep.translate(line) for line in last_orders]
+        self.game_result = result and rep.translate(result) or None
+        if self.game_result: self.phase = None
+        else: self.init_turn()
+    def load_results(self, outcome):
+        results, state, self.metrics = outcome
+        self.import_state(state)
+        rep = self.map.variant.rep
+        return [rep.translate(line) for line in results]
+    
+    def adjudicate(self, order_sets):
+        ''' Resolves hypothetical order sets for the current turn.
+            Each OrderSet should hold orders for units on this judge's map,
+            attributed to their powers as if each had submitted them.
+            Copies of the orders are checked and adjudicated without
+            creating any messages, and the map is restored from a snapshot
+            after each set, so neither the map nor the sets are changed.
+            Returns a list of results for each order set, each of which
+            is a list of (order, result) pairs in the order used by run().
+        '''#'''
+        turn = self.map.current_turn
+        phase = turn.phase()
+        if phase == turn.move_phase: algorithm = self.move_results
+        elif phase == turn.retreat_phase: algorithm = self.retreat_results
+        elif phase == turn.build_phase: algorithm = self.build_results
+        else: raise ValueError('Unknown phase %s' % phase)
+        
+        results = []
+        submitted = self.next_orders
+        metrics = self.metrics
+        position = self.map.snapshot()
+        try:
+            for order_set in order_sets:
+                self.metrics = JudgeMetrics(self.variant_name, turn.key, phase)
+                self.next_orders = orders = OrderSet()
+                for power in self.map.powers.itervalues():
+                    for order in order_set.order_list(power):
+                        self.submit(copy(order), power, phase, orders)
+                try: results.append(algorithm())
+                finally: self.map.restore(position)
+        finally:
+            self.next_orders = submitted
+            self.metrics = metrics
+        return results
     def build_algorithm(self):
         ''' The main adjudication routine for adjustment phases.
             Returns a list of ORD messages.
         '''#'''
-        orders = []
         turn = self.map.current_turn
+        return [ORD(turn)(order)(result)
+            for order, result in self.build_results()]
+    def build_results(self):
+        ''' Carries out the orders for an adjustment phase.
+            Returns a list of (order, result) pairs.
+        '''#'''
+        orders = []
+        phase = self.map.current_turn.build_phase
         for power in self.map.powers.itervalues():
             surplus = power.surplus()
             for order in self.next_orders.order_list(power):
                 # Double-check, because previous orders can affect validity.
-                result = order.order_note(power, self.phase)
+                result = order.order_note(power, phase)
                 if result == MBV:
                     if order.order_type == BLD:
                         self.log_debug(11, 'Building %s', order.unit)
@@ -695,7 +823,7 @@ class Judge(JudgeInterface):
                     else:
                         self.log_debug(7, 'Unknown order type %s in build phase', order.order_type)
                         result = FLD
-                orders.append(ORD(turn)(order)(result))
+                orders.append((order, result))
             
             # Handle missing orders
             if surplus > 0:
@@ -703,22 +831,28 @@ class Judge(JudgeInterface):
                 while surplus > 0:
                     unit = units.pop(0)
                     self.log_debug(8, 'Removing %s on behalf of %s', unit, power)
-                    orders.append(ORD(turn)(RemoveOrder(unit))(SUC))
+                    orders.append((RemoveOrder(unit), SUC))
                     unit.die()
                     surplus -= 1
             while surplus < 0:
                 self.log_debug(8, 'Waiving on behalf of %s', power)
-                orders.append(ORD(turn)(WaiveOrder(power))(SUC))
+                orders.append((WaiveOrder(power), SUC))
                 surplus += 1
         return orders
     def retreat_algorithm(self):
         ''' The main adjudication routine for retreat phases.
             Returns a list of ORD messages.
         '''#'''
+        turn = self.map.current_turn
+        return [ORD(turn)(order)(result)
+            for order, result in self.retreat_results()]
+    def retreat_results(self):
+        ''' Carries out the orders for a retreat phase.
+            Returns a list of (order, result) pairs.
+        '''#'''
         orders = []
         removed = []
         destinations = defaultdict(list)
-        turn = self.map.current_turn
         for unit in self.map.units:
             if unit.dislodged:
                 order = self.unit_order(unit, DisbandOrder)
@@ -730,25 +864,34 @@ class Judge(JudgeInterface):
                     destinations[order.destination.province.key].append(order)
                     result = None
                 else: result = FLD   # Unrecognized order, but correct season
-                if result: orders.append(ORD(turn)(order)(result))
+                if result: orders.append((order, result))
         for unit in removed: unit.die()
         for unit_list in destinations.itervalues():
             if len(unit_list) == 1:
                 # Successful retreat
                 order = unit_list[0]
-                orders.append(ORD(turn)(order)(SUC))
+                orders.append((order, SUC))
                 order.unit.move_to(order.destination)
             else:
                 # Bouncing
                 for order in unit_list:
-                    orders.append(ORD(turn)(order)(BNC))
+                    orders.append((order, BNC))
                     order.unit.die()
         return orders
     def move_algorithm(self):
         ''' The main adjudication routine for movement phases.
             Returns a list of ORD messages.
         '''#'''
+        turn = self.map.current_turn
+        return [ORD(turn)(order.strict)(result)
+            for order, result in self.move_results()]
+    def move_results(self):
+        ''' Carries out the orders for a movement phase.
+            Returns a list of (order, result) pairs.
+        '''#'''
         # 0) Initialize arrays
+        metrics = self.metrics
+        start = time()
         decisions = Decision_Set()
         convoyers = {}
         for province in self.map.spaces.itervalues(): province.entering = []
@@ -776,6 +919,7 @@ class Judge(JudgeInterface):
                     decisions.add(support[self.datc.datc_4a4](order))
                 else: order.__result = NSO
         self.log_debug(11, "Convoyers = %s", convoyers)
+        start = metrics.lap('orders', start)
         
         # 2) Clean up order inter-dependencies.
         # Each moving unit in a potential head-to-head conflict
@@ -787,10 +931,19 @@ class Judge(JudgeInterface):
             self.add_path_decisions(choice.order, convoyers, decisions)
         for choice in decisions[Decision.SUPPORT]:
             choice.order.supported.supports.append(choice)
+        start = metrics.lap('paths', start)
         
-        # 3) Initialize the dependencies in each decision.
+        # 3) Initialize the dependencies in each decision,
+        # indexing the decisions that depend on each one.
         decision_list = decisions.sorted()
-        for choice in decisions: choice.init_deps()
+        dependents = defaultdict(list)
+        for choice in decisions:
+            choice.init_deps()
+            for dep in choice.depends:
+                if dep: dependents[dep].append(choice)
+        for kind, choices in decisions.iteritems():
+            if choices: metrics.count(Decision.names[kind], len(choices))
+        start = metrics.lap('dependencies', start)
         
         # 4a) Pre-make some decisions if so requested
         if self.datc.datc_4a2 == 'b':
@@ -799,34 +952,80 @@ class Judge(JudgeInterface):
                 if choice not in resolved]
         
         # 4) Run through the decisions until they are all made.
-        while decision_list:
-            self.log_debug(11, '%d decisions to make...', len(decision_list))
-            remaining = []
-            for choice in decision_list:
-                self.log_debug(14, str(choice))
-                for dep in choice.depends:
-                    self.log_debug(16, " - " + str(dep))
-                
-                if not choice.calculate():
-                    remaining.append(choice)
-                self.log_debug(16, " => " + choice.state())
-            
-            if len(remaining) == len(decision_list):
-                decision_list = self.resolve_paradox(remaining)
-            else: decision_list = remaining
+        self.make_decisions(decision_list, dependents)
+        start = metrics.lap('decisions', start)
         
         # 5) Move units around
-        turn = self.map.current_turn
-        orders = [ORD (turn) (unit.current_order.strict)
-            (self.process_results(unit)) for unit in self.map.units]
+        orders = [(unit.current_order, self.process_results(unit))
+            for unit in self.map.units]
         
         # 6) Clean up all of the circular references
         for choice in decisions: del choice.depends
         for unit in self.map.units: del unit.decisions
+        metrics.lap('results', start)
         
-        # 7) Return the ORD messages
+        # 7) Return the results
         return orders
     
+    def make_decisions(self, decision_list, dependents):
+        ''' Calculates decisions until all of them have been made.
+            Works in passes through the list, like the DATC algorithm,
+            but only calculates a decision if one of its dependencies
+            has changed since its last calculation; otherwise, it would
+            simply repeat the previous result.  Paradoxes are detected
+            when a pass makes no new decisions.
+            Counts calculations performed in self.calculations,
+            and those skipped over full passes in self.calculations_saved.
+            Passes and paradoxes are counted in self.metrics.
+        '''#'''
+        position = {}
+        for index, choice in enumerate(decision_list):
+            position[choice] = index
+        remaining = decision_list
+        pending = range(len(decision_list))
+        self.calculations = self.calculations_saved = 0
+        metrics = self.metrics
+        tracing = self.debugging(14)
+        while remaining:
+            self.log_debug(11, '%d decisions to make...', len(remaining))
+            metrics.sweeps += 1
+            self.calculations_saved += len(remaining)
+            queued = set(pending)
+            later = set()
+            progress = False
+            while pending:
+                index = heappop(pending)
+                queued.discard(index)
+                choice = decision_list[index]
+                if tracing:
+                    self.log_debug(14, choice)
+                    for dep in choice.depends:
+                        self.log_debug(16, " - %s", dep)
+                
+                previous = choice.values()
+                self.calculations += 1
+                if choice.calculate(): progress = True
+                if tracing: self.log_debug(16, " => %s", choice.state())
+                if choice.values() != previous:
+                    for dependent in dependents[choice]:
+                        if dependent.decided(): continue
+                        spot = position[dependent]
+                        if spot < index: later.add(spot)
+                        elif spot not in queued:
+                            heappush(pending, spot)
+                            queued.add(spot)
+            
+            remaining = [choice for choice in remaining if not choice.decided()]
+            if remaining and not (progress and later):
+                metrics.paradoxes += 1
+                remaining = self.resolve_paradox(remaining)
+                later = [position[choice] for choice in remaining]
+            pending = list(later)
+            heapify(pending)
+        self.calculations_saved -= self.calculations
+        metrics.calculations += self.calculations
+        self.log_debug(11, '%d calculations made; %d saved.',
+                self.calculations, self.calculations_saved)
     def farthest_units(self, power):
         # Defined separately to give ChaosJudge a place to hook.
         return power.farthest_units(self.map.distance)
@@ -868,10 +1067,12 @@ class Judge(JudgeInterface):
                 else: routes = None
         else: routes = None
         
-        self.log_debug(11, "Path_Decision(%s, %s, %s, %s) from '%s' for 4.A.1 and '%s' for 4.A.3",
-                order, routes and [[s.key for s in p] for p in routes],
-                not disrupt_any, try_overland, self.datc.datc_4a1, self.datc.datc_4a3)
+        if self.debugging(11):
+            self.log_debug(11, "Path_Decision(%s, %s, %s, %s) from '%s' for 4.A.1 and '%s' for 4.A.3",
+                    order, routes and [[s.key for s in p] for p in routes],
+                    not disrupt_any, try_overland, self.datc.datc_4a1, self.datc.datc_4a3)
         path = Path_Decision(order, routes, not disrupt_any, try_overland)
+        if path.routes: self.metrics.routes += len(path.routes)
         if order.__result: path.failed = True
         else: decisions.add(path)
     def unit_order(self, unit, order_class):
@@ -1016,28 +1217,35 @@ class Judge(JudgeInterface):
                 result.append(choice)
         return result
     def get_core(self, decisions):
+        ''' Finds the smallest paradox core among the undecided decisions:
+            the smallest cycle of decisions that depends on no others.
+            Each strongly connected component of the dependency graph
+            is checked once, so this takes linear time.
+            If an undecided decision depends on no cycle at all,
+            the core is unknown, so all of the decisions are returned.
+        '''#'''
         choices = {}
         for choice in decisions:
-            choices[choice] = set([dep for dep in choice.depends
-                if dep and not dep.decided()])
+            choices[choice] = [dep for dep in choice.depends
+                if dep and not dep.decided()]
             self.log_debug(8, '%s:', choice)
             for dep in choice.depends: self.log_debug(11, '- %s', dep)
-        while True:
-            additions = False
-            for deps in choices.itervalues():
-                newdeps = set()
-                for choice in deps:
-                    newdeps |= choices[choice]
-                if not (newdeps <= deps):
-                    deps |= newdeps
-                    additions = True
-            if not additions: break
+        
         result = decisions
         self.log_debug(8, '%d original decisions', len(decisions))
-        for choice,dep_list in choices.iteritems():
-            self.log_debug(11, '%s -> depends on %d', choice, len(dep_list))
-            if len(dep_list) < len(result): result = dep_list
-        return result or decisions
+        components = {}
+        for number, component in enumerate(strongly_connected(decisions, choices)):
+            for choice in component: components[choice] = number
+            self.log_debug(11, 'Component of %d decisions', len(component))
+            if any(components[dep] != number
+                    for choice in component for dep in choices[choice]):
+                # Depends on another component
+                continue
+            if len(component) == 1 and component[0] not in choices[component[0]]:
+                # Undecided, but not part of a cycle
+                return decisions
+            if len(component) < len(result): result = component
+        return result
     def process_results(self, unit):
         ''' Returns the result of the unit's order, based on decisions.
             False Path    -> DSR or NSO (FAR determined earlier)
@@ -1107,6 +1315,61 @@ class Judge(JudgeInterface):
         return True
 
 
+def run_exported(state):
+    ''' Adjudicates a turn described by Judge.export() in a fresh judge.
+        Meant to be called in a worker process, so everything it needs
+        and everything it returns is plain enough to be pickled.
+        Judge and DATC options come from the worker's configuration.
+        Returns the outcome, to be passed to Judge.load_results().
+    '''#'''
+    name, hello, position, submissions, unready = state
+    variant = variants[name]
+    game_opts = GameOptions()
+    game_opts.parse_message(variant.rep.translate(hello))
+    judge = variant.new_judge(game_opts)
+    judge.resume(position, submissions, unready)
+    results = [str(message) for message in judge.run()]
+    return results, judge.export_state(), judge.metrics
+
+class JudgeMetrics(object):
+    ''' The cost of one run of the judge, for watchers and benchmarks.
+        Variables:
+            - variant       The name of the variant
+            - turn          The key of the turn that was adjudicated
+            - phase         That turn's phase, or None if the game was over
+            - decisions     Decision name -> number of those decisions made
+            - sweeps        Passes through the undecided decisions
+            - calculations  Decision calculations performed
+            - paradoxes     Times paradox resolution was needed
+            - routes        Convoy routes considered for moving units
+            - steps         Step of move_results() -> seconds spent there
+            - seconds       Total seconds spent in Judge.run()
+            - latency       Seconds the server waited for the results,
+                            including any time spent in a worker process
+        Everything here is a plain number, string, or dictionary of them,
+        so the metrics of a worker process can be sent back with its results.
+    '''#'''
+    def __init__(self, variant, turn, phase):
+        self.variant = variant
+        self.turn = turn
+        self.phase = phase
+        self.decisions = {}
+        self.sweeps = 0
+        self.calculations = 0
+        self.paradoxes = 0
+        self.routes = 0
+        self.steps = {}
+        self.seconds = 0
+        self.latency = None
+    def count(self, name, number):
+        self.decisions[name] = self.decisions.get(name, 0) + number
+    def lap(self, step, start):
+        ''' Adds the time since start to the step; returns the current time.'''
+        now = time()
+        self.steps[step] = self.steps.get(step, 0) + now - start
+        return now
+    def decision_count(self): return sum(self.decisions.values())
+
 class Decision_Set(defaultdict):
     ''' Holds a set of Decisions, separating them by type.
         As a list, they are returned in the following order:
@@ -1166,6 +1429,9 @@ class Decision(object):
             self.names[self.type], self.order.unit, self.state())
     def __repr__(self): return str(self)   # To make lists look nice
     def state(self): raise NotImplementedError
+    def values(self):
+        ''' Returns the current state of the decision in comparable form.'''
+        raise NotImplementedError
     def battles(self):
         unit_list = self.order.unit.location.province.entering
         return [unit for unit in self.into.units if unit in unit_list]
@@ -1191,6 +1457,7 @@ class Tristate_Decision(Decision):
         return self.passed or self.failed
     def state(self):
         return self.status[(self.passed, self.failed)]
+    def values(self): return self.passed, self.failed
     def minmax(self, decision_list):
         ''' Returns the highest maximum and minimum values in the decision list.'''
         min_found = max_found = 0
@@ -1402,6 +1669,7 @@ class Numeric_Decision(Decision):
         return self.max_value == self.min_value
     def state(self):
         return 'minimum %d, maximum %s' % (self.min_value, self.max_value)
+    def values(self): return self.min_value, self.max_value
 class Attack_Decision(Numeric_Decision):
     # Strength of the attack
     __slots__ = ()
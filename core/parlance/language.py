@@ -9,10 +9,11 @@ r'''Parlance language classes
 '''#'''
 
 import re
-from struct import pack, unpack
+from array  import array
+from sys    import byteorder
 
 from config    import Configurable, VerboseObject, parse_file
-from util      import Comparable, rindex
+from util      import Comparable
 
 __all__ = [
     'Message',
@@ -36,6 +37,12 @@ class Message(list):
         IndexError: list index out of range
     '''#'''
     
+    # The results of folded(), pack(), and encoded(),
+    # discarded whenever the Message changes.
+    _folded = None
+    _packed = None
+    _encoded = None
+    
     def __init__(self, *message):
         ''' Creates a new message from a string or series.
             Mostly, this will be called by calling a token;
@@ -46,13 +53,13 @@ class Message(list):
             >>> str(Message((NOT, [GOF])))
             'NOT ( GOF )'
         '''#'''
-        for item in message: list.extend(self, self.to_tokens(item))
+        for item in message: self.to_tokens(item, False, self)
     
     def fold(self):
         ''' Folds the token into a list, with bracketed sublists as lists.
             Also converts text and number tokens to strings and integers.
-            This version takes about half the time for a map definition,
-            but probably a bit longer than old_fold() for simple messages.
+            The result is a new list each time, which the caller may modify;
+            see folded() for a shared copy that is only computed once.
             
             >>> NOT(GOF).fold()
             [NOT, [GOF]]
@@ -71,16 +78,40 @@ class Message(list):
                 ...
             ValueError: unbalanced parentheses in folded Message
         '''#'''
-        complaint = 'unbalanced parentheses in folded Message'
-        if self.count(BRA) != self.count(KET):
-            raise ValueError(complaint)
-        series = list(self)
-        while BRA in series:
-            k = series.index(KET)
-            try: b = rindex(series[:k], BRA)
-            except ValueError: raise ValueError(complaint)
-            series[b:k+1] = [self.convert(series[b+1:k])]
-        return self.convert(series)
+        convert = self.convert
+        stack = []
+        series = []
+        for token in self:
+            if token == BRA:
+                stack.append(series)
+                series = []
+            elif token == KET:
+                if not stack:
+                    raise ValueError('unbalanced parentheses in folded Message')
+                folded = convert(series)
+                series = stack.pop()
+                series.append(folded)
+            else: series.append(token)
+        if stack: raise ValueError('unbalanced parentheses in folded Message')
+        return convert(series)
+    def folded(self):
+        ''' Returns the folded Message, as fold() would,
+            but only folds it the first time it is called.
+            Every caller gets the same list, so it must not be modified;
+            changing the Message itself discards the saved copy.
+            
+            >>> m = NOT(GOF)
+            >>> m.folded() is m.folded()
+            True
+            >>> m[2] = DRW
+            >>> m.folded()
+            [NOT, [DRW]]
+        '''#'''
+        result = self._folded
+        if result is None:
+            result = self._folded = self.fold()
+        return result
+    
     @staticmethod
     def convert(series):
         r'''Converts embedded strings and integers into Python values.
@@ -176,18 +207,48 @@ class Message(list):
         return 'Message(' + repr(self.fold()) + ')'
     def pack(self):
         ''' Produces a string of token numbers from a Message.
+            The string is kept until the Message changes,
+            so a message sent to many clients is only packed once.
             >>> print map(lambda x: hex(ord(x)), NOT(GOF).pack())
             ['0x48', '0xd', '0x40', '0x0', '0x48', '0x3', '0x40', '0x1']
         '''#'''
-        return pack('!' + 'H'*len(self), *map(int, self))
+        result = self._packed
+        if result is None:
+            numbers = array('H', self)
+            if byteorder == 'little': numbers.byteswap()
+            result = self._packed = numbers.tostring()
+        return result
+    def encoded(self, key, encoder):
+        ''' Returns encoder(self), keeping the result until the Message
+            changes, so that a network protocol can send a broadcast
+            in the same form to each client without encoding it again.
+            The key names the form, and must include anything else
+            that the encoder's result depends on.
+            
+            >>> m = NOT(GOF)
+            >>> m.encoded('text', str)
+            'NOT ( GOF )'
+            >>> m.encoded('text', len)
+            'NOT ( GOF )'
+            >>> m.append(DRW)
+            >>> m.encoded('text', str)
+            'NOT ( GOF ) DRW'
+        '''#'''
+        saved = self._encoded
+        if saved is None: saved = self._encoded = {}
+        result = saved.get(key)
+        if result is None: result = saved[key] = encoder(self)
+        return result
     def tokenize(self): return self
     
     # Formerly module methods, but only used in this class.
     @staticmethod
-    def to_tokens(value, wrap=False):
+    def to_tokens(value, wrap=False, result=None):
         ''' Returns a list of Token instances based on a value.
             If wrap is true, lists and tuples will be wrapped in parentheses.
             (But that's meant to be used only by this method.)
+            If result is given, the tokens are appended to it,
+            so that nested lists don't each need a list of their own.
             
             >>> Message.to_tokens(3)
             [IntegerToken(3)]
@@ -201,26 +262,38 @@ class Message(list):
             [BRA, IntegerToken(3), IntegerToken(0), IntegerToken(-3), KET]
             >>> Message.to_tokens([+NOT, (GOF,)])
             [NOT, BRA, GOF, KET]
+            >>> Message.to_tokens([GOF], True, [NOT])
+            [NOT, BRA, GOF, KET]
         '''#'''
-        if hasattr(value, 'tokenize'):
-            result = value.tokenize()
-            if isinstance(result, list): return result
+        # The list methods avoid translating tokens again when result
+        # is a Message.
+        if result is None: result = []
+        if isinstance(value, Token): list.append(result, value)
+        elif hasattr(value, 'tokenize'):
+            tokens = value.tokenize()
+            if isinstance(tokens, Message): list.extend(result, tokens)
+            elif isinstance(tokens, list):
+                for item in tokens: Message.to_tokens(item, True, result)
             else:
                 raise TypeError('tokenize for %s returned non-list (type %s)' %
-                        (value, result.__class__.__name__))
+                        (value, tokens.__class__.__name__))
         elif isinstance(value, (int, float, long)):
-            return number_tokens(value)
+            list.extend(result, number_tokens(value))
         elif isinstance(value, unicode):
-            return [StringToken(c) for c in value.encode("utf-8")]
+            list.extend(result, [StringToken(c) for c in value.encode("utf-8")])
         elif isinstance(value, str):
-            return [StringToken(c) for c in value]
-        elif wrap: return Message.wrap(value)
+            list.extend(result, [StringToken(c) for c in value])
+        elif wrap: Message.wrap(value, result)
         else:
-            try: return sum([Message.to_tokens(item, True) for item in value], [])
+            try: items = iter(value)
             except TypeError: raise TypeError('Cannot tokenize ' + str(value))
+            to_tokens = Message.to_tokens
+            for item in items: to_tokens(item, True, result)
+        return result
     @staticmethod
-    def wrap(value):
+    def wrap(value, result=None):
         ''' Tokenizes the list and wraps it in a pair of brackets.
+            If result is given, the tokens are appended to it.
             >>> Message.wrap(GOF)
             [BRA, GOF, KET]
             >>> Message.wrap(NOT(GOF))
@@ -228,7 +301,11 @@ class Message(list):
             >>> Message.wrap('name')
             [BRA, StringToken('n'), StringToken('a'), StringToken('m'), StringToken('e'), KET]
         '''#'''
-        return [BRA] + Message.to_tokens(value) + [KET]
+        if result is None: result = []
+        list.append(result, BRA)
+        Message.to_tokens(value, False, result)
+        list.append(result, KET)
+        return result
     
     # Automatically translate new items into Tokens
     def append(self, value):
@@ -246,6 +323,7 @@ class Message(list):
                 ...
             TypeError: list objects are unhashable
         '''#'''
+        self._folded = self._packed = self._encoded = None
         list.append(self, protocol.base_rep[value])
     def extend(self, value):
         ''' Adds a list of new tokens to the Message, without parentheses.
@@ -260,6 +338,7 @@ class Message(list):
             >>> str(m)
             'NOT GOF "name" 3'
         '''#'''
+        self._folded = self._packed = self._encoded = None
         list.extend(self, self.to_tokens(value))
     def __add__(self, other):
         ''' Adds the given Message or list at the end of this Message,
@@ -281,13 +360,16 @@ class Message(list):
             >>> print CCD (ENG) (SPR, 1901)
             CCD ( ENG ) ( SPR 1901 )
         '''#'''
-        if len(args) == 1: return self + self.wrap(*args)
-        else: return self + self.wrap(args)
+        result = Message(self)
+        if len(args) == 1: self.wrap(args[0], result)
+        else: self.wrap(args, result)
+        return result
     __and__ = __call__
     def __iand__(self, other):
         try:
             if len(other) == 1: other = other[0]
         except TypeError: pass
+        self._folded = self._packed = self._encoded = None
         list.extend(self, self.wrap(other)); return self
     def __mod__(self, other):
         ''' Wraps each element of a list individually,
@@ -297,7 +379,10 @@ class Message(list):
             >>> print NOW (FAL, 1901) % units
             NOW ( FAL 1901 ) ( ENG FLT EDI ) ( ENG FLT LON ) ( ENG AMY LVP )
         '''#'''
-        return reduce(apply, [(item,) for item in other], self)
+        result = Message(self)
+        wrap = self.wrap
+        for item in other: wrap(item, result)
+        return result
     
     def __setslice__(self, from_index, to_index, value):
         ''' Replaces a portion of the Message, with Tokens.
@@ -309,6 +394,7 @@ class Message(list):
             >>> str(m)
             'NOT YES 34 "na" REJ'
         '''#'''
+        self._folded = self._packed = self._encoded = None
         try: list.__setslice__(self, from_index, to_index, self.to_tokens(value))
         except TypeError:
             raise TypeError('must assign list (not "%s") to slice' %
@@ -327,6 +413,7 @@ class Message(list):
                 ...
             TypeError: list objects are unhashable
         '''#'''
+        self._folded = self._packed = self._encoded = None
         list.__setitem__(self, index, protocol.base_rep[value])
     def insert(self, index, value):
         ''' Inserts a single token into the Message.
@@ -339,7 +426,25 @@ class Message(list):
                 ...
             TypeError: list objects are unhashable
         '''#'''
+        self._folded = self._packed = self._encoded = None
         list.insert(self, index, protocol.base_rep[value])
+    
+    # Other changes must also discard the saved copies.
+    def _discard_folded(method):
+        def discard(self, *args, **kwargs):
+            self._folded = self._packed = self._encoded = None
+            return method(self, *args, **kwargs)
+        discard.__name__ = method.__name__
+        discard.__doc__ = method.__doc__
+        return discard
+    __delitem__ = _discard_folded(list.__delitem__)
+    __delslice__ = _discard_folded(list.__delslice__)
+    __imul__ = _discard_folded(list.__imul__)
+    pop = _discard_folded(list.pop)
+    remove = _discard_folded(list.remove)
+    reverse = _discard_folded(list.reverse)
+    sort = _discard_folded(list.sort)
+    del _discard_folded
 
 
 class _integer_Token(int):
@@ -489,7 +594,7 @@ class Token(_integer_Token):
             >>> StringToken('A').is_text()
             True
         '''#'''
-        return self.category == protocol.token_cats['Text']
+        return protocol.category_flags[self.category] & protocol.text_flag != 0
     def is_power(self):
         ''' Whether the token represents a power (country) of the game.
             >>> YES.is_power()
@@ -499,13 +604,14 @@ class Token(_integer_Token):
             >>> Token('ENG', 0x4101).is_power()
             True
         '''#'''
-        return self.category == protocol.token_cats['Powers']
+        return protocol.category_flags[self.category] & protocol.power_flag != 0
     def is_unit_type(self):
         ''' Whether the token represents a type of unit.'''
-        return self.category == protocol.token_cats['Unit_Types']
+        return (protocol.category_flags[self.category]
+            & protocol.unit_type_flag != 0)
     def is_coastline(self):
         ''' Whether the token represents a specific coastline of a province.'''
-        return self.category == protocol.token_cats['Coasts']
+        return protocol.category_flags[self.category] & protocol.coast_flag != 0
     def is_supply(self):
         ''' Whether the token represents a province with a supply centre.
             >>> YES.is_supply()
@@ -515,17 +621,22 @@ class Token(_integer_Token):
             >>> Token('NWY', 0x553E).is_supply()
             True
         '''#'''
-        return self.is_province() and self.category & 1 == 1
+        return protocol.category_flags[self.category] & protocol.supply_flag != 0
     def is_coastal(self):
         ''' Whether the token represents a coastal province;
             that is, one to or from which an army can be convoyed.
         '''#'''
-        return self.category_name() in (
-            'Coastal SC',
-            'Coastal non-SC',
-            'Bicoastal SC',
-            'Bicoastal non-SC',
-        )
+        return (protocol.category_flags[self.category]
+            & protocol.coastal_flag != 0)
+    def is_sea(self):
+        ''' Whether the token represents a sea province,
+            through which fleets can convoy.
+            >>> Token('NTH', 0x5213).is_sea()
+            True
+            >>> Token('LON', 0x5534).is_sea()
+            False
+        '''#'''
+        return protocol.category_flags[self.category] & protocol.sea_flag != 0
     def is_province(self):
         ''' Whether the token represents a province.
             >>> YES.is_province()
@@ -535,8 +646,8 @@ class Token(_integer_Token):
             >>> Token('NWY', 0x553E).is_province()
             True
         '''#'''
-        p_cat = protocol.token_cats['Provinces']
-        return p_cat[0] <= self.category <= p_cat[1]
+        return (protocol.category_flags[self.category]
+            & protocol.province_flag != 0)
     def is_integer(self):
         ''' Whether the token represents a number.
             >>> YES.is_integer()
@@ -579,7 +690,7 @@ class Token(_integer_Token):
             >>> msg[3].is_bignum()
             True
         '''#'''
-        return self.category_name() == "Bignum"
+        return protocol.category_flags[self.category] & protocol.bignum_flag != 0
     def is_season(self):
         ''' Whether the token represents a season or phase.
             >>> SPR.is_season()
@@ -587,7 +698,17 @@ class Token(_integer_Token):
             >>> YES.is_season()
             False
         '''#'''
-        return self.category == protocol.token_cats['Phases']
+        return protocol.category_flags[self.category] & protocol.phase_flag != 0
+    def is_reserved(self):
+        ''' Whether the token is reserved for private use,
+            and thus must never be sent over the wire.
+            >>> YES.is_reserved()
+            False
+            >>> Token('AIX', 0x5801).is_reserved()
+            True
+        '''#'''
+        return (protocol.category_flags[self.category]
+            & protocol.reserved_flag != 0)
     
     # Conversions
     def __hex__(self):
@@ -822,6 +943,8 @@ class Representation(Configurable):
             'The character to use for quoting strings when printing messages.'),
     )
     
+    word_pattern = re.compile(r'[()]|[^\s()]+')
+    
     def __init__(self, tokens, base):
         # tokens is a number -> name mapping
         self.__super.__init__()
@@ -830,6 +953,19 @@ class Representation(Configurable):
         self.numbers = nums = {}
         for number, name in tokens.iteritems():
             nums[number] = names[name] = Token(name, number)
+        
+        # Every name this representation can translate, base names included
+        if base: self.words = words = dict(base.words)
+        else: self.words = words = {}
+        words.update(names)
+        if words.has_key('BRA'): words['('] = words['BRA']
+        if words.has_key('KET'): words[')'] = words['KET']
+        
+        # Tokens by number, including those from the base representation;
+        # integer, text, and unknown tokens are added as they are found.
+        if base: self.table = table = dict(base.table)
+        else: self.table = table = {}
+        table.update(nums)
     
     def __getitem__(self, key):
         ''' Returns a Token from its name or number.'''
@@ -1026,25 +1162,41 @@ class Representation(Configurable):
                 ...
             KeyError: "unknown token 'NAME'"
         '''#'''
-        # Switch parentheses to three-character notation
-        text = text.replace('(', ' BRA ')
-        text = text.replace(')', ' KET ')
-        
-        # Pass items into Token, converting integers if necessary
         result = []
-        for word in text.split():
-            try:
-                n = int(word)
-            except:
-                token = self[word.upper()]
-                result.append(token)
+        append = result.append
+        words = self.words
+        for word in self.word_pattern.findall(text):
+            token = words.get(word) or words.get(word.upper())
+            if token is not None: append(token)
             else:
-                result.extend(number_tokens(n))
+                # Convert integers, or complain about the unknown word
+                try: number = int(word)
+                except ValueError: append(self[word.upper()])
+                else: result.extend(number_tokens(number))
         return result
     
     def unpack(self, data):
-        result = Message([self[x]
-            for x in unpack('!' + 'H'*(len(data)//2), data)])
+        r'''Produces a Message from a string of token numbers.
+            The string is kept, to be sent again if the Message is.
+            The data may also be a buffer into a network connection's
+            input, which is not kept, because its contents will change.
+            >>> print base_rep.unpack('\x48\x0d\x40\x00\x48\x03\x40\x01')
+            NOT ( GOF )
+        '''#'''
+        numbers = array('H')
+        numbers.fromstring(data)
+        if byteorder == 'little': numbers.byteswap()
+        table = self.table
+        try: tokens = [table[number] for number in numbers]
+        except KeyError:
+            tokens = []
+            for number in numbers:
+                token = table.get(number)
+                if token is None: token = table[number] = self[number]
+                tokens.append(token)
+        result = Message()
+        list.extend(result, tokens)
+        if isinstance(data, str): result._packed = data
         return result
 
 
@@ -1077,6 +1229,7 @@ class Protocol(VerboseObject):
             - base_rep       Representation of the language-level tokens
             - default_rep    Representation of the tokens for the default map
             - token_cats     Token category name <-> number(s) mappings
+            - category_flags List of category number -> flag bits
             - error_strings  Mapping of Error Message code -> description
             - message_types  Mapping of type word -> message code
             - version        Version of the protocol document
@@ -1089,6 +1242,7 @@ class Protocol(VerboseObject):
         self.base_rep = None
         self.default_rep = None
         self.token_cats = {}
+        self.category_flags = [0] * 0x100
         self.error_strings = {}
         self.message_types = {}
         self.version = None
@@ -1101,6 +1255,7 @@ class Protocol(VerboseObject):
         self.bignum = self.token_cats['Bignum'] << 8
         self.max_pos_int = (self.token_cats['Integers'][1] + 1) << 7
         self.max_neg_int = self.max_pos_int << 1
+        self.flag_categories()
     
     def parse_dcsp(self, dcsp_file):
         # Local variable initialization
@@ -1185,6 +1340,55 @@ class Protocol(VerboseObject):
         # Sanity checking
         if not self.magic: self.log_debug(1, 'Missing magic number')
         if not self.version: self.log_debug(1, 'Missing version number')
+    
+    # Flag bits for the token categories
+    text_flag      = 0x001
+    power_flag     = 0x002
+    unit_type_flag = 0x004
+    coast_flag     = 0x008
+    phase_flag     = 0x010
+    province_flag  = 0x020
+    supply_flag    = 0x040
+    coastal_flag   = 0x080
+    sea_flag       = 0x100
+    bignum_flag    = 0x200
+    reserved_flag  = 0x400
+    
+    def flag_categories(self):
+        ''' Sets the flag bits for each token category,
+            so that Token predicates need only one lookup.
+            
+            >>> proto = Protocol()
+            >>> flags = proto.category_flags[proto.token_cats['Coastal_SC']]
+            >>> flags == (proto.province_flag | proto.supply_flag |
+            ...     proto.coastal_flag)
+            True
+        '''#'''
+        flags = self.category_flags
+        def mark(name, flag):
+            if self.token_cats.has_key(name):
+                cats = self.token_cats[name]
+                if isinstance(cats, tuple):
+                    cats = range(cats[0], cats[1] + 1)
+                else: cats = [cats]
+                for cat in cats: flags[cat] |= flag
+        mark('Text', self.text_flag)
+        mark('Powers', self.power_flag)
+        mark('Unit_Types', self.unit_type_flag)
+        mark('Coasts', self.coast_flag)
+        mark('Phases', self.phase_flag)
+        mark('Bignum', self.bignum_flag)
+        for name in ('Coastal_SC', 'Coastal_non-SC',
+                'Bicoastal_SC', 'Bicoastal_non-SC'):
+            mark(name, self.coastal_flag)
+        for name in ('Sea_SC', 'Sea_non-SC'):
+            mark(name, self.sea_flag)
+        mark('Provinces', self.province_flag)
+        for cat in range(len(flags)):
+            if flags[cat] & self.province_flag and cat & 1:
+                flags[cat] |= self.supply_flag
+            if 'Reserved' in self.token_cats.get(cat, ''):
+                flags[cat] |= self.reserved_flag
 
 protocol = Protocol()
 BRA = protocol.base_rep['BRA']
@@ -18,7 +18,6 @@ from twisted.internet.protocol import ClientFactory, Protocol, ServerFactory, co
 from twisted.internet.error import CannotListenError
 from twisted.protocols.basic import LineOnlyReceiver
 from twisted.protocols.policies import TimeoutMixin
-from twisted.protocols.stateful import StatefulProtocol
 from twisted.web.http import HTTPChannel
 from twisted.web.server import Site
 
@@ -29,7 +28,60 @@ from parlance.language import Message, Representation, protocol
 from parlance.tokens import ADM, MDF, OFF, REJ, YES
 from parlance.util import random_cycle
 
-class DaideProtocol(VerboseObject, StatefulProtocol, TimeoutMixin):
+class OutputBuffer(object):
+    r'''Producer side of a connection's output.
+        Messages sent together are passed to the transport in one call.
+        The connection registers itself as a streaming producer, so
+        output is held here while the transport's own buffer is full;
+        a peer that falls too far behind is disconnected, rather than
+        letting its unsent messages grow without bound.
+    '''#'''
+    
+    __options__ = (
+        ('output_backlog', int, 1 << 20, None,
+            'Number of bytes that may be held for a slow connection',
+            'before it gets dropped.'),
+    )
+    
+    def start_output(self):
+        self.paused = False
+        self.backlog = []
+        self.backlog_size = 0
+        self.transport.registerProducer(self, True)
+    def output(self, chunks):
+        if self.paused:
+            self.backlog.extend(chunks)
+            self.backlog_size += sum([len(chunk) for chunk in chunks])
+            if self.backlog_size > self.options.output_backlog:
+                self.overflow()
+        elif len(chunks) == 1:
+            self.transport.write(chunks[0])
+        elif chunks:
+            self.transport.writeSequence(chunks)
+    def overflow(self):
+        self.log.warning("Dropping a connection with %d bytes unsent",
+            self.backlog_size)
+        self.stopProducing()
+        self.closed = True
+        
+        # Twisted before 11.1 can only close it politely.
+        abort = getattr(self.transport, 'abortConnection',
+            self.transport.loseConnection)
+        abort()
+    
+    # IPushProducer
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        backlog = self.backlog
+        self.stopProducing()
+        self.output(backlog)
+    def stopProducing(self):
+        self.paused = False
+        self.backlog = []
+        self.backlog_size = 0
+
+class DaideProtocol(VerboseObject, Protocol, TimeoutMixin, OutputBuffer):
     r'''Base methods for the DAIDE Client-Server Protocol.'''
     
     __options__ = (
@@ -46,6 +98,7 @@ class DaideProtocol(VerboseObject, StatefulProtocol, TimeoutMixin):
         self.configure(protocol)
         self.final_sent = False
         self.closed = False
+        self.start_output()
     def close(self, notified=False):
         self.log.debug("Closing")
         self.closed = True
@@ -56,12 +109,43 @@ class DaideProtocol(VerboseObject, StatefulProtocol, TimeoutMixin):
             self.final_sent = True
         self.transport.loseConnection()
     
+    def makeConnection(self, transport):
+        Protocol.makeConnection(self, transport)
+        self.reading = self.getInitialState()
+        self.received = []
+        self.received_size = 0
     def getInitialState(self):
         self.log.debug("Initializing State")
         return (self.read_header, 4)
     def dataReceived(self, data):
+        r'''Splits incoming data into the pieces the read methods expect.
+            Each read method returns the next method and the number of
+            bytes to pass it, or None to be called again.  Incoming
+            chunks are joined only once enough have arrived for the next
+            piece, and each piece is passed as a buffer into the joined
+            string instead of a copy, so pipelined messages are copied
+            at most once.
+        '''#'''
         #self.log.debug("Processing %r", data)
-        StatefulProtocol.dataReceived(self, data)
+        self.received.append(data)
+        self.received_size += len(data)
+        handler, size = self.reading
+        if self.received_size < size:
+            return
+        data = str.join('', self.received)
+        offset = 0
+        while len(data) - offset >= size:
+            state = handler(buffer(data, offset, size))
+            offset += size
+            if self.transport.disconnecting:
+                # No more data will be read from this connection.
+                return
+            if state: handler, size = state
+        self.reading = (handler, size)
+        if offset < len(data):
+            self.received = [data[offset:]]
+        else: self.received = []
+        self.received_size = len(data) - offset
     
     def configure(self, proto):
         self.send_final = True
@@ -76,15 +160,22 @@ class DaideProtocol(VerboseObject, StatefulProtocol, TimeoutMixin):
             self.handlers[value] = getattr(self, "read_" + abbr)
     
     def write(self, message):
-        self.send_dcsp(self.DM, message.pack())
+        # Broadcasts are framed once, for all of their recipients.
+        self.output([message.encoded(self.DM, self.frame_message)])
+    def write_list(self, messages):
+        self.output([message.encoded(self.DM, self.frame_message)
+            for message in messages])
+    def frame_message(self, message):
+        return self.frame(self.DM, message.pack())
+    def frame(self, msg_type, data):
+        return pack('!BxH', msg_type, len(data)) + data
     def send_dcsp(self, msg_type, data):
         r'''Sends a DCSP message to the client.
             msg_type must be an integer, one of the defined message types.
             data must be a packed binary string.
         '''#'''
         #self.log.debug("Sending %s: %r", msg_type, data)
-        msg = pack('!BxH', msg_type, len(data)) + data
-        self.transport.write(msg)
+        self.output([self.frame(msg_type, data)])
     
     def read_header(self, data):
         msg_type, msg_len = unpack('!BxH', data)
@@ -133,8 +224,7 @@ class DaideProtocol(VerboseObject, StatefulProtocol, TimeoutMixin):
                 if version == self.proto.version:
                     # Success!
                     address = self.transport.getPeer().host
-                    self.service = Service(self, address,
-                        self.factory.server, self.factory.game)
+                    self.service = self.factory.new_service(self, address)
                 else: self.send_error(self.proto.VersionError)
             elif unpack('<HH', data)[1] == self.proto.magic:
                 self.send_error(self.proto.EndianError)
@@ -203,7 +293,7 @@ class DaideProtocol(VerboseObject, StatefulProtocol, TimeoutMixin):
         else:
             # Tokens in the "Reserved for AI use" category
             # must never be sent over the wire.
-            if any('Reserved' in token.category_name() for token in msg):
+            if any(token.is_reserved() for token in msg):
                 msg = None
         return msg
     def handle_message(self, msg):
@@ -246,7 +336,7 @@ class DaideClientProtocol(DaideProtocol):
         if player.closed:
             self.close()
 
-class DppProtocol(VerboseObject, LineOnlyReceiver):
+class DppProtocol(VerboseObject, LineOnlyReceiver, OutputBuffer):
     r'''Line-based Diplomacy Programming Protocol.
         Like the Daide protocol, but using text instead of tokens.
     '''#"""#'''
@@ -258,6 +348,7 @@ class DppProtocol(VerboseObject, LineOnlyReceiver):
         # We can auto-detect from that what to send.
         # Macintosh is just out of luck.
         self.delimiter = "\n"
+        self.start_output()
     
     def close(self):
         self.log.debug("Closing")
@@ -268,8 +359,7 @@ class DppProtocol(VerboseObject, LineOnlyReceiver):
             if line.endswith("\r"):
                 self.delimiter = "\r\n"
             address = self.transport.getPeer().host
-            self.service = Service(self, address,
-                self.factory.server, self.factory.game)
+            self.service = self.factory.new_service(self, address)
         else:
             self.translate(line)
     
@@ -285,8 +375,21 @@ class DppProtocol(VerboseObject, LineOnlyReceiver):
     def send_RM(self, representation):
         self.rep = representation
     
+    def sendLine(self, line):
+        self.output([line, self.delimiter])
     def write(self, message):
-        self.sendLine(str(message))
+        self.sendLine(self.encoded(message))
+    def write_list(self, messages):
+        chunks = []
+        for message in messages:
+            chunks.append(self.encoded(message))
+            chunks.append(self.delimiter)
+        self.output(chunks)
+    def encoded(self, message):
+        # The text depends on the output options of the representation.
+        opts = protocol.base_rep.options
+        key = ('dpp', opts.quot_char, opts.output_escape, opts.squeeze_parens)
+        return message.encoded(key, str)
     
     def connectionLost(self, reason=connectionDone):
         if self.service and not self.service.closed:
@@ -425,6 +528,9 @@ class DaideServerFactory(DaideFactory, ServerFactory):
         ('game_port_max', int, None, None,
             'Maximum port for game-specific connections.',
             'If blank, no game-specific ports will be opened.'),
+        ('listen_backlog', int, 1024, None,
+            'Number of connections that may wait to be accepted.',
+            'Many clients connecting at once can overflow a short queue.'),
     )
     
     class LogMixer(object):
@@ -450,6 +556,8 @@ class DaideServerFactory(DaideFactory, ServerFactory):
         self.socket = None
         self.port = None
         self.closed = False
+    def new_service(self, connection, address):
+        return Service(connection, address, self.server, self.game)
     def close(self):
         if self.socket:
             return self.socket.loseConnection().addCallback(self._socketClosed)
@@ -494,7 +602,8 @@ class DaideServerFactory(DaideFactory, ServerFactory):
         return port
     def tryPort(self, reactor, port):
         try:
-            self.socket = reactor.listenTCP(port, self)
+            self.socket = reactor.listenTCP(port, self,
+                self.options.listen_backlog)
         except CannotListenError:
             self.socket = None
             return False
@@ -563,18 +672,25 @@ class Service(VerboseObject):
     def write(self, message):
         # Skips the logging and watcher steps
         self.sock.write(message)
+    def write_list(self, message_list):
+        self.sock.write_list(message_list)
     def send(self, message):
+        self.write(message)
+        self.notify(message)
+    def send_list(self, message_list):
+        # Passed to the connection as a single batch
+        message_list = list(message_list)
+        self.write_list(message_list)
+        for msg in message_list:
+            self.notify(msg)
+    def notify(self, message):
         if message[0] is MDF:
             text = 'MDF [...]'
         else: text = unicode(message)
         self.log_debug(3, '%3s << %s', self.power_name(), text)
-        self.write(message)
         for watcher in self.server.watchers:
             watcher.handle_server_message(message,
                 self.game.game_id, self.client_id)
-    def send_list(self, message_list):
-        for msg in message_list:
-            self.send(msg)
     def accept(self, message):
         self.send(YES(message))
     def reject(self, message):
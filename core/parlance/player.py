@@ -529,7 +529,7 @@ class Sizes(AutoObserver):
     def handle_SCO(self, message):
         self.log_debug(1, 'Supply Centres: ' + '; '.join([
             '%s, %d' % (dist[0], len(dist) - 1)
-            for dist in message.fold()[1:]
+            for dist in message.folded()[1:]
         ]))
 
 class Clock(AutoObserver):
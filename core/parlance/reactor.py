@@ -7,7 +7,23 @@ r'''Parlance Twisted reactor core
     the Artistic License 2.0, as published by the Perl Foundation.
 '''#'''
 
+from heapq import heapify, heappop, heappush
+from itertools import count
+from math import ceil
 from time import time
+from traceback import format_exc
+
+try:
+    from multiprocessing import Pool
+except ImportError:
+    # Python 2.5 and earlier
+    Pool = None
+
+try:
+    from resource import RLIMIT_NOFILE, getrlimit, setrlimit
+except ImportError:
+    # Not available on Windows
+    getrlimit = None
 
 from twisted.application.reactors import getReactorTypes, installReactor
 from twisted.internet.interfaces import IHalfCloseableProtocol
@@ -18,16 +34,34 @@ from zope.interface import implements
 from parlance.config import VerboseObject
 from parlance.util import expand_list
 
+reactor_names = sorted([installer.shortName
+    for installer in getReactorTypes()])
+if "default" in reactor_names:
+    default_reactor = "default"
+else:
+    # Older Twisted releases have no platform default.
+    default_reactor = "select"
+
 
 class ThreadManager(VerboseObject):
     r'''Thin layer over Twisted's reactor, for historical reasons.
     '''#'''
     
     __options__ = (
-        ("reactor", str, "select", None,
+        ("reactor", str, default_reactor, None,
             "Which Twisted reactor to install.",
-            "Choose from %s." % expand_list(sorted(installer.shortName
-                for installer in getReactorTypes()), "or")),
+            "The default reactor is the best one for the platform,",
+            "such as epoll on Linux, which scales to many more",
+            "connections than select.",
+            "Choose from %s." % expand_list(reactor_names, "or")),
+        ("processes", int, 0, None,
+            "Number of worker processes for long calculations,",
+            "such as adjudicating turns for many games at once.",
+            "Use 0 to do everything in the main process."),
+        ("timer_tick", float, 0.01, None,
+            "Resolution of the shared timer for game events, in seconds.",
+            "Events for any number of games that fall within the same",
+            "tick are run together, after a single reactor wakeup."),
     )
     
     def __init__(self, reactor=None):
@@ -35,10 +69,28 @@ class ThreadManager(VerboseObject):
         self.__super.__init__()
         self.reactor = reactor or self.install()
         self.running = []
+        self.pool = None
+        self.timers = []
+        self.timer_order = count()
+        self.cancelled = 0
+        self.wakeup = None
+        self.wakeup_time = None
     def install(self):
         installReactor(self.options.reactor)
+        self.raise_file_limit()
         import twisted.internet.reactor
         return twisted.internet.reactor
+    def raise_file_limit(self):
+        r'''Allows as many open files as the system will permit.
+            Each connection uses one, so a server hosting thousands
+            of clients can otherwise run out at the usual soft limit.
+        '''#'''
+        if getrlimit:
+            soft, hard = getrlimit(RLIMIT_NOFILE)
+            if soft != hard:
+                try: setrlimit(RLIMIT_NOFILE, (hard, hard))
+                except (ValueError, OSError), e:
+                    self.log.debug("Could not raise file limit: %s", e)
     
     def run(self):
         ''' The main loop; never returns until the manager closes.'''
@@ -46,6 +98,9 @@ class ThreadManager(VerboseObject):
         self.reactor.run()
     def close(self):
         self.closed = True
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
         self.reactor.stop()
     def check(self):
         self.log.debug("Checking for stopped clients")
@@ -65,12 +120,104 @@ class ThreadManager(VerboseObject):
         assert not self.closed
         return self.reactor.callLater(delay, client.run)
     
+    # The shared timer
+    def call_later(self, delay, func, *args):
+        r'''Schedules func(*args) to run after delay seconds.
+            Returns a ScheduledCall that can be cancelled or reset.
+            Unlike reactor.callLater(), any number of these share a
+            single reactor call, so thousands of games can keep their
+            deadlines here without swamping the reactor.
+        '''#'''
+        call = ScheduledCall(self, func, args)
+        self.schedule(call, time() + delay)
+        return call
+    def schedule(self, call, when):
+        entry = [when, self.timer_order.next(), call]
+        call.entry = entry
+        heappush(self.timers, entry)
+        self.set_wakeup()
+    def unschedule(self, call):
+        entry = call.entry
+        if entry:
+            entry[2] = None
+            call.entry = None
+            self.cancelled += 1
+            if self.cancelled > len(self.timers) // 2:
+                # Too many dead entries; rebuild the heap without them.
+                self.timers = [e for e in self.timers if e[2]]
+                heapify(self.timers)
+                self.cancelled = 0
+    def set_wakeup(self):
+        r'''Makes sure the reactor wakes up for the earliest event.
+            Wakeups are rounded up to the next tick, so events that
+            are due close together get run by the same one.
+        '''#'''
+        timers = self.timers
+        while timers and not timers[0][2]:
+            heappop(timers)
+            self.cancelled -= 1
+        if not timers or self.closed:
+            return
+        tick = self.options.timer_tick
+        when = timers[0][0]
+        if tick > 0:
+            when = ceil(when / tick) * tick
+        if self.wakeup is None:
+            self.wakeup = self.reactor.callLater(max(0, when - time()),
+                self.run_timers)
+        elif when < self.wakeup_time:
+            self.wakeup.reset(max(0, when - time()))
+        else:
+            return
+        self.wakeup_time = when
+    def run_timers(self):
+        r'''Runs every scheduled call that has come due.
+            Calls scheduled while these run wait for the next wakeup,
+            so the reactor still gets a chance to handle the network.
+        '''#'''
+        self.wakeup = None
+        now = time()
+        timers = self.timers
+        due = []
+        while timers and timers[0][0] <= now:
+            entry = heappop(timers)
+            if entry[2]: due.append(entry)
+            else: self.cancelled -= 1
+        for entry in due:
+            call = entry[2]
+            if call and call.entry is entry:
+                call.entry = None
+                try: call.func(*call.args)
+                except Exception:
+                    self.log.exception("Exception in scheduled call to %r",
+                        call.func)
+        self.set_wakeup()
+    
     def add_threaded(self, client):
         self.log.debug("New threaded client: %s", client.prefix)
         assert not self.closed
         return self.new_thread(client.run)
     def new_thread(self, target, *args, **kwargs):
         return self.reactor.callInThread(target, *args, **kwargs)
+    def parallel(self):
+        r'''Whether new_process() will use a separate worker process.'''
+        return bool(Pool and self.options.processes > 0 and not self.closed)
+    def new_process(self, callback, target, *args):
+        r'''Calls target(*args) in a worker process.
+            The target and its arguments must be picklable.
+            When it finishes, callback gets called in the reactor thread
+            with a success flag and either the result or a traceback.
+            Without worker processes, both get called immediately.
+        '''#'''
+        if not self.parallel():
+            callback(*call_safely(target, args))
+            return
+        if not self.pool:
+            self.pool = Pool(self.options.processes)
+        def finished(result):
+            # Runs in the pool's result thread.
+            self.reactor.callFromThread(callback, *result)
+        self.pool.apply_async(call_safely, (target, args), callback=finished)
     
     # Help for specific types of clients
     def add_server(self, server, game=None):
@@ -94,6 +241,37 @@ class ThreadManager(VerboseObject):
         port = factory.options.port
         return self.reactor.connectTCP(host, port, factory)
 
+class ScheduledCall(object):
+    r'''A call scheduled with ThreadManager.call_later().
+        Works like the reactor's IDelayedCall, for the parts we use.
+    '''#'''
+    
+    def __init__(self, manager, func, args):
+        self.manager = manager
+        self.func = func
+        self.args = args
+        self.entry = None
+    
+    def active(self):
+        return self.entry is not None
+    def getTime(self):
+        return self.entry and self.entry[0]
+    def cancel(self):
+        self.manager.unschedule(self)
+    def reset(self, delay):
+        self.manager.unschedule(self)
+        self.manager.schedule(self, time() + delay)
+
+def call_safely(target, args):
+    r'''Runs a function in a worker process for new_process().
+        Exceptions don't travel well between processes, so this
+        returns a success flag along with the result or traceback.
+    '''#"""#'''
+    try:
+        return True, target(*args)
+    except Exception:
+        return False, format_exc()
+
 class InputWaiter(LineOnlyReceiver):
     r'''Protocol to direct stdin lines to the input handler.'''
     implements(IHalfCloseableProtocol)
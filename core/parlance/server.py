@@ -9,13 +9,17 @@ r'''Parlance game server
 '''#'''
 
 import re
+import zlib
+from heapq      import heapify, heappop, heappush
 from os         import path
 from random     import randint, shuffle
+from struct     import pack, unpack
 from time       import time
 
 from config     import GameOptions, VerboseObject, bots, variants, watchers
 from fallbacks  import defaultdict
 from gameboard  import Turn
+from judge      import run_exported
 from language   import Message, Time, protocol
 from main       import ServerProgram
 from tokens     import *
@@ -36,6 +40,12 @@ class DelayedAction(object):
         self.terms = terms
         self.args = args
         self.when = time() + delay
+    
+    # Ordering for the game's queue of actions.
+    # Equality is left alone, so vetoes remove the right one.
+    def __lt__(self, other): return self.when < other.when
+    def __le__(self, other): return self.when <= other.when
+    
     def veto(self, client):
         ''' Cancels the action, calling the veto action if it was given.
             The veto callback may return a true value to block the cancellation,
@@ -48,7 +58,9 @@ class DelayedAction(object):
             if self.veto_line:
                 client.game.admin('%s has vetoed %s',
                         client.full_name(), self.veto_line)
-            client.game.actions.remove(self)
+            actions = client.game.actions
+            actions.remove(self)
+            heapify(actions)
     def call(self):
         if self.callback: self.callback(*self.args)
 
@@ -70,6 +82,12 @@ class Server(ServerProgram):
             'However, the server will stop reporting them in game listings.'),
         ('log_path', file, path.join('log', 'games'), 'game log directory',
             'The directory in which to save game logs.'),
+        ('log_format', str, 'text', 'game log format',
+            'How to save game logs: "text" for readable messages,',
+            '"packed" for token numbers, which load much faster,',
+            'or "compressed" for packed tokens compressed with zlib.',
+            'Packed logs are saved with a .dpb extension;',
+            'logs in either format can be loaded.'),
         
         # Admin messages
         ('snd_admin', bool, True, 'send admin messages',
@@ -102,12 +120,17 @@ class Server(ServerProgram):
         self.quitting  = False
         self.watchers = [watchers[key]() for key in watchers]
         self.started_games = 0
-        if not self.start_game():
+        if not self.start_default():
             self.log_debug(1, 'Unable to start default variant')
             self.close()
-    def filename(self, game_id):
-        fname = game_id + path.extsep + 'dpp'
+    def start_default(self):
+        ''' Starts the game to be joined by clients that don't select one.'''
+        return self.start_game()
+    def filename(self, game_id, packed=False):
+        fname = game_id + path.extsep + (packed and 'dpb' or 'dpp')
         return path.join(self.options.log_path, fname)
+    def packed_logs(self):
+        return self.options.log_format in ('packed', 'compressed')
     
     def add_client(self, client):
         self.clients[client.client_id] = client
@@ -142,10 +165,16 @@ class Server(ServerProgram):
             else: self.start_game()
     def archive(self, game):
         if not self.options.log_games: return
-        fname = self.filename(game.game_id)
+        packed = self.packed_logs()
+        fname = self.filename(game.game_id, packed)
         try:
-            saved = open(fname, 'w')
-            game.save(saved)
+            if packed:
+                saved = open(fname, 'wb')
+                game.save_packed(saved,
+                    self.options.log_format == 'compressed')
+            else:
+                saved = open(fname, 'w')
+                game.save(saved)
             saved.close()
         except IOError, err:
             self.log_debug(7, 'Unable to save %s: %s', fname, err)
@@ -259,19 +288,26 @@ class Server(ServerProgram):
             # Resuscitate an archived game as a Historian
             # Todo: What if the game hadn't finished before the server closed?
             new_game = Historian(self, game_id)
-            try:
-                saved = open(self.filename(game_id), 'rU')
-                result = new_game.load(saved)
-                saved.close()
-            except IOError: pass
-            except Exception, e:
-                self.log_debug(1,
-                        'Exception while loading a saved game: %s %s',
-                        e.__class__.__name__, e.args)
-            else:
-                if result:
-                    self.games[game_id] = new_game
-                    game = new_game
+            preferred = self.packed_logs()
+            for packed in (preferred, not preferred):
+                try:
+                    if packed:
+                        saved = open(self.filename(game_id, True), 'rb')
+                        result = new_game.load_packed(saved)
+                    else:
+                        saved = open(self.filename(game_id), 'rU')
+                        result = new_game.load(saved)
+                    saved.close()
+                except IOError: continue
+                except Exception, e:
+                    self.log_debug(1,
+                            'Exception while loading a saved game: %s %s',
+                            e.__class__.__name__, e.args)
+                else:
+                    if result:
+                        self.games[game_id] = new_game
+                        game = new_game
+                break
         
         return game
     def join_game(self, client, game_id):
@@ -308,13 +344,15 @@ class Server(ServerProgram):
             if not game_id:
                 game_id = timestamp()
             
-            self.started_games += 1
             if client: client.admin('New game started, with id %s.', game_id)
-            game = Game(self, game_id, variant)
-            self.games[game_id] = game
-            self.default.append(game)
-            return game
+            return self.new_game(game_id, variant)
         return None
+    def new_game(self, game_id, variant):
+        self.started_games += 1
+        game = Game(self, game_id, variant)
+        self.games[game_id] = game
+        self.default.append(game)
+        return game
     def select_game(self, client, match):
         # Select a new game via admin command.
         # Must be careful here, because the client is less capable.
@@ -421,7 +459,8 @@ class Dynamic(VerboseObject):
         Useful when deadlines shift frequently.
         
         Based on twisted.protocols.policies.TimeoutMixin,
-        but without the automatic reactor installation.
+        but using the manager's shared timer instead of the reactor,
+        so each game costs one heap entry rather than a reactor call.
     '''#"""#'''
     
     # Todo: Distill the timer-related portions of Historian and Game.
@@ -429,7 +468,7 @@ class Dynamic(VerboseObject):
     
     def callLater(self, period, func):
         # This could be simpler, but I distrust singletons.
-        return self.server.manager.reactor.callLater(period, func)
+        return self.server.manager.call_later(period, func)
     
     def resetTimeout(self):
         now = time()
@@ -491,6 +530,7 @@ class Historian(Dynamic):
             - finished         Whether the game has completed
             - closed           Whether the game is trying to unload
             - clients          List of Clients that have accepted the map
+            - actions          Heap of DelayedActions, earliest first
         '''#'''
         self.__super.__init__()
         self.server = server
@@ -509,29 +549,144 @@ class Historian(Dynamic):
         self.validator = Validator()
         self.actions = []
     
-    def save(self, stream):
+    # Sections of a game log
+    opening_section = 0
+    turn_section = 1
+    closing_section = 2
+    
+    # Start of a packed game log, and the flag for compression
+    packed_magic = 'DPB\x01'
+    compressed_flag = 0x01
+    
+    def log_sections(self):
+        ''' Collects the messages to save for the game, in order.
+            Returns a list of (section type, turn key, messages) tuples;
+            the turn key is None for the opening and closing sections.
+        '''#'''
         if not self.started:
             raise UserWarning('Trying to save an unstarted game')
-        def write_message(msg): stream.write(str(msg) + '\n')
-        def write(token): write_message(self.messages[token])
-        write(LST)
-        write(MAP)
-        write(VAR)
-        write(MDF)
-        write(HLO)
-        write(SCO)
-        write(NOW)
+        opening = [self.messages[token]
+            for token in (LST, MAP, VAR, MDF, HLO, SCO, NOW)]
+        sections = [(self.opening_section, None, opening)]
         for turn in sorted(self.history.keys()):
-            for message in self.get_history(turn, False):
-                write_message(message)
-        if self.judge.game_result: write_message(self.judge.game_result)
-        if self.started:
-            if self.finished: write(SMR)
-            else:
-                for country, player in self.players:
-                    write_message(IAM (country) (player.pcode))
+            sections.append((self.turn_section, turn,
+                self.get_history(turn, False)))
+        closing = []
+        if self.judge.game_result: closing.append(self.judge.game_result)
+        if self.finished: closing.append(self.messages[SMR])
+        else:
+            for country, player in self.players:
+                closing.append(IAM (country) (player.pcode))
+        sections.append((self.closing_section, None, closing))
+        return sections
+    def save(self, stream):
+        for section, turn, messages in self.log_sections():
+            for message in messages:
+                stream.write(str(message) + '\n')
+        self.saved = True
+        self.broadcast(SVE(str(self.game_id)))
+    def save_packed(self, stream, compress=False):
+        ''' Saves the game log as packed token numbers.
+            After the magic string and a byte of flags comes the index:
+            the number of sections, then the type, year, season index,
+            and message count of each, then the length of each message.
+            The messages themselves follow, packed as for the network.
+            Everything after the flags may be compressed with zlib.
+        '''#'''
+        sections = self.log_sections()
+        index = [pack('!I', len(sections))]
+        lengths = []
+        data = []
+        for section, turn, messages in sections:
+            year, season = turn or (0, 0)
+            index.append(pack('!BiHI', section, year, season, len(messages)))
+            for message in messages:
+                packed = message.pack()
+                lengths.append(len(packed) // 2)
+                data.append(packed)
+        index.append(pack('!%dI' % len(lengths), *lengths))
+        body = ''.join(index + data)
+        flags = 0
+        if compress:
+            body = zlib.compress(body)
+            flags |= self.compressed_flag
+        stream.write(self.packed_magic + chr(flags) + body)
         self.saved = True
         self.broadcast(SVE(str(self.game_id)))
+    def load_packed(self, stream):
+        ''' Loads a game log saved by save_packed().'''
+        data = stream.read()
+        start = len(self.packed_magic)
+        if data[:start] != self.packed_magic:
+            raise ValueError('not a packed game log')
+        body = data[start + 1:]
+        if ord(data[start]) & self.compressed_flag:
+            body = zlib.decompress(body)
+        
+        # Read the index
+        count = unpack('!I', body[:4])[0]
+        end = 4 + 11 * count
+        sections = [unpack('!BiHI', body[pos:pos + 11])
+            for pos in range(4, end, 11)]
+        total = sum([section[3] for section in sections])
+        lengths = unpack('!%dI' % total, body[end:end + 4 * total])
+        
+        sco = None
+        turn = None
+        result = None
+        rep = protocol.base_rep
+        history = {}
+        messages = {}
+        pos = end + 4 * total
+        message_number = 0
+        for section, year, season, count in sections:
+            if section == self.turn_section:
+                turn = (year, season)
+                entry = history[turn] = {
+                        SUB: [],
+                        ORD: [],
+                        SCO: sco,
+                        'new_SCO': False,
+                        NOW: None
+                }
+            for length in lengths[message_number:message_number + count]:
+                message = rep.unpack(body[pos:pos + 2 * length])
+                pos += 2 * length
+                first = message[0]
+                if section == self.opening_section:
+                    messages[first] = message
+                    if first is SCO: sco = message
+                    elif first is MAP:
+                        if not self.select_variant(message): return False
+                        rep = self.variant.rep
+                    elif first is HLO:
+                        self.game_options.parse_message(message)
+                elif section == self.turn_section:
+                    if first is SCO:
+                        entry[SCO] = sco = message
+                        entry['new_SCO'] = True
+                    elif first is NOW: entry[NOW] = message
+                    else: entry[first].append(message)
+                elif first is SMR: messages[SMR] = message
+                elif first in (DRW, SLO): result = message
+            message_number += count
+        self.judge = self.HistoricalJudge(self, turn, result)
+        self.history = history
+        self.messages = messages
+        self.saved = True
+        return True
+    def select_variant(self, message):
+        ''' Sets the variant named in a MAP message.
+            Returns False if the variant can't be found.
+        '''#'''
+        variant_name = message.fold()[1][0]
+        try:
+            self.variant = variants[variant_name]
+        except KeyError:
+            self.log_debug(7, 'Variant %r not found among %r',
+                    variant_name, variants.keys())
+            return False
+        return True
     def load(self, stream):
         sco = None
         turn = None
@@ -562,15 +717,8 @@ class Historian(Dynamic):
             elif first in (LST, MAP, VAR, MDF, HLO, SMR):
                 messages[first] = message
                 if first is MAP:
-                    variant_name = message.fold()[1][0]
-                    try:
-                        self.variant = variants[variant_name]
-                    except KeyError:
-                        self.log_debug(7, 'Variant %r not found among %r',
-                                variant_name, variants.keys())
-                        return False
-                    else:
-                        rep = self.variant.rep
+                    if not self.select_variant(message): return False
+                    rep = self.variant.rep
                 elif first is HLO:
                     self.game_options.parse_message(message)
             elif first in (DRW, SLO):
@@ -597,6 +745,14 @@ class Historian(Dynamic):
             client.write(message)
         for watcher in self.server.watchers:
             watcher.handle_broadcast_message(message, self.game_id)
+    def broadcast_list(self, messages):
+        ''' Sends a series of messages to each ready client as one batch.'''
+        for message in messages: self.log.info("ALL << %s", message)
+        for client in self.clients:
+            client.write_list(messages)
+        for message in messages:
+            for watcher in self.server.watchers:
+                watcher.handle_broadcast_message(message, self.game_id)
     def admin(self, line, *args):
         if self.server.options.snd_admin:
             self.broadcast(ADM('Server')(str(line) % args))
@@ -670,17 +826,21 @@ class Historian(Dynamic):
         '''#'''
         result = None
         if self.actions:
-            next_action = min([a.when for a in self.actions])
-            result = next_action - now
+            result = self.actions[0].when - now
         return result
     def run(self):
         r'''Runs any queued actions.
         '''#'''
-        now = time()
-        for act in list(self.actions):
-            if act.when <= now:
-                act.call()
-                self.actions.remove(act)
+        self.run_actions(time())
+    def run_actions(self, now):
+        r'''Runs the queued actions that have come due, in order.
+        '''#'''
+        actions = self.actions
+        while actions and actions[0].when <= now:
+            heappop(actions).call()
+    def add_action(self, action):
+        heappush(self.actions, action)
+        self.resetTimeout()
     
     # History replay via admin command
     def replay(self, client, match):
@@ -699,7 +859,6 @@ class Historian(Dynamic):
         else:
             rate = 1
         self.replay_step(client, rate, turn)
-        self.resetTimeout()
     def replay_step(self, client, rate, turn):
         self.log.debug("Replaying %s for %s", turn, client.prefix)
         result = self.get_history(turn, False)
@@ -709,7 +868,7 @@ class Historian(Dynamic):
             # Queue the next turn's results
             now = self.history[turn][NOW]
             next = Turn(now[2], now[3])
-            self.actions.append(DelayedAction(self.replay_step,
+            self.add_action(DelayedAction(self.replay_step,
                     None, None, [], rate, client, rate, next))
     
     commands = [
@@ -795,6 +954,8 @@ class Game(Historian):
             - press_deadline   When press must stop for the current turn
             - time_checked     When time notifications were last sent
             - time_stopped     Time remaining when the clock stopped
+            - judging          Whether a worker process has the turn
+            - judge_started    When the judge was last asked to run
             - press_in         Whether press is allowed during a given phase
             - limits           The time limits for the phases, as well as max and press
             - players          Power token -> player mappings
@@ -816,10 +977,13 @@ class Game(Historian):
         self.press_allowed  = False
         self.paused         = False
         self.timers         = {}
+        self.time_requests  = []
         self.deadline       = None
         self.press_deadline = 0
         self.time_checked   = None
         self.time_stopped   = None
+        self.judging        = False
+        self.judge_started  = None
         
         self.set_limits()
         
@@ -1048,6 +1212,7 @@ class Game(Historian):
             self.time_checked = seconds
         self.deadline = self.time_stopped = None
         self.press_deadline = 0
+        self.queue_time_requests()
         if seconds and not self.finished:
             message = TME(Time(seconds))
             if self.paused:
@@ -1066,14 +1231,22 @@ class Game(Historian):
         if self.ready(): return 0
         result = None
         if self.deadline and not self.paused:
-            timers = [sec for sec in self.timers if sec < self.time_checked]
-            timers.append(self.limits['press'] and self.press_deadline)
-            result = self.deadline - max(timers)
+            marks = [self.limits['press'] and self.press_deadline]
+            if self.time_requests: marks.append(-self.time_requests[0])
+            result = self.deadline - max(marks)
         if self.actions:
-            next_action = min([a.when for a in self.actions])
+            next_action = self.actions[0].when
             if result: result = min(next_action, result)
             else: result = next_action
         return result and result - now
+    def queue_time_requests(self):
+        ''' Collects the requested times still to come this turn.
+            time_requests is a heap of negated seconds, so the next
+            notification due is always at the top.
+        '''#'''
+        self.time_requests = [-sec for sec in self.timers
+            if sec < self.time_checked]
+        heapify(self.time_requests)
     def cancel_time_requests(self, client):
         ''' Removes the client from the list of time requests.'''
         for client_list in self.timers.itervalues():
@@ -1084,36 +1257,68 @@ class Game(Historian):
         '''#'''
         now = time()
         self.log.debug("Checking game actions")
-        for act in list(self.actions):
-            if act.when <= now: act.call(); self.actions.remove(act)
+        self.run_actions(now)
         if self.ready(): self.run_judge()
         elif self.deadline and not self.paused:
             remain = self.deadline - now
-            times = reversed(sorted(sec for sec in self.timers
-                        if remain < sec < self.time_checked))
-            for second in times:
-                self.time_checked = second
-                for client in self.timers[second]:
-                    client.send(TME(Time(second)))
+            requests = self.time_requests
+            while requests and -requests[0] > remain:
+                second = -heappop(requests)
+                if second < self.time_checked:
+                    self.time_checked = second
+                    for client in self.timers[second]:
+                        client.send(TME(Time(second)))
             if now > self.deadline: self.run_judge()
             elif remain < self.press_deadline:
                 self.press_allowed  = False
     def ready(self):
         self.log.debug("Paused: %r", self.paused)
+        self.log.debug("Judging: %r", self.judging)
         self.log.debug("Judge unready: %s", repr(self.judge.unready))
         self.log.debug("Players unready: %r", self.players_unready())
-        return not (self.paused or self.judge.unready or self.players_unready())
+        return not (self.paused or self.judging
+                or self.judge.unready or self.players_unready())
     def run_judge(self):
-        ''' Runs the judge and handles turn transitions.'''
+        ''' Runs the judge and handles turn transitions.
+            If the server has worker processes, the turn is adjudicated
+            in one of them, and nothing else happens to the orders until
+            its results come back; otherwise, it runs right here.
+        '''#'''
+        if self.judging: return
         if self.deadline: self.log_debug(10, 'Running the judge with %f seconds left', self.deadline - time())
         else: self.log_debug(10, 'Running the judge')
         
-        key = self.judge.turn().key
+        self.judge_started = time()
+        manager = self.server.manager
+        state = manager.parallel() and self.judge.export()
+        if state:
+            self.judging = True
+            self.deadline = None
+            self.press_allowed = False
+            manager.new_process(self.judged, run_exported, state)
+        else:
+            key = self.judge.turn().key
+            self.process_results(key, self.judge.run())
+    def judged(self, success, outcome):
+        ''' Handles the results of a turn adjudicated in another process.'''
+        self.judging = False
+        if self.closed or self.finished:
+            self.log_debug(10, 'Discarding results for a closed game')
+        else:
+            key = self.judge.turn().key
+            if success: results = self.judge.load_results(outcome)
+            else:
+                self.log.warning("Remote adjudication failed:\n%s", outcome)
+                results = self.judge.run()
+            self.process_results(key, results)
+    def process_results(self, key, results):
+        ''' Records and broadcasts the results of adjudicating a turn.'''
+        self.report_metrics()
         self.history[key] = turn = {
             SUB: [], ORD: [], SCO: None, NOW: None, 'new_SCO': False
         }
-        for message in self.judge.run():
-            self.broadcast(message)
+        self.broadcast_list(results)
+        for message in results:
             if message[0] in (ORD, SUB): turn[message[0]].append(message)
             elif message[0] in (SCO, NOW): turn[message[0]] = message
         if not turn[SCO]: turn[SCO] = self.judge.map.create_SCO()
@@ -1124,15 +1329,24 @@ class Game(Historian):
             for player in self.players.itervalues():
                 if player.client: player.ready = True
         else: self.finish()
+    def report_metrics(self):
+        ''' Passes the judge's measurements of its last run to the watchers.'''
+        metrics = self.judge.metrics
+        if metrics:
+            metrics.latency = time() - self.judge_started
+            for watcher in self.server.watchers:
+                try: watcher.handle_judge_metrics(metrics, self.game_id)
+                except Exception:
+                    self.log.exception("Exception in watcher handler for %s",
+                        watcher.prefix)
     def queue_action(self, client, action_callback, action_line,
             veto_callback, veto_line, veto_terms, *args):
         delay = self.options.veto_time
         self.admin('%s is %s', client.full_name(), action_line)
         if delay > 0:
-            self.actions.append(DelayedAction(action_callback, veto_callback,
+            self.add_action(DelayedAction(action_callback, veto_callback,
                 veto_line, veto_terms, delay, *args))
             self.admin('(You may veto within %s seconds.)', num2name(delay))
-            self.resetTimeout()
         else: action_callback(*args)
     def full_name(self): return 'The server'
     
@@ -1190,7 +1404,7 @@ class Game(Historian):
         return result
     def handle_GOF(self, client, message):
         country = client.country
-        if country and self.judge.phase:
+        if country and self.judge.phase and not self.judging:
             self.players[country].ready = True
             client.accept(message)
             missing = self.judge.missing_orders(country)
@@ -1259,12 +1473,23 @@ class Game(Historian):
             else:
                 # Add it to the list
                 self.timers.setdefault(request, []).append(client)
+                if (request < self.time_checked
+                        and len(self.timers[request]) == 1):
+                    heappush(self.time_requests, -request)
                 client.accept(message)
                 self.resetTimeout()
         else: client.reject(message)
     def handle_SUB(self, client, message):
-        self.judge.handle_SUB(client, message)
-        self.resetTimeout()
+        if self.judging: client.reject(message)
+        else:
+            self.judge.handle_SUB(client, message)
+            self.resetTimeout()
+    def handle_MIS(self, client, message):
+        if self.judging: client.reject(message)
+        else: self.judge.handle_MIS(client, message)
+    def handle_DRW(self, client, message):
+        if self.judging: client.reject(message)
+        else: self.judge.handle_DRW(client, message)
     
     # Messages with standard prefixes
     def handle_NOT_TME(self, client, message):
@@ -1283,11 +1508,18 @@ class Game(Historian):
         client.send(reply(message))
     def handle_NOT_GOF(self, client, message):
         country = client.country
-        if country and self.judge.phase and not self.judge.eliminated(country):
+        if (country and self.judge.phase and not self.judging
+                and not self.judge.eliminated(country)):
             self.players[country].ready = False
             client.accept(message)
             self.resetTimeout()
         else: client.reject(message)
+    def handle_NOT_SUB(self, client, message):
+        if self.judging: client.reject(message)
+        else: self.judge.handle_NOT_SUB(client, message)
+    def handle_NOT_DRW(self, client, message):
+        if self.judging: client.reject(message)
+        else: self.judge.handle_NOT_DRW(client, message)
     def handle_YES_MAP(self, client, message):
         if message.fold()[1][1][0].lower() == self.judge.map_name:
             if client in self.clients: return # Ignore duplicate messages
@@ -1606,8 +1838,8 @@ class Game(Historian):
                 None, 'ending the game.', ('end', 'close', 'finish'))
     def veto_admin(self, client, match):
         word = match.group(2)
-        if word: actions = [a for a in self.actions if word in a.terms]
-        else: actions = list(self.actions)
+        if word: actions = [a for a in sorted(self.actions) if word in a.terms]
+        else: actions = sorted(self.actions)
         if actions:
             for vetoed in actions: vetoed.veto(client)
         else:
@@ -0,0 +1,570 @@
+r'''Parlance sharded game server
+    Copyright (C) 2009  Eric Wald
+    
+    This module spreads the games of one server across worker processes,
+    so that a host with several cores can run many games in parallel.
+    A front-end process accepts every connection, on the main port and on
+    the game-specific ports, and relays each client's messages to the
+    worker hosting the client's game.  Each worker runs an ordinary Server
+    without sockets, reporting its games back to the front end.
+    
+    Parlance may be used, modified, and/or redistributed under the terms of
+    the Artistic License 2.0, as published by the Perl Foundation.
+'''#'''
+
+import os
+import sys
+from itertools import count
+from struct    import calcsize, pack, unpack
+
+try:
+    from multiprocessing import cpu_count
+except ImportError:
+    # Python 2.5 and earlier
+    cpu_count = None
+
+from twisted.internet.protocol import ProcessProtocol, Protocol, connectionDone
+from twisted.internet.stdio import StandardIO
+
+from parlance.config    import Configuration, VerboseObject, variants
+from parlance.fallbacks import any
+from parlance.language  import Representation, protocol
+from parlance.main      import ServerProgram
+from parlance.network   import DaideServerFactory, Service
+from parlance.reactor   import ThreadManager
+from parlance.server    import Server
+from parlance.tokens    import ADM, LST, REJ, SEL, YES
+from parlance.util      import timestamp
+
+class ShardLink(object):
+    r'''Frames for the traffic between the front end and its workers.
+        Each frame has a type, a client or request number, and a body;
+        the handle_<type> method for the frame's type gets the other two.
+    '''#'''
+    
+    header = '!BII'
+    header_size = calcsize(header)
+    frame_types = ('CONNECT', 'MESSAGE', 'CLOSE', 'START', 'BROADCAST',
+        'SHUTDOWN', 'LIST', 'LISTING', 'LISTED', 'REPRESENTATION',
+        'OPENED', 'CLOSED', 'STATUS')
+    (CONNECT, MESSAGE, CLOSE, START, BROADCAST, SHUTDOWN, LIST, LISTING,
+        LISTED, REPRESENTATION, OPENED, CLOSED, STATUS) = range(13)
+    
+    def start_link(self):
+        self.received = []
+        self.received_size = 0
+        self.needed = self.header_size
+        self.handlers = {}
+        for number, name in enumerate(self.frame_types):
+            handler = getattr(self, 'handle_' + name, None)
+            if handler: self.handlers[number] = handler
+    def frame(self, kind, number, data=''):
+        return pack(self.header, kind, number, len(data)) + data
+    def send(self, kind, number=0, data=''):
+        self.write_frames([self.frame(kind, number, data)])
+    def write_frames(self, frames):
+        raise NotImplementedError
+    def frames_received(self, data):
+        r'''Collects incoming data, handling each complete frame.
+            Chunks are joined only once the next frame has arrived.
+        '''#'''
+        self.received.append(data)
+        self.received_size += len(data)
+        if self.received_size < self.needed:
+            return
+        data = str.join('', self.received)
+        size = self.header_size
+        offset = 0
+        self.needed = size
+        while len(data) - offset >= size:
+            kind, number, length = unpack(self.header,
+                data[offset:offset + size])
+            end = offset + size + length
+            if len(data) < end:
+                self.needed = size + length
+                break
+            body = data[offset + size:end]
+            offset = end
+            handler = self.handlers.get(kind)
+            if handler: handler(number, body)
+            else: self.log.warning("Unexpected frame type %d", kind)
+        if offset < len(data):
+            self.received = [data[offset:]]
+        else: self.received = []
+        self.received_size = len(data) - offset
+
+def pack_representation(rep):
+    return str.join('', [pack('!H3sx', token.number, name)
+        for name, token in rep.items()])
+def unpack_representation(data):
+    rep = {}
+    for i in xrange(0, len(data), 6):
+        num, name = unpack('!H3sx', data[i:i+6])
+        rep[num] = name
+    return Representation(rep, protocol.base_rep)
+
+
+# Front end
+class ShardedServer(ServerProgram):
+    r'''Front end for a server whose games run in worker processes.
+        Accepts every connection, sends each client to the worker
+        hosting its game, and keeps track of the games on each worker.
+        Admin broadcasts, game listings, and the decisions to start
+        default games or to shut down cover every worker.
+    '''#'''
+    
+    __section__ = 'server'
+    __options__ = tuple([item for item in Server.__options__
+            if item[0] in ('games', 'variant')]) + (
+        ('shards', int, 0, None,
+            'Number of worker processes for the sharded server.',
+            'Use 0 to start one for each processor.'),
+    )
+    
+    @classmethod
+    def run_program(cls, args):
+        r'''Run a sharded game server.
+            Takes the same arguments as the plain server.
+        '''#'''
+        if args:
+            if args[0] in variants:
+                Configuration.set_globally('variant', args[0])
+            else: cls.usage('Unknown variant %r', args[0])
+        
+        manager = ThreadManager()
+        server = cls(manager)
+        if server.start():
+            manager.run()
+        else: manager.log.critical("Failed to open the socket.")
+    
+    def __init__(self, manager):
+        ''' Initializes instance variables, including:
+            - manager       The ThreadManager instance in charge of the program
+            - shards        Shard for each worker process
+            - relays        client_id -> Relay for all connected clients
+            - games         game_id -> Shard hosting that game
+            - default       The id of the game joined by default
+            - started_games The number of games that have been started
+        '''#'''
+        self.__super.__init__()
+        self.manager   = manager
+        self.relays    = {}
+        self.games     = {}
+        self.ports     = {}
+        self.requests  = {}
+        self.reps      = {}
+        self.default   = None
+        self.factory   = None
+        self.closing   = False
+        self.closed    = False
+        self.quitting  = False
+        self.started_games = 0
+        self.next_request = count(1).next
+        number = self.options.shards or (cpu_count and cpu_count()) or 1
+        self.shards = [Shard(self, index) for index in range(number)]
+    def start(self):
+        ''' Starts the worker processes and opens the main port.'''
+        for shard in self.shards:
+            shard.start(self.manager.reactor)
+        factory = RelayFactory(self)
+        if factory.openPort(self.manager.reactor):
+            self.factory = factory
+            self.manager.running.append(self)
+            return True
+        self.close()
+        return False
+    def live_shards(self):
+        return [shard for shard in self.shards if not shard.closed]
+    def representation(self, data):
+        rep = self.reps.get(data)
+        if rep is None:
+            rep = self.reps[data] = unpack_representation(data)
+        return rep
+    
+    # Games and clients
+    def route(self, game_id=None):
+        ''' Chooses the game and shard for a new client.'''
+        shard = self.games.get(game_id)
+        if not shard or shard.closed:
+            shard = self.default and self.games[self.default]
+            if not shard or shard.closed:
+                self.start_game()
+            game_id = self.default
+            shard = self.games.get(game_id)
+        return game_id, shard
+    def start_game(self):
+        ''' Starts a default game on the next worker in turn.'''
+        shards = self.live_shards()
+        if not shards: return None
+        shard = shards[self.started_games % len(shards)]
+        game_id = timestamp()
+        shard.send(shard.START, 0, '%s %s' % (game_id, self.options.variant))
+        self.games[game_id] = shard
+        self.default = game_id
+        self.started_games += 1
+        return game_id
+    def game_opened(self, shard, game_id):
+        if not self.games.has_key(game_id):
+            # Started on the worker, by admin command
+            self.started_games += 1
+        self.games[game_id] = shard
+        factory = RelayFactory(self, game_id)
+        if factory.openPort(self.manager.reactor):
+            self.ports[game_id] = factory
+    def game_closed(self, shard, game_id):
+        factory = self.ports.pop(game_id, None)
+        if factory: factory.close()
+        if self.default == game_id: self.default = None
+    def disconnect(self, relay):
+        del self.relays[relay.client_id]
+    def check_close(self):
+        ''' Closes the server if all requested games have been completed.
+            Meant to be called when a worker reports its open games,
+            which it does when its last client disconnects.
+        '''#'''
+        if self.relays or self.closing: return
+        if self.quitting:
+            self.log.info("Closing politely, by request.")
+            self.close()
+        elif not any(shard.open_games for shard in self.live_shards()):
+            if 0 < self.options.games <= self.started_games:
+                self.log_debug(11, 'Completed all requested games')
+                self.close()
+            else: self.start_game()
+    
+    # Requests covering every worker
+    def broadcast(self, data):
+        for shard in self.live_shards():
+            shard.send(shard.BROADCAST, 0, data)
+    def list_games(self, relay, message):
+        if len(message) > 3:
+            shard = self.games.get(message.fold()[1][0])
+            shards = [shard for shard in [shard] if shard and not shard.closed]
+        else: shards = self.live_shards()
+        request = self.next_request()
+        self.requests[request] = [relay, message, set(shards), False]
+        for shard in shards:
+            shard.send(shard.LIST, request, message.pack())
+        if not shards: self.finish_listing(request)
+    def listing(self, request, data):
+        entry = self.requests.get(request)
+        if entry:
+            entry[3] = True
+            relay = entry[0]
+            if not relay.closed:
+                relay.sock.write(protocol.default_rep.unpack(data))
+    def listed(self, shard, request):
+        entry = self.requests.get(request)
+        if entry:
+            entry[2].discard(shard)
+            if not entry[2]: self.finish_listing(request)
+    def finish_listing(self, request):
+        relay, message, shards, found = self.requests.pop(request)
+        if not relay.closed:
+            if len(message) <= 3: relay.sock.write(YES(message))
+            elif not found: relay.sock.write(REJ(message))
+    def shutdown(self, now):
+        if now or not self.relays:
+            self.close()
+        else: self.quitting = True
+    
+    # Closing down
+    def close(self):
+        ''' Tells the workers to close, and closes when they have.'''
+        if not self.closing:
+            self.log_debug(10, 'Closing')
+            self.closing = True
+            for shard in self.live_shards():
+                shard.send(shard.SHUTDOWN)
+            if not self.live_shards(): self.finish()
+    def shard_ended(self, shard):
+        for relay in self.relays.values():
+            if relay.shard is shard: relay.close(True)
+        for request, entry in self.requests.items():
+            if shard in entry[2]: self.listed(shard, request)
+        if not self.live_shards():
+            self.closing = True
+            self.finish()
+    def finish(self):
+        if not self.closed:
+            if self.factory: self.factory.close()
+            for factory in self.ports.values(): factory.close()
+            self.ports = {}
+            self.closed = True
+            self.manager.check()
+            self.log_debug(11, 'Done closing')
+
+class Shard(VerboseObject, ProcessProtocol, ShardLink):
+    r'''The front end's connection to one worker process.
+        The worker reads frames from its standard input, and writes them
+        to file descriptor 3, leaving standard output free for logging.
+    '''#'''
+    command = 'from parlance.shard import ShardWorker; ShardWorker.main()'
+    
+    def __init__(self, front, number):
+        self.__super.__init__()
+        self.front = front
+        self.prefix = 'Shard #%d' % number
+        self.closed = False
+        self.open_games = []
+        self.start_link()
+    def start(self, reactor):
+        args = [sys.executable, '-c', self.command] + sys.argv[1:]
+        reactor.spawnProcess(self, sys.executable, args, env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2, 3: 'r'})
+    def write_frames(self, frames):
+        if not self.closed:
+            self.transport.writeToChild(0, str.join('', frames))
+    def childDataReceived(self, fd, data):
+        if fd == 3: self.frames_received(data)
+    def processEnded(self, reason):
+        self.log.debug("Worker ended: %s", reason.value)
+        self.closed = True
+        self.front.shard_ended(self)
+    
+    def relay(self, client_id):
+        # Ignores clients that have since moved to another worker
+        relay = self.front.relays.get(client_id)
+        return relay and relay.shard is self and relay
+    def handle_REPRESENTATION(self, client_id, data):
+        relay = self.relay(client_id)
+        if relay: relay.send_RM(self.front.representation(data))
+    def handle_MESSAGE(self, client_id, data):
+        relay = self.relay(client_id)
+        if relay: relay.write(data)
+    def handle_CLOSE(self, client_id, data):
+        relay = self.relay(client_id)
+        if relay: relay.close(True)
+    def handle_OPENED(self, number, game_id):
+        self.front.game_opened(self, game_id)
+    def handle_CLOSED(self, number, game_id):
+        self.front.game_closed(self, game_id)
+    def handle_STATUS(self, number, data):
+        self.open_games = data.split()
+        self.front.check_close()
+    def handle_BROADCAST(self, number, data):
+        self.front.broadcast(data)
+    def handle_SHUTDOWN(self, number, data):
+        self.front.shutdown(data == 'now')
+    def handle_LISTING(self, request, data):
+        self.front.listing(request, data)
+    def handle_LISTED(self, request, data):
+        self.front.listed(self, request)
+
+class Relay(VerboseObject):
+    r'''Stands in for a Service in the front end of a sharded server,
+        passing a client's messages to and from the worker hosting its game.
+    '''#'''
+    next_id = count(1).next
+    
+    def __init__(self, connection, address, front, game_id=None):
+        self.__super.__init__()
+        self.sock      = connection
+        self.client_id = self.next_id()
+        self.address   = address
+        self.front     = front
+        self.rep       = None
+        self.closed    = False
+        self.prefix    = 'Relay #%d' % self.client_id
+        
+        front.relays[self.client_id] = self
+        game_id, self.shard = front.route(game_id)
+        if self.shard: self.connect(game_id)
+        else: self.close(True)
+    def connect(self, game_id):
+        self.shard.send(self.shard.CONNECT, self.client_id,
+            '%s %s' % (self.address, game_id))
+    def handle_message(self, msg):
+        if msg[0] is LST:
+            self.front.list_games(self, msg)
+        else:
+            if msg[0] is SEL and len(msg) > 3:
+                self.select(msg.fold()[1][0])
+            self.shard.send(self.shard.MESSAGE, self.client_id, msg.pack())
+    def select(self, game_id):
+        ''' Moves the client to the worker hosting the selected game.
+            That worker will answer the SEL message itself.
+        '''#'''
+        shard = self.front.games.get(game_id)
+        if shard and shard is not self.shard and not shard.closed:
+            self.shard.send(self.shard.CLOSE, self.client_id)
+            self.shard = shard
+            self.connect(game_id)
+    
+    def send_RM(self, representation):
+        self.rep = representation
+        self.sock.send_RM(representation)
+    def write(self, data):
+        self.sock.write(self.rep.unpack(data))
+    def close(self, notified=False):
+        if not self.closed:
+            self.log.debug("Closing.")
+            self.closed = True
+            if not (notified or self.shard.closed):
+                self.shard.send(self.shard.CLOSE, self.client_id)
+            self.front.disconnect(self)
+            self.sock.close()
+
+class RelayFactory(DaideServerFactory):
+    r'''Accepts connections for the front end of a sharded server.'''
+    def new_service(self, connection, address):
+        return Relay(connection, address, self.server, self.game)
+
+
+# Worker processes
+class ShardWorker(Server):
+    r'''Runs some of the games of a sharded server, in a worker process.
+        The front end owns the clients' connections and the listening
+        ports, and decides when to start default games; this reports
+        its games to the front end, and passes along admin broadcasts
+        and shutdown requests, which concern every worker.
+    '''#'''
+    
+    @classmethod
+    def run_program(cls, args):
+        manager = WorkerManager()
+        server = cls(manager)
+        manager.add_server(server)
+        manager.stdio = StandardIO(server.link, 0, 3, manager.reactor)
+        manager.run()
+    
+    def __init__(self, manager):
+        self.link = WorkerLink(self)
+        self.shared = True
+        self.__super.__init__(manager)
+    def start_default(self):
+        # The front end chooses where to start default games.
+        return True
+    def start_requested(self, game_id, var_name):
+        try: variant = variants[var_name]
+        except KeyError:
+            self.log.error('Unknown variant "%s"', var_name)
+        else: self.new_game(game_id, variant)
+    
+    def check_close(self):
+        for game_id, game in self.games.items():
+            if game.closed and game.saved:
+                # Remove saved games from memory
+                del self.games[game_id]
+        self.report_status()
+    def report_status(self):
+        open_games = [game_id for game_id, game in self.games.iteritems()
+            if not (game.closed or game.finished)]
+        self.link.send(self.link.STATUS, 0, str.join(' ', open_games))
+    def broadcast(self, message, shared=True):
+        if shared and self.shared and message[0] is ADM:
+            # Admin messages go to every worker's clients.
+            self.link.send(self.link.BROADCAST, 0, message.pack())
+        else: self.__super.broadcast(message)
+    
+    # The shutdown command affects the whole server.
+    def set_quitting(self, value):
+        if value: self.link.send(self.link.SHUTDOWN, 0, '')
+    quitting = property(lambda self: False, set_quitting)
+    def close(self):
+        if self.shared and not self.closed:
+            # Let the front end close every worker, including this one.
+            self.link.send(self.link.SHUTDOWN, 0, 'now')
+        else: self.__super.close()
+
+class WorkerLink(VerboseObject, Protocol, ShardLink):
+    r'''A worker's connection to the front end.'''
+    
+    def __init__(self, server):
+        self.__super.__init__()
+        self.server = server
+        self.sockets = {}
+        self.closed = False
+        self.start_link()
+    def dataReceived(self, data):
+        self.frames_received(data)
+    def write_frames(self, frames):
+        if not self.closed: self.transport.writeSequence(frames)
+    def connectionLost(self, reason=connectionDone):
+        self.log.debug("Lost the front end")
+        self.closed = True
+        self.server.shared = False
+        self.server.close()
+        self.server.manager.close()
+    
+    def handle_CONNECT(self, client_id, data):
+        address, game_id = data.split(' ', 1)
+        sock = RelayedSocket(self, client_id)
+        self.sockets[client_id] = sock
+        sock.service = Service(sock, address, self.server, game_id or None)
+    def handle_MESSAGE(self, client_id, data):
+        sock = self.sockets.get(client_id)
+        if sock:
+            service = sock.service
+            service.handle_message(service.game.variant.rep.unpack(data))
+    def handle_CLOSE(self, client_id, data):
+        sock = self.sockets.pop(client_id, None)
+        if sock:
+            sock.closed = True
+            sock.service.close()
+    def handle_START(self, number, data):
+        game_id, var_name = data.split(' ', 1)
+        self.server.start_requested(game_id, var_name)
+    def handle_BROADCAST(self, number, data):
+        self.server.broadcast(protocol.default_rep.unpack(data), False)
+    def handle_SHUTDOWN(self, number, data):
+        self.server.shared = False
+        self.server.close()
+    def handle_LIST(self, request, data):
+        message = protocol.default_rep.unpack(data)
+        if len(message) > 3:
+            games = [self.server.games.get(message.fold()[1][0])]
+        else: games = self.server.games.values()
+        frames = [self.frame(self.LISTING, request, game.listing().pack())
+            for game in games if game]
+        frames.append(self.frame(self.LISTED, request))
+        self.write_frames(frames)
+
+class RelayedSocket(object):
+    r'''Stands in for a client's connection, in a worker process.'''
+    def __init__(self, link, client_id):
+        self.link = link
+        self.client_id = client_id
+        self.service = None
+        self.closed = False
+    def send_RM(self, representation):
+        self.link.send(self.link.REPRESENTATION, self.client_id,
+            pack_representation(representation))
+    def write(self, message):
+        self.link.send(self.link.MESSAGE, self.client_id, message.pack())
+    def write_list(self, messages):
+        self.link.write_frames([self.link.frame(self.link.MESSAGE,
+            self.client_id, message.pack()) for message in messages])
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            del self.link.sockets[self.client_id]
+            self.link.send(self.link.CLOSE, self.client_id)
+
+class GamePort(object):
+    r'''Stands in for a game's listening port, in a worker process.
+        The front end opens the real port, if the game gets one.
+    '''#'''
+    def __init__(self, server, game_id):
+        self.server = server
+        self.game_id = game_id
+        server.link.send(server.link.OPENED, 0, game_id)
+    def close(self):
+        self.server.link.send(self.server.link.CLOSED, 0, self.game_id)
+        self.server.report_status()
+
+class WorkerManager(ThreadManager):
+    r'''Thread manager for a worker process, which opens no ports.'''
+    def add_server(self, server, game=None):
+        if game: return GamePort(server, game)
+        self.running.append(server)
+        self.link = server.link
+        return True
+    def close(self):
+        if self.link.closed:
+            self.__super.close()
+        else:
+            # Finish sending to the front end before stopping;
+            # the link will call back when its pipe has closed.
+            self.closed = True
+            self.link.transport.loseConnection()
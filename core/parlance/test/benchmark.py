@@ -0,0 +1,62 @@
+r'''Test cases for the Parlance adjudication benchmarks
+    Copyright (C) 2009  Eric Wald
+
+    Parlance may be used, modified, and/or redistributed under the terms of
+    the Artistic License 2.0, as published by the Perl Foundation.
+'''#'''
+
+import os
+import unittest
+from tempfile import mkstemp
+
+from parlance.benchmark import Benchmark, Measurement
+
+class BenchmarkTestCase(unittest.TestCase):
+    "Tests for the judge benchmark harness"
+    def setUp(self):
+        self.bench = Benchmark()
+        self.bench.options.repeat = 1
+        self.bench.options.stress_turns = 2
+        self.bench.options.stress_variants = ''
+    def slower(self, seconds):
+        return {'stress.standard': {
+            'movement': Measurement(1, seconds, 10, 20, 0, 100),
+        }}
+
+    def test_stress_measured(self):
+        self.bench.options.stress_variants = 'standard'
+        results = self.bench.run_all(['stress'])
+        self.failUnlessEqual(results.keys(), ['stress.standard'])
+        movement = results['stress.standard']['movement']
+        self.failUnlessEqual(movement.runs, 1)
+        self.failUnless(movement.decisions > 0)
+        self.failUnless(movement.calculations >= movement.decisions)
+    def test_datc_selected(self):
+        results = self.bench.run_all(['DATC_6_C.test_6C1'])
+        self.failUnlessEqual(results.keys(), ['DATC_6_C.test_6C1'])
+        movement = results['DATC_6_C.test_6C1']['movement']
+        self.failUnlessEqual(movement.paradoxes, 1)
+    def test_save_load(self):
+        results = self.slower(0.5)
+        handle, filename = mkstemp()
+        os.close(handle)
+        try:
+            self.bench.save(filename, results)
+            baseline = self.bench.load(filename)
+        finally: os.remove(filename)
+        self.failUnlessEqual(sorted(baseline), [
+            ('stress.standard', 'movement'),
+            ('total', 'movement'),
+        ])
+        self.failUnlessEqual(baseline[('total', 'movement')].values(),
+            [1, 0.5, 10, 20, 0, 100])
+    def test_regression(self):
+        baseline = {('stress.standard', 'movement'): Measurement(1, 1.0)}
+        regressions = self.bench.compare(baseline, self.slower(2.0))
+        self.failUnlessEqual(regressions, [('movement', 1.0, 2.0)])
+    def test_within_threshold(self):
+        baseline = {('stress.standard', 'movement'): Measurement(1, 1.0)}
+        regressions = self.bench.compare(baseline, self.slower(1.1))
+        self.failUnlessEqual(regressions, [])
+
+if __name__ == '__main__': unittest.main()
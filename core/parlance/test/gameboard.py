@@ -11,12 +11,13 @@ r'''Test cases for the Parlance gameboard and unit orders
 import time
 
 from parlance.config     import variants
-from parlance.gameboard  import Map, Province, Turn, Variant
+from parlance.gameboard  import Location, Map, Province, Turn, Unit, Variant
 from parlance.judge      import DatcOptions
 from parlance.language   import Message, Representation, protocol
 from parlance.orders     import OrderSet, createUnitOrder
 from parlance.test       import TestCase, failing, fails, load_variant
 from parlance.tokens     import *
+from parlance.util       import Infinity
 from parlance.validation import Validator
 from parlance.xtended    import *
 
@@ -1274,6 +1275,180 @@ class MapTestCase(TestCase):
         province = board.spaces[variant.rep["TWO"]]
         self.failUnlessEqual(province.name, "Somewhere")
 
+class PositionTestCase(TestCase):
+    r'''Snapshots of the changeable parts of a Map'''
+    def setUp(self):
+        self.board = Map(variants["standard"])
+        self.before = (self.board.create_NOW(), self.board.create_SCO())
+    def failUnlessRestored(self):
+        after = (self.board.create_NOW(), self.board.create_SCO())
+        self.failUnlessEqual(after, self.before)
+    def test_restore_move(self):
+        position = self.board.snapshot()
+        unit = self.board.spaces[MOS].unit
+        unit.move_to(self.board.locs[(AMY, UKR, None)])
+        self.board.restore(position)
+        self.failUnlessRestored()
+        self.failUnless(self.board.spaces[MOS].unit is unit)
+        self.failIf(self.board.spaces[UKR].units)
+    def test_restore_retreat(self):
+        position = self.board.snapshot()
+        self.board.spaces[WAR].unit.retreat([UKR, GAL])
+        self.board.restore(position)
+        self.failUnlessRestored()
+    def test_restore_build(self):
+        position = self.board.snapshot()
+        self.board.spaces[MOS].unit.die()
+        russia = self.board.powers[RUS]
+        fleet = Unit(russia, self.board.locs[(FLT, SEV, None)])
+        fleet.build()
+        self.board.restore(position)
+        self.failUnlessRestored()
+        self.failIf([unit for unit in russia.units if unit is fleet])
+    def test_restore_ownership(self):
+        position = self.board.snapshot()
+        unit = self.board.spaces[LON].unit
+        unit.move_to(self.board.locs[(FLT, BEL, None)])
+        unit.takeover()
+        self.board.advance()
+        self.board.restore(position)
+        self.failUnlessRestored()
+        self.failUnlessEqual(self.board.spaces[BEL].owner, self.board.neutral)
+        self.failUnlessEqual(self.board.current_turn, Turn(SPR, 1901))
+    def test_restore_twice(self):
+        position = self.board.snapshot()
+        self.board.spaces[PAR].unit.move_to(self.board.locs[(AMY, PIC, None)])
+        self.board.restore(position)
+        self.board.spaces[PAR].unit.move_to(self.board.locs[(AMY, BUR, None)])
+        self.board.restore(position)
+        self.failUnlessRestored()
+
+class ConvoyRoutesTestCase(TestCase):
+    "Tests for convoy routes answered from the map's sea index"
+    def setUp(self):
+        self.board = Map(standard)
+        self.board.handle_NOW(NOW(SPR, 1901) % [
+            [ENG, AMY, LON],
+            [ENG, FLT, NTH],
+            [ENG, FLT, ECH],
+        ])
+    def routes(self, source, dest):
+        location = self.board.locs[(AMY, source, None)]
+        return location.convoy_routes(self.board.spaces[dest], self.board)
+    def test_routes_listed(self):
+        routes = self.routes(LON, BEL)
+        self.failUnlessEqual([tuple([prov.key for prov in route])
+                for route in routes],
+            [(ECH,), (NTH,), (ECH, NTH), (NTH, ECH)])
+    def test_routes_exist(self):
+        routes = self.routes(LON, BEL)
+        self.failUnless(routes)
+        self.failUnlessEqual(routes.routes, None)
+    def test_routes_missing(self):
+        routes = self.routes(LON, NAF)
+        self.failIf(routes)
+        self.failUnlessEqual(routes, [])
+    def test_route_contained(self):
+        routes = self.routes(LON, BEL)
+        self.failUnless((NTH, ECH) in routes)
+        self.failIf((NTH, NTH) in routes)
+        self.failIf((ECH, NTH, ECH) in routes)
+        self.failIf((IRI,) in routes)
+        self.failUnlessEqual(routes.routes, None)
+    def test_route_landing(self):
+        routes = self.routes(LON, HOL)
+        self.failUnless((ECH, NTH) in routes)
+        self.failIf((NTH, ECH) in routes)
+    def test_fleets_fixed(self):
+        routes = self.routes(LON, BEL)
+        for unit in list(self.board.spaces[ECH].units): unit.die()
+        self.failUnlessEqual(len(routes), 4)
+        self.failUnlessEqual(len(self.routes(LON, BEL)), 1)
+
+class DistanceTestCase(TestCase):
+    "Tests for the map's table of province distances"
+    def setUp(self):
+        self.board = Map(standard)
+    def test_table_lazy(self):
+        self.failUnlessEqual(self.board.distances, None)
+        self.board.province_distance(LON, MOS)
+        self.failIfEqual(self.board.distances, None)
+    def test_distance_self(self):
+        self.failUnlessEqual(self.board.province_distance(LON, LON), 0)
+    def test_distance_neighbor(self):
+        self.failUnlessEqual(self.board.province_distance(LON, NTH), 1)
+    def test_distance_far(self):
+        self.failUnlessEqual(self.board.province_distance(LON, MOS), 4)
+    def test_distance_nearest(self):
+        location = self.board.locs[(AMY, MOS, None)]
+        self.failUnlessEqual(self.board.distance(location, [LON, SEV]), 1)
+    def test_distance_none(self):
+        location = self.board.locs[(AMY, MOS, None)]
+        self.failUnlessEqual(self.board.distance(location, []), Infinity)
+    def test_distance_island(self):
+        variant = load_variant('''
+            [borders]
+            ONE=AMY TWO
+            TWO=AMY ONE
+            TRE=AMY
+        ''')
+        board = Map(variant)
+        ONE, TRE = variant.rep['ONE'], variant.rep['TRE']
+        self.failUnlessEqual(board.province_distance(ONE, TRE), Infinity)
+
+class TopologyTestCase(TestCase):
+    "Tests for the map's compact adjacency arrays"
+    def setUp(self):
+        self.board = Map(standard)
+        self.topology = self.board.topology
+    def test_province_ids(self):
+        for key, province in self.board.spaces.iteritems():
+            self.failUnlessEqual(self.topology.provinces[province.id], key)
+    def test_location_ids(self):
+        for key, location in self.board.locs.iteritems():
+            self.failUnlessEqual(self.topology.locations[location.id], key)
+            self.failUnlessEqual(location.topology, self.topology)
+    def test_location_province(self):
+        location = self.board.locs[(FLT, STP, NCS)]
+        province = self.topology.location_province[location.id]
+        self.failUnlessEqual(province, self.board.spaces[STP].id)
+    def test_neighbours(self):
+        for location in self.board.locs.itervalues():
+            keys = [self.topology.locations[index]
+                for index in self.topology.neighbours(location.id)]
+            self.failUnlessEqual(keys, location.borders_out)
+    def test_adjacent(self):
+        for province in self.board.spaces.itervalues():
+            keys = set(self.topology.provinces[index]
+                for index in self.topology.adjacent(province.id))
+            self.failUnlessEqual(keys, province.borders_out)
+    def test_flags(self):
+        ids = self.topology.province_ids
+        self.failUnless(self.topology.is_coastal(ids[LON]))
+        self.failIf(self.topology.is_coastal(ids[MOS]))
+        self.failUnless(self.topology.is_sea(ids[NTH]))
+        self.failIf(self.topology.is_sea(ids[LON]))
+        self.failUnless(self.topology.is_supply(ids[MOS]))
+        self.failIf(self.topology.is_supply(ids[UKR]))
+    def test_can_reach(self):
+        ids = self.topology.province_ids
+        fleet = self.board.locs[(FLT, LON, None)].id
+        self.failUnless(self.topology.can_reach(fleet, ids[NTH]))
+        self.failIf(self.topology.can_reach(fleet, ids[LVP]))
+    def test_can_move_to_coast(self):
+        unit = Unit(None, self.board.locs[(FLT, BAR, None)])
+        self.failUnless(unit.can_move_to(self.board.locs[(FLT, STP, NCS)]))
+        self.failIf(unit.can_move_to(self.board.locs[(FLT, STP, SCS)]))
+    def test_can_move_to_province(self):
+        unit = Unit(None, self.board.locs[(AMY, LON, None)])
+        self.failUnless(unit.can_move_to(self.board.spaces[YOR]))
+        self.failIf(unit.can_move_to(self.board.spaces[NTH]))
+    def test_can_move_to_fake(self):
+        # Locations off the map fall back to their border lists
+        province = self.board.spaces[STP]
+        unit = Unit(None, self.board.locs[(FLT, BAR, None)])
+        self.failUnless(unit.can_move_to(Location(None, province, None, [])))
+
 class LocationBugfix(TestCase):
     r'''Tests to reproduce bugs related to the Location class'''
     def test_infinite_convoy(self):
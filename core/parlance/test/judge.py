@@ -14,9 +14,10 @@ from time import time
 from nose.tools import timed
 
 from parlance.config    import variants, Configuration, GameOptions
+from parlance.gameboard import Turn
 from parlance.judge     import Attack_Decision, Hold_Decision, \
-        Move_Decision, Path_Decision, Prevent_Decision
-from parlance.language  import Token
+        Move_Decision, Path_Decision, Prevent_Decision, run_exported
+from parlance.language  import Message, Token
 from parlance.orders    import MoveOrder, OrderSet, createUnitOrder
 from parlance.tokens    import *
 from parlance.xtended   import *
@@ -169,6 +170,11 @@ class Judge_Movement(DiplomacyAdjudicatorTestCase):
         self.legalOrder(FRA, [(FRA, FLT, BRE), MTO, ECH])
         self.legalOrder(FRA, [(FRA, FLT, MAO), SUP, (FRA, FLT, BRE), MTO, ECH])
         self.assertMapState(steady_state)
+    def test_skipped_calculations(self):
+        ''' Decisions are only recalculated when their dependencies change'''
+        self.test_beleagured()
+        self.failUnless(self.judge.calculations > 0)
+        self.failUnless(self.judge.calculations_saved > 0)
     def test_dptg_bug(self):
         ''' Listed in the DAIDE introduction as a required bugfix.
             The DPTG algorithm apparently gets this wrong.
@@ -1537,4 +1543,249 @@ class Judge_Notes(DiplomacyAdjudicatorTestCase):
     def ntest_nmr(self): pass
     def ntest_nrs(self): pass
 
+class Judge_Hypothetical(DiplomacyAdjudicatorTestCase):
+    ''' Adjudication of hypothetical order sets'''
+    def order_set(self, *orders):
+        result = OrderSet()
+        board = self.judge.map
+        for country, order in orders:
+            power = board.powers[country]
+            order = createUnitOrder(Message(order).fold(),
+                    power, board, self.judge.datc)
+            result.add(order, country)
+        return result
+    def assertResults(self, results, expected):
+        self.failUnlessEqual(set([(str(order.strict), result)
+                    for order, result in results]),
+            set([(str(order), result) for order, result in expected]))
+    def test_position_unchanged(self):
+        ''' Hypothetical order sets leave the map unchanged'''
+        self.init_state(SPR, 1901, [
+            [RUS, AMY, MOS],
+            [RUS, AMY, UKR],
+            [GER, AMY, WAR],
+        ])
+        before = self.judge.map.create_NOW()
+        attack = self.order_set(
+            (RUS, [(RUS, AMY, MOS), SUP, (RUS, AMY, UKR), MTO, WAR]),
+            (RUS, [(RUS, AMY, UKR), MTO, WAR]))
+        results = self.judge.adjudicate([attack, OrderSet()])
+        self.failUnlessEqual(len(results), 2)
+        self.failUnlessEqual(self.judge.map.create_NOW(), before)
+        self.failIf(self.judge.next_orders)
+    def test_independent_results(self):
+        ''' Each hypothetical order set is adjudicated separately'''
+        self.init_state(SPR, 1901, [
+            [RUS, AMY, MOS],
+            [RUS, AMY, UKR],
+            [GER, AMY, WAR],
+        ])
+        attack = self.order_set(
+            (RUS, [(RUS, AMY, MOS), SUP, (RUS, AMY, UKR), MTO, WAR]),
+            (RUS, [(RUS, AMY, UKR), MTO, WAR]))
+        bounce = self.order_set(
+            (RUS, [(RUS, AMY, UKR), MTO, WAR]))
+        supported, unsupported, again = self.judge.adjudicate(
+            [attack, bounce, attack])
+        self.assertResults(supported, [
+            (Message([(RUS, AMY, MOS), SUP, (RUS, AMY, UKR), MTO, WAR]), SUC),
+            (Message([(RUS, AMY, UKR), MTO, WAR]), SUC),
+            (Message([(GER, AMY, WAR), HLD]), RET),
+        ])
+        self.assertResults(unsupported, [
+            (Message([(RUS, AMY, MOS), HLD]), SUC),
+            (Message([(RUS, AMY, UKR), MTO, WAR]), BNC),
+            (Message([(GER, AMY, WAR), HLD]), SUC),
+        ])
+        self.assertResults(again, [(order.strict, result)
+                for order, result in supported])
+    def test_matches_run(self):
+        ''' Hypothetical results match those of the real turn'''
+        self.init_state(SPR, 1901, [
+            [ENG, FLT, ECH],
+            [ENG, AMY, LON],
+            [FRA, FLT, BRE],
+        ])
+        orders = [
+            (ENG, [(ENG, AMY, LON), CTO, BRE, VIA, [ECH]]),
+            (ENG, [(ENG, FLT, ECH), CVY, (ENG, AMY, LON), CTO, BRE]),
+            (FRA, [(FRA, FLT, BRE), MTO, MAO]),
+        ]
+        results = self.judge.adjudicate([self.order_set(*orders)])[0]
+        for country, order in orders: self.legalOrder(country, order)
+        turn = self.judge.turn()
+        messages = [msg for msg in self.judge.run() if msg[0] is ORD]
+        self.failUnlessEqual(messages, [ORD(turn)(order.strict)(result)
+                for order, result in results])
+
+class Judge_Sweeps(DiplomacyAdjudicatorTestCase):
+    ''' Skipping calculations must not change the results of a full sweep'''
+    def full_sweep(self, decision_list, dependents):
+        ''' The plain DATC loop, calculating every decision in each pass.'''
+        judge = self.judge
+        judge.calculations = 0
+        while decision_list:
+            remaining = []
+            for choice in decision_list:
+                judge.calculations += 1
+                if not choice.calculate(): remaining.append(choice)
+            if len(remaining) == len(decision_list):
+                decision_list = judge.resolve_paradox(remaining)
+            else: decision_list = remaining
+    def adjudicate(self, full, paradox_rule, state, orders):
+        self.setUp()
+        if full: self.judge.make_decisions = self.full_sweep
+        if paradox_rule: self.judge.datc.datc_4a2 = paradox_rule
+        self.init_state(SPR, 1901, state)
+        for nation, order in orders: self.legalOrder(nation, order)
+        return [str(message) for message in self.judge.run()]
+    def assertSameResults(self, paradox_rule, state, orders):
+        expected = self.adjudicate(True, paradox_rule, state, orders)
+        self.failUnlessEqual(self.adjudicate(False, paradox_rule,
+            state, orders), expected)
+    
+    circle_state = [
+        [TUR, FLT, ANK],
+        [TUR, AMY, CON],
+        [TUR, AMY, SMY],
+        [TUR, AMY, BUL],
+    ]
+    circle_orders = [
+        (TUR, [(TUR, FLT, ANK), MTO, CON]),
+        (TUR, [(TUR, AMY, CON), MTO, SMY]),
+        (TUR, [(TUR, AMY, SMY), MTO, ANK]),
+        (TUR, [(TUR, AMY, BUL), SUP, (TUR, FLT, ANK), MTO, CON]),
+    ]
+    pandin_state = [
+        [ENG, FLT, LON],
+        [ENG, FLT, WAL],
+        [FRA, AMY, BRE],
+        [FRA, FLT, ECH],
+        [GER, FLT, NTH],
+        [GER, FLT, BEL],
+    ]
+    pandin_orders = [
+        (ENG, [(ENG, FLT, LON), SUP, (ENG, FLT, WAL), MTO, ECH]),
+        (ENG, [(ENG, FLT, WAL), MTO, ECH]),
+        (FRA, [(FRA, AMY, BRE), CTO, LON, VIA, [ECH]]),
+        (FRA, [(FRA, FLT, ECH), CVY, (FRA, AMY, BRE), CTO, LON]),
+        (GER, [(GER, FLT, NTH), SUP, (GER, FLT, BEL), MTO, ECH]),
+        (GER, [(GER, FLT, BEL), MTO, ECH]),
+    ]
+    
+    def test_circular_movement(self):
+        ''' 6.C.2 gives the same results as a full sweep'''
+        self.assertSameResults(None, self.circle_state, self.circle_orders)
+    def test_convoy_paradox_1982(self):
+        ''' 6.F.16.b gives the same results as a full sweep'''
+        self.assertSameResults('b', self.pandin_state, self.pandin_orders)
+    def test_convoy_paradox_szykman(self):
+        ''' 6.F.16.d gives the same results as a full sweep'''
+        self.assertSameResults('d', self.pandin_state, self.pandin_orders)
+    def test_calculation_total(self):
+        ''' Calculations made and saved add up to the full sweep's'''
+        self.adjudicate(True, None, self.circle_state, self.circle_orders)
+        self.failUnlessEqual(self.judge.calculations, 55)
+        self.adjudicate(False, None, self.circle_state, self.circle_orders)
+        self.failUnlessEqual(self.judge.calculations, 32)
+        self.failUnlessEqual(self.judge.calculations
+            + self.judge.calculations_saved, 55)
+
+class Judge_Metrics(DiplomacyAdjudicatorTestCase):
+    "Measurements of the judge's work"
+    def setUp(self):
+        DiplomacyAdjudicatorTestCase.setUp(self)
+        self.init_state(SPR, 1901, [
+            [TUR, FLT, ANK],
+            [TUR, AMY, CON],
+            [TUR, AMY, SMY],
+        ])
+    def circle(self):
+        self.legalOrder(TUR, [(TUR, FLT, ANK), MTO, CON])
+        self.legalOrder(TUR, [(TUR, AMY, CON), MTO, SMY])
+        self.legalOrder(TUR, [(TUR, AMY, SMY), MTO, ANK])
+        self.judge.run()
+    def test_no_metrics(self):
+        self.failUnlessEqual(self.judge.metrics, None)
+    def test_metrics_turn(self):
+        self.circle()
+        self.failUnlessEqual(self.judge.metrics.variant, 'standard')
+        self.failUnlessEqual(self.judge.metrics.turn, Turn(SPR, 1901).key)
+        self.failUnlessEqual(self.judge.metrics.phase, Turn.move_phase)
+    def test_metrics_decisions(self):
+        self.circle()
+        decisions = self.judge.metrics.decisions
+        self.failUnlessEqual(decisions['Move'], 3)
+        self.failUnlessEqual(decisions['Dislodge'], 3)
+        self.failUnlessEqual(decisions['Hold'], 3)
+        self.failIf('Support' in decisions)
+    def test_metrics_paradox(self):
+        ''' Circular movement is resolved as a paradox'''
+        self.circle()
+        self.failUnlessEqual(self.judge.metrics.paradoxes, 1)
+    def test_metrics_sweeps(self):
+        self.circle()
+        metrics = self.judge.metrics
+        self.failUnless(metrics.sweeps > 1)
+        self.failUnlessEqual(metrics.calculations, self.judge.calculations)
+    def test_metrics_steps(self):
+        self.circle()
+        metrics = self.judge.metrics
+        self.failUnlessEqual(sorted(metrics.steps), ['decisions',
+            'dependencies', 'orders', 'paths', 'results'])
+        self.failUnless(metrics.seconds >= sum(metrics.steps.values()))
+    def test_metrics_build(self):
+        self.init_state(WIN, 1901, [
+            [TUR, FLT, ANK],
+            [TUR, AMY, CON],
+        ])
+        self.judge.run()
+        self.failUnlessEqual(self.judge.metrics.phase, Turn.build_phase)
+        self.failUnlessEqual(self.judge.metrics.steps, {})
+    def test_metrics_hypothetical(self):
+        self.circle()
+        metrics = self.judge.metrics
+        self.judge.adjudicate([OrderSet()])
+        self.failUnless(self.judge.metrics is metrics)
+
+class Judge_Exported(DiplomacyAdjudicatorTestCase):
+    ''' Adjudication of exported turns, as in a worker process'''
+    def setUp(self):
+        DiplomacyAdjudicatorTestCase.setUp(self)
+        self.init_state(SPR, 1901, [
+            [ENG, FLT, ECH],
+            [ENG, AMY, LON],
+            [FRA, FLT, BRE],
+            [ENG, AMY, PIC],
+        ])
+        self.legalOrder(ENG, [(ENG, AMY, LON), CTO, BRE, VIA, [ECH]])
+        self.legalOrder(ENG, [(ENG, FLT, ECH), CVY, (ENG, AMY, LON), CTO, BRE])
+        self.legalOrder(ENG, [(ENG, AMY, PIC), SUP, (ENG, AMY, LON), MTO, BRE])
+    def test_exported_results(self):
+        ''' Exported turns produce the same messages as run()'''
+        outcome = run_exported(self.judge.export())
+        results, state, metrics = outcome
+        self.failUnlessEqual(results,
+            [str(message) for message in self.judge.run()])
+        self.failUnlessEqual(state, self.judge.export_state())
+    def test_load_results(self):
+        ''' Results of an exported turn update the judge'''
+        outcome = run_exported(self.judge.export())
+        results = self.judge.load_results(outcome)
+        self.failUnlessEqual(self.judge.phase, Turn.retreat_phase)
+        self.failUnlessEqual(results[-1], self.judge.map.create_NOW())
+        self.failUnlessEqual(self.judge.unready, set([FRA]))
+        self.failUnless(self.judge.map.powers[FRA].units[0].dislodged)
+    def test_load_metrics(self):
+        ''' Metrics from an exported turn replace the judge's own'''
+        outcome = run_exported(self.judge.export())
+        self.judge.load_results(outcome)
+        self.failUnlessEqual(self.judge.metrics.decisions['Move'], 1)
+        self.failUnlessEqual(self.judge.metrics.routes, 1)
+    def test_export_draw(self):
+        ''' Agreed draws are not exported'''
+        powers = frozenset(self.judge.map.current_powers())
+        self.judge.draws[powers] = set(powers)
+        self.failUnlessEqual(self.judge.export(), None)
+
 if __name__ == '__main__': unittest.main()
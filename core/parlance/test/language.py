@@ -10,7 +10,7 @@ r'''Test cases for the Parlance server
 
 import unittest
 
-from parlance.language   import Message, StringToken, protocol
+from parlance.language   import IntegerToken, Message, StringToken, protocol
 from parlance.test       import fails
 from parlance.tokens     import *
 from parlance.validation import Validator
@@ -81,6 +81,58 @@ class ValidatorTestCase(unittest.TestCase):
         message = SND (FRA) (HUH (YES (press)))
         reply = self.validator.validate_client_message(message)
         self.failUnlessEqual(reply, False)
+    def test_syntax_compiled(self):
+        self.failUnlessEqual(sorted(Validator.compiled), sorted(Validator.syntax))
+    def test_expression_memoized(self):
+        # Each expression is matched against each window only once.
+        press = PRP (ORR (NOT (DRW)) (AND (PCE (ENG, FRA)) (DRW)))
+        message = SND (FRA) (press)
+        parser = self.validator.parser(message)
+        calls = []
+        match_rules = parser.match_rules
+        def counted(sub, start, stop):
+            calls.append((sub, start, stop))
+            return match_rules(sub, start, stop)
+        parser.match_rules = counted
+        self.failUnlessEqual(parser.expression('client_message',
+            0, len(message)), (len(message), True))
+        self.failUnless(calls)
+        self.failUnlessEqual(len(calls), len(set(calls)))
+    def test_unmatched_bra(self):
+        message = Message([NOT, KET, BRA])
+        reply = self.validator.validate_client_message(message)
+        self.failUnlessEqual(reply, PRN (message))
+    def test_unknown_expression(self):
+        self.failUnlessRaises(ValueError,
+            self.validator.validate_expression, [YES], 'no_such_rule')
+    def test_orders_match_first(self):
+        message = SUB ((ENG, AMY, LON), HLD) ((ENG, FLT, EDI), MTO, ECH)
+        parser = self.validator.parser(message, True)
+        self.failUnless(self.validator.match_first(parser, 'client_message'))
+        reply = self.validator.validate_client_message(message)
+        self.failUnlessEqual(reply, False)
+    def test_orders_fallback(self):
+        # The full check still places the ERR token.
+        message = SUB ((ENG, AMY, LON), MTO) ((ENG, FLT, EDI), HLD)
+        parser = self.validator.parser(message, True)
+        self.failIf(self.validator.match_first(parser, 'client_message'))
+        reply = self.validator.validate_client_message(message)
+        self.failUnlessEqual(reply,
+            HUH (SUB ((ENG, AMY, LON), MTO, ERR) ((ENG, FLT, EDI), HLD)))
+    def test_rules_by_token(self):
+        starts, follows, others = Validator.rules_by_token('order', 8000)
+        for rule in follows[HLD]:
+            self.failUnless(rule[3:4] == [('token', HLD, False)]
+                or rule in follows[None])
+        self.failUnless(len(follows[HLD]) < len(Validator.compiled['order']))
+    def test_single_token_inlined(self):
+        check = Validator.token_check('province')
+        self.failUnless(check(LON))
+        self.failIf(check(AMY))
+        self.failUnlessEqual(Validator.token_check('unit'), None)
+        steps = Validator.compiled['army'][0][1]
+        self.failUnlessEqual([step[0] for step in steps],
+            ['cat', 'token', 'cat'])
 
 class LanguageTestCase(unittest.TestCase):
     greek = u"Καλημέρα κόσμε"
@@ -99,6 +151,18 @@ class LanguageTestCase(unittest.TestCase):
     def test_translate_bignum(self):
         msg = protocol.default_rep.translate("TME (123456)")
         self.failUnlessEqual(msg, TME (123456))
+    def test_translate_spacing(self):
+        msg = protocol.default_rep.translate("not(gof)\t(\r\nDrw)(-3)")
+        self.failUnlessEqual(msg, NOT (GOF) (DRW) (-3))
+    def test_translate_unknown(self):
+        self.failUnlessRaises(KeyError,
+            protocol.default_rep.translate, "NOT (XYZ)")
+    def test_representation_words(self):
+        # Names from the base representation are included
+        words = protocol.default_rep.words
+        self.failUnlessEqual(words['ENG'], ENG)
+        self.failUnlessEqual(words['YES'], YES)
+        self.failUnlessEqual(words['('], BRA)
     def test_bignum_str(self):
         msg = TME (123456)
         self.failUnlessEqual(str(msg), "TME ( 123456 )")
@@ -106,6 +170,99 @@ class LanguageTestCase(unittest.TestCase):
         msg = TME (123456)
         msg.pop(2)
         self.failUnlessEqual(str(msg), "TME ( 0x4C40 )")
+    def test_fold_deep_nesting(self):
+        msg = Message(*([BRA] * 5000 + [YES] + [KET] * 5000))
+        folded = msg.fold()
+        for level in range(5000): folded, = folded
+        self.failUnlessEqual(folded, [YES])
+    def test_fold_new_list(self):
+        msg = NOT (GOF)
+        self.failIf(msg.fold() is msg.fold())
+    def test_folded_shared(self):
+        msg = NOT (GOF)
+        self.failUnless(msg.folded() is msg.folded())
+        self.failUnlessEqual(msg.folded(), msg.fold())
+    def test_folded_extend(self):
+        msg = NOT (GOF)
+        msg.folded()
+        msg.extend([DRW])
+        self.failUnlessEqual(msg.folded(), [NOT, [GOF], DRW])
+    def test_folded_pop(self):
+        msg = NOT (GOF) ++ DRW
+        msg.folded()
+        msg.pop()
+        self.failUnlessEqual(msg.folded(), [NOT, [GOF]])
+    def test_folded_delete(self):
+        msg = NOT (GOF)
+        msg.folded()
+        del msg[1:]
+        self.failUnlessEqual(msg.folded(), [NOT])
+    def test_call_copies(self):
+        msg = NOT (GOF)
+        result = msg (DRW)
+        self.failUnlessEqual(msg, [NOT, BRA, GOF, KET])
+        self.failUnlessEqual(result, [NOT, BRA, GOF, KET, BRA, DRW, KET])
+    def test_mod_copies(self):
+        msg = +NOW
+        result = msg % [[ENG, AMY, LON], [FRA, FLT, BRE]]
+        self.failUnlessEqual(msg, [NOW])
+        self.failUnlessEqual(str(result),
+            "NOW ( ENG AMY LON ) ( FRA FLT BRE )")
+    def test_mod_empty(self):
+        msg = +NOW
+        result = msg % []
+        self.failUnlessEqual(result, msg)
+        self.failIf(result is msg)
+    def test_mod_nested(self):
+        msg = SUB % [[[ENG, AMY, LON], MTO, [WAL, ECH]]]
+        self.failUnlessEqual(str(msg), "SUB ( ( ENG AMY LON ) MTO ( WAL ECH ) )")
+    def test_tokenize_nested(self):
+        class Order(object):
+            def tokenize(self): return [[ENG, AMY, LON], HLD]
+        msg = SUB (Order())
+        self.failUnlessEqual(str(msg), "SUB ( ( ENG AMY LON ) HLD )")
+    def test_untokenizable(self):
+        self.failUnlessRaises(TypeError, Message, [NOT, object()])
+    def test_folded_unbalanced(self):
+        msg = NOT (GOF)
+        del msg[-1]
+        self.failUnlessRaises(ValueError, msg.folded)
+    def test_pack_saved(self):
+        msg = NOT (GOF)
+        self.failUnless(msg.pack() is msg.pack())
+    def test_pack_changed(self):
+        msg = NOT (GOF)
+        msg.pack()
+        msg[2] = DRW
+        self.failUnlessEqual(msg.pack(), "\x48\x0d\x40\x00\x48\x01\x40\x01")
+    def test_unpack_keeps_data(self):
+        data = NOT (GOF).pack()
+        msg = protocol.base_rep.unpack(data)
+        self.failUnlessEqual(msg, NOT (GOF))
+        self.failUnless(msg.pack() is data)
+    def test_unpack_changed(self):
+        msg = protocol.base_rep.unpack(NOT (GOF).pack())
+        msg.pop(0)
+        self.failUnlessEqual(msg.pack(), "\x40\x00\x48\x03\x40\x01")
+    def test_unpack_odd_length(self):
+        self.failUnlessRaises(ValueError, protocol.base_rep.unpack, "\x48\x0d\x40")
+    def test_unpack_table(self):
+        # Tokens from the base representation and the numeric ranges
+        data = "\x48\x0d\x41\x01\x00\x05\x3f\xff\x4b\x41"
+        msg = protocol.default_rep.unpack(data)
+        self.failUnlessEqual(list(msg), [NOT, ENG, IntegerToken(5),
+            IntegerToken(-1), StringToken('A')])
+        table = protocol.default_rep.table
+        self.failUnless(table[0x480d] is NOT)
+        self.failUnless(table[0x3fff] is IntegerToken(-1))
+        self.failUnless(table[0x4b41] is StringToken('A'))
+    def test_unpack_buffer(self):
+        # Buffers into network input get unpacked, but not kept.
+        data = "\x00\x00\x48\x0d\x41\x01"
+        msg = protocol.default_rep.unpack(buffer(data, 2))
+        self.failUnlessEqual(list(msg), [NOT, ENG])
+        self.failUnless(type(msg.pack()) is str)
+        self.failUnlessEqual(msg.pack(), "\x48\x0d\x41\x01")
 
 class NumberTestCase(unittest.TestCase):
     def check_number_code(self, number, code):
@@ -19,13 +19,15 @@ from time            import time, sleep
 from mock import Mock, patch
 from twisted.internet.protocol import ClientFactory, ServerFactory
 from twisted.protocols.basic import LineOnlyReceiver
+from twisted.protocols.loopback import LoopbackRelay
+from twisted.test.proto_helpers import StringTransport
 
 from parlance.config    import VerboseObject
 from parlance.fallbacks import any
 from parlance.gameboard import Variant
 from parlance.language  import Representation, Token, protocol
 from parlance.reactor   import ThreadManager
-from parlance.network   import DaideClientProtocol, DaideFactory, DaideProtocol
+from parlance.network   import DaideClientProtocol, DaideFactory, DaideProtocol, DaideServerFactory, DppProtocol
 from parlance.player    import Clock, HoldBot, Player
 from parlance.server    import Server
 from parlance.tokens    import ADM, BRA, CCD, DRW, HLO, IAM, KET, NME, REJ, YES
@@ -459,6 +461,203 @@ class DppTestCase(NetworkTestCase):
         self.manager.process(1)
         self.assertEqual(client.lines, ["HUH (REJ ERR)"])
 
+class BroadcastFraming(unittest.TestCase):
+    def connect(self, klass=DaideProtocol):
+        client = klass()
+        client.transport = Mock()
+        client.connectionMade()
+        return client
+    
+    def test_daide_frame(self):
+        client = self.connect()
+        message = HLO (NME)
+        client.write(message)
+        client.transport.write.assert_called_with(
+            pack('!BxH', client.DM, 8) + message.pack())
+    def test_daide_frame_once(self):
+        message = HLO (NME)
+        clients = [self.connect() for i in range(3)]
+        for client in clients: client.write(message)
+        sent = [client.transport.write.call_args[0][0] for client in clients]
+        self.failUnless(sent[0] is sent[1] is sent[2])
+    def test_daide_frame_changed(self):
+        client = self.connect()
+        message = HLO (NME)
+        client.write(message)
+        message.append(YES)
+        client.write(message)
+        client.transport.write.assert_called_with(
+            pack('!BxH', client.DM, 10) + message.pack())
+    def test_dpp_text_once(self):
+        message = HLO (NME)
+        clients = [self.connect(DppProtocol) for i in range(2)]
+        for client in clients: client.write(message)
+        sent = [client.transport.writeSequence.call_args[0][0][0]
+            for client in clients]
+        self.failUnlessEqual(sent[0], str(message))
+        self.failUnless(sent[0] is sent[1])
+
+class OutputBuffering(unittest.TestCase):
+    def connect(self, klass=DaideProtocol, transport=None):
+        client = klass()
+        client.transport = transport or Mock()
+        client.connectionMade()
+        return client
+    def overflow(self, transport):
+        client = self.connect(transport=transport)
+        client.options.output_backlog = 20
+        client.pauseProducing()
+        client.write(HLO (NME))
+        client.write(HLO (NME))
+        self.failUnless(client.closed)
+        return client
+    
+    def test_producer_registered(self):
+        client = self.connect()
+        client.transport.registerProducer.assert_called_with(client, True)
+    def test_daide_list(self):
+        client = self.connect()
+        messages = [HLO (NME), +YES]
+        client.write_list(messages)
+        client.transport.writeSequence.assert_called_with(
+            [pack('!BxH', client.DM, len(msg.pack())) + msg.pack()
+                for msg in messages])
+        self.failIf(client.transport.write.called)
+    def test_dpp_list(self):
+        client = self.connect(DppProtocol)
+        messages = [HLO (NME), +YES]
+        client.write_list(messages)
+        client.transport.writeSequence.assert_called_with(
+            [str(messages[0]), '\n', str(messages[1]), '\n'])
+    def test_paused(self):
+        client = self.connect()
+        client.pauseProducing()
+        client.write(HLO (NME))
+        client.write_list([+YES, +YES])
+        self.failIf(client.transport.write.called)
+        self.failIf(client.transport.writeSequence.called)
+        client.resumeProducing()
+        self.failUnlessEqual(client.transport.writeSequence.call_count, 1)
+        self.failUnlessEqual(
+            len(client.transport.writeSequence.call_args[0][0]), 3)
+        client.write(+YES)
+        self.failUnlessEqual(client.transport.write.call_count, 1)
+    def test_overflow(self):
+        client = self.connect()
+        client.options.output_backlog = 20
+        client.pauseProducing()
+        client.write(HLO (NME))
+        self.failIf(client.transport.abortConnection.called)
+        client.write(HLO (NME))
+        client.transport.abortConnection.assert_called_with()
+        self.failUnlessEqual(client.backlog, [])
+        self.failUnless(client.closed)
+    def test_overflow_aborted(self):
+        transport = StringTransport()
+        self.overflow(transport)
+        self.failUnless(transport.disconnecting)
+        self.failUnless(transport.disconnected)
+    def test_overflow_without_abort(self):
+        # Transports from Twisted before 11.1 lack abortConnection().
+        transport = LoopbackRelay(Mock())
+        self.overflow(transport)
+        self.failUnlessEqual(transport.shouldLose, 1)
+
+class ListeningPorts(unittest.TestCase):
+    def test_listen_backlog(self):
+        reactor = Mock()
+        factory = DaideServerFactory(Mock())
+        factory.options.listen_backlog = 500
+        self.failUnlessEqual(factory.openMainPort(reactor, 16713), 16713)
+        reactor.listenTCP.assert_called_with(16713, factory, 500)
+
+class SharedTimer(unittest.TestCase):
+    def setUp(self):
+        self.manager = ThreadManager(Mock())
+        self.manager.options.timer_tick = 0.5
+        self.calls = []
+    def call_later(self, delay, name):
+        return self.manager.call_later(delay, self.calls.append, name)
+    
+    @patch("parlance.reactor.time")
+    def test_single_wakeup(self, time):
+        time.return_value = 100.0
+        self.call_later(3.2, "second")
+        self.call_later(3.1, "first")
+        self.call_later(7, "later")
+        reactor = self.manager.reactor
+        self.failUnlessEqual(reactor.callLater.call_count, 1)
+        self.failUnlessAlmostEqual(reactor.callLater.call_args[0][0], 3.5)
+        time.return_value = 103.5
+        self.manager.run_timers()
+        self.failUnlessEqual(self.calls, ["first", "second"])
+        self.failUnlessEqual(reactor.callLater.call_count, 2)
+    @patch("parlance.reactor.time")
+    def test_earlier_call(self, time):
+        time.return_value = 100.0
+        self.call_later(10, "later")
+        self.call_later(2, "sooner")
+        self.manager.wakeup.reset.assert_called_with(2.0)
+    @patch("parlance.reactor.time")
+    def test_cancel(self, time):
+        time.return_value = 100.0
+        call = self.call_later(1, "cancelled")
+        self.call_later(2, "kept")
+        call.cancel()
+        self.failIf(call.active())
+        time.return_value = 105.0
+        self.manager.run_timers()
+        self.failUnlessEqual(self.calls, ["kept"])
+        self.failUnlessEqual(self.manager.timers, [])
+    @patch("parlance.reactor.time")
+    def test_reset(self, time):
+        time.return_value = 100.0
+        call = self.call_later(1, "reset")
+        self.call_later(2, "other")
+        call.reset(5)
+        time.return_value = 103.0
+        self.manager.run_timers()
+        self.failUnlessEqual(self.calls, ["other"])
+        self.failUnless(call.active())
+        time.return_value = 106.0
+        self.manager.run_timers()
+        self.failUnlessEqual(self.calls, ["other", "reset"])
+
+class InputFraming(unittest.TestCase):
+    class Receiver(DaideProtocol):
+        def connectionMade(self):
+            DaideProtocol.connectionMade(self)
+            self.first = None
+            self.rep = self.proto.default_rep
+            self.messages = []
+        def handle_message(self, msg):
+            self.messages.append(msg)
+    
+    def setUp(self):
+        transport = Mock()
+        transport.disconnecting = False
+        self.client = self.Receiver()
+        self.client.makeConnection(transport)
+        self.messages = [HLO (NME), +YES, REJ (IAM)]
+        self.data = str.join('', [pack('!BxH', self.client.DM,
+            len(msg.pack())) + msg.pack() for msg in self.messages])
+    
+    def test_pipelined(self):
+        self.client.dataReceived(self.data)
+        self.failUnlessEqual(self.client.messages, self.messages)
+        self.failUnlessEqual(self.client.received_size, 0)
+    def test_split(self):
+        cut = len(self.data) - 3
+        self.client.dataReceived(self.data[:cut])
+        self.failUnlessEqual(self.client.messages, self.messages[:2])
+        self.failUnlessEqual(self.client.received_size, 5)
+        self.client.dataReceived(self.data[cut:])
+        self.failUnlessEqual(self.client.messages, self.messages)
+    def test_bytewise(self):
+        for char in self.data:
+            self.client.dataReceived(char)
+        self.failUnlessEqual(self.client.messages, self.messages)
+
 class Network_Full_Games(NetworkTestCase):
     def test_full_connection(self):
         # Seven fake players
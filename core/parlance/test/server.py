@@ -9,6 +9,7 @@ r'''Test cases for the Parlance server
 '''#'''
 
 import unittest
+from StringIO import StringIO
 from itertools import count
 from time import sleep, time
 
@@ -20,10 +21,11 @@ from parlance.language   import Time
 from parlance.reactor    import ThreadManager
 from parlance.network    import Service
 from parlance.player     import HoldBot
-from parlance.server     import Server
+from parlance.server     import Historian, Server
 from parlance.tokens     import *
 from parlance.test       import fails, load_variant
 from parlance.util       import num2name
+from parlance.watcher    import Watcher
 from parlance.xtended    import *
 
 test_variants = {
@@ -60,6 +62,8 @@ class Storage(object):
             self.lines = lines
         def __iter__(self):
             return iter(self.lines)
+        def read(self):
+            return str.join('', self.lines)
         def close(self):
             self.lines = None
     
@@ -133,6 +137,10 @@ class FakeSocket(VerboseObject):
         self.player.handle_message(message)
         if self.player.closed and not self.closed:
             self.close()
+    def write_list(self, messages):
+        for message in messages:
+            if self.closed: break
+            self.write(message)
     def send(self, message):
         r'''Takes a message from the player to the server.'''
         self.log.debug("%3s >> %s", self.service.power_name(), message)
@@ -532,6 +540,58 @@ class Server_Basics(ServerTestCase):
             self.game.summarize()
         ]
         self.assertEqual([str(msg) + '\n' for msg in expected], result)
+    def check_packed(self, compress):
+        self.set_option('send_ORD', True)
+        self.connect_server()
+        self.start_game()
+        self.game.run_judge()
+        self.game.close()
+        stream = StringIO()
+        self.game.save_packed(stream, compress)
+        
+        historian = Historian(self.server, self.game.game_id)
+        self.failUnless(historian.load_packed(StringIO(stream.getvalue())))
+        for token in (LST, MAP, VAR, MDF, HLO, SCO, NOW, SMR):
+            self.assertEqual(historian.messages[token],
+                self.game.messages[token])
+        self.assertEqual(sorted(historian.history), sorted(self.game.history))
+        for turn in self.game.history:
+            self.assertEqual(historian.get_history(turn, True),
+                self.game.get_history(turn, True))
+        text = StringIO()
+        self.game.save(text)
+        loaded = Historian(self.server, self.game.game_id)
+        loaded.load(StringIO(text.getvalue()))
+        self.assertEqual(historian.judge.turn(), loaded.judge.turn())
+    def test_save_packed(self):
+        self.check_packed(False)
+    def test_save_compressed(self):
+        self.check_packed(True)
+    def test_load_packed_invalid(self):
+        historian = Historian(None, 'game')
+        self.failUnlessRaises(ValueError, historian.load_packed,
+            StringIO('LST ( "game" )\n'))
+    @patch("__builtin__.open", Storage())
+    def test_historian_packed(self):
+        self.set_option('MTL', 5)
+        self.set_option('send_ORD', True)
+        self.connect_server()
+        self.server.options.log_games = True
+        self.server.options.log_format = 'compressed'
+        game = self.start_game()
+        game.run_judge()
+        game.close()
+        self.server.check_close()
+        self.failIf(self.server.games.has_key(game.game_id))
+        
+        player = self.connect_player(self.Fake_Player,
+                game_id=game.game_id, observe=True)
+        self.assertContains(YES (SEL (game.game_id)), player.queue)
+        player.queue = []
+        player.send(HST(SPR, 1901))
+        power = self.game.judge.map.powers.values()[0]
+        self.assertContains(ORD (SPR, 1901) ([power.units[0]], HLD) (SUC),
+                player.queue)
     @patch("__builtin__.open", Storage())
     def test_archive_game(self):
         self.connect_server()
@@ -580,6 +640,23 @@ class Server_Basics(ServerTestCase):
         sleep(12)
         game.run()
         self.failUnlessEqual(times, [limit, limit - 5, limit - 10])
+    def test_clock_request_during_turn(self):
+        self.connect_server()
+        player = self.connect_player(self.Fake_Player)
+        game = self.start_game()
+        request = TME(Time(game.limits[game.judge.phase] - 1))
+        player.send(request)
+        sleep(1.5)
+        player.queue = []
+        game.run()
+        game.run()
+        self.failUnlessEqual(player.queue, [request])
+    def test_deadline_shared_timer(self):
+        self.connect_server()
+        game = self.start_game()
+        deadlines = [entry[0] for entry in self.manager.timers if entry[2]]
+        self.failUnlessEqual(len(deadlines), 1)
+        self.failUnless(deadlines[0] <= game.deadline + 0.01)
     @patch("parlance.server.variants", test_variants)
     def test_variant_map_name(self):
         ''' Variants should use the name of the map in MAP messages.
@@ -598,6 +675,77 @@ class Server_Basics(ServerTestCase):
         player.send(+VAR)
         self.assertContains(VAR ("testing"), player.queue)
 
+class Server_Workers(ServerTestCase):
+    ''' Adjudication in worker processes'''
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.connect_server()
+        self.pending = []
+        def new_process(callback, target, *args):
+            self.pending.append((callback, target, args))
+        self.manager.parallel = lambda: True
+        self.manager.new_process = new_process
+    def finish_process(self, success=True):
+        callback, target, args = self.pending.pop(0)
+        if success: callback(True, target(*args))
+        else: callback(False, 'Traceback: Nothing really happened')
+    
+    def test_worker_results(self):
+        ''' Results from a worker are broadcast, starting the next turn.'''
+        player = self.connect_player(self.Fake_Player)
+        game = self.start_game()
+        turn = game.judge.turn()
+        game.run_judge()
+        self.failUnlessEqual(len(self.pending), 1)
+        self.failUnlessEqual(game.judge.turn(), turn)
+        player.queue = []
+        self.finish_process()
+        self.failIfEqual(game.judge.turn(), turn)
+        self.assertContains(game.judge.map.create_NOW(), player.queue)
+    def test_worker_blocks_orders(self):
+        ''' Orders are rejected while a worker has the turn.'''
+        player = self.connect_player(self.Fake_Player)
+        game = self.start_game()
+        player.send(+MIS)
+        units = [msg.fold()[1:] for msg in player.queue if msg[0] is MIS][-1]
+        message = SUB % [[unit, HLD] for unit in units]
+        game.run_judge()
+        player.queue = []
+        player.send(message)
+        self.assertContains(REJ (message), player.queue)
+        player.send(+DRW)
+        self.assertContains(REJ (+DRW), player.queue)
+        self.failIf(game.ready())
+    def test_worker_run_once(self):
+        ''' The turn is only sent to one worker at a time.'''
+        self.connect_player(self.Fake_Player)
+        game = self.start_game()
+        game.run_judge()
+        game.run_judge()
+        self.failUnlessEqual(len(self.pending), 1)
+    def test_worker_failure(self):
+        ''' The turn is run in the server if the worker fails.'''
+        player = self.connect_player(self.Fake_Player)
+        game = self.start_game()
+        turn = game.judge.turn()
+        game.run_judge()
+        self.finish_process(False)
+        self.failIfEqual(game.judge.turn(), turn)
+        self.failIf(game.judging)
+    def test_worker_metrics(self):
+        ''' Metrics from a worker reach the watchers.'''
+        self.connect_player(self.Fake_Player)
+        game = self.start_game()
+        watcher = Mock(spec=Watcher)
+        self.server.watchers = [watcher]
+        game.run_judge()
+        self.failIf(watcher.handle_judge_metrics.called)
+        self.finish_process()
+        metrics, game_id = watcher.handle_judge_metrics.call_args[0]
+        self.failUnlessEqual(game_id, game.game_id)
+        self.failUnlessEqual(metrics.variant, 'standard')
+        self.failUnless(metrics.latency >= metrics.seconds)
+
 class Server_Press(ServerTestCase):
     ''' Press-handling tests'''
     def setUp(self):
@@ -0,0 +1,167 @@
+r'''Test cases for the Parlance sharded server
+    Copyright (C) 2009  Eric Wald
+    
+    Parlance may be used, modified, and/or redistributed under the terms of
+    the Artistic License 2.0, as published by the Perl Foundation.
+'''#'''
+
+import unittest
+from struct import calcsize, unpack
+
+from mock import Mock
+
+from parlance.shard    import Relay, ShardedServer, ShardLink, \
+        ShardWorker, WorkerManager
+from parlance.tokens   import ADM, LST, SEL, YES
+
+from parlance.test.server import ServerTestCase
+
+def parse_frames(data):
+    size = calcsize(ShardLink.header)
+    frames = []
+    while data:
+        kind, number, length = unpack(ShardLink.header, data[:size])
+        frames.append((ShardLink.frame_types[kind], number,
+            data[size:size + length]))
+        data = data[size + length:]
+    return frames
+
+class ShardLinkTestCase(unittest.TestCase):
+    class Recorder(ShardLink):
+        def __init__(self):
+            self.frames = []
+            self.start_link()
+        def handle_MESSAGE(self, number, data):
+            self.frames.append((number, data))
+    
+    def test_frames_split(self):
+        link = self.Recorder()
+        data = link.frame(link.MESSAGE, 3, 'abc') + link.frame(link.MESSAGE, 4)
+        for char in data: link.frames_received(char)
+        self.failUnlessEqual(link.frames, [(3, 'abc'), (4, '')])
+        self.failUnlessEqual(link.received_size, 0)
+
+class ShardWorkerTestCase(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.manager = WorkerManager(Mock())
+        self.server = ShardWorker(self.manager)
+        self.manager.add_server(self.server)
+        self.link = self.server.link
+        self.link.transport = Mock()
+    def sent(self):
+        frames = []
+        for args, kwargs in self.link.transport.writeSequence.call_args_list:
+            frames.extend(parse_frames(str.join('', args[0])))
+        self.link.transport.writeSequence.reset_mock()
+        return frames
+    def start(self):
+        self.link.handle_START(0, 'GAME standard')
+        self.link.handle_CONNECT(5, '10.2.3.4 GAME')
+        self.sent()
+    
+    def test_no_default_game(self):
+        self.failUnlessEqual(self.server.games, {})
+    def test_start(self):
+        self.link.handle_START(0, 'GAME standard')
+        self.failUnlessEqual(self.server.games.keys(), ['GAME'])
+        self.failUnlessEqual(self.sent(), [('OPENED', 0, 'GAME')])
+    def test_connect(self):
+        self.link.handle_START(0, 'GAME standard')
+        self.sent()
+        self.link.handle_CONNECT(5, '10.2.3.4 GAME')
+        self.failUnlessEqual([frame[:2] for frame in self.sent()],
+            [('REPRESENTATION', 5)])
+        self.link.handle_MESSAGE(5, (+SEL).pack())
+        self.failUnlessEqual(self.sent(),
+            [('MESSAGE', 5, SEL('GAME').pack())])
+    def test_admin_shared(self):
+        self.start()
+        message = ADM('Server')('Hello')
+        self.server.broadcast(message)
+        self.failUnlessEqual(self.sent(),
+            [('BROADCAST', 0, message.pack())])
+        self.link.handle_BROADCAST(0, message.pack())
+        self.failUnlessEqual(self.sent(), [('MESSAGE', 5, message.pack())])
+    def test_list(self):
+        self.start()
+        self.link.handle_LIST(3, (+LST).pack())
+        listing = self.server.games['GAME'].listing()
+        self.failUnlessEqual(self.sent(),
+            [('LISTING', 3, listing.pack()), ('LISTED', 3, '')])
+    def test_close_requested(self):
+        self.server.close()
+        self.failUnlessEqual(self.sent(), [('SHUTDOWN', 0, 'now')])
+        self.failIf(self.server.closed)
+    def test_client_closed(self):
+        self.start()
+        self.link.handle_CLOSE(5, '')
+        self.failUnlessEqual(self.link.sockets, {})
+        self.failUnlessEqual(self.sent(), [('STATUS', 0, 'GAME')])
+
+class ShardedServerTestCase(ServerTestCase):
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.set_option('shards', 2)
+        self.front = ShardedServer(Mock())
+        for shard in self.front.shards:
+            shard.transport = Mock()
+    def sent(self, shard):
+        frames = []
+        for args, kwargs in shard.transport.writeToChild.call_args_list:
+            frames.extend(parse_frames(args[1]))
+        shard.transport.writeToChild.reset_mock()
+        return frames
+    def connect(self, game_id=None):
+        return Relay(Mock(), '10.2.3.4', self.front, game_id)
+    
+    def test_default_game(self):
+        relay = self.connect()
+        game_id = self.front.default
+        first, second = self.front.shards
+        self.failUnlessEqual(self.sent(first), [
+            ('START', 0, game_id + ' standard'),
+            ('CONNECT', relay.client_id, '10.2.3.4 ' + game_id),
+        ])
+        self.failUnlessEqual(self.sent(second), [])
+    def test_select_moves(self):
+        relay = self.connect()
+        first, second = self.front.shards
+        second.handle_OPENED(0, 'OTHER')
+        self.sent(first)
+        message = SEL('OTHER')
+        relay.handle_message(message)
+        self.failUnlessEqual(self.sent(first),
+            [('CLOSE', relay.client_id, '')])
+        self.failUnlessEqual(self.sent(second), [
+            ('CONNECT', relay.client_id, '10.2.3.4 OTHER'),
+            ('MESSAGE', relay.client_id, message.pack()),
+        ])
+        self.failUnless(relay.shard is second)
+    def test_list_games(self):
+        relay = self.connect()
+        first, second = self.front.shards
+        message = +LST
+        relay.handle_message(message)
+        request = [frame[1] for frame in self.sent(first)
+            if frame[0] == 'LIST'][0]
+        self.failUnlessEqual(self.sent(second),
+            [('LIST', request, message.pack())])
+        listing = LST('GAME')(0)('standard')
+        first.handle_LISTING(request, listing.pack())
+        first.handle_LISTED(request, '')
+        relay.sock.write.assert_called_with(listing)
+        second.handle_LISTED(request, '')
+        relay.sock.write.assert_called_with(YES(message))
+    def test_games_completed(self):
+        self.set_option('games', 1)
+        relay = self.connect()
+        relay.close()
+        first, second = self.front.shards
+        self.sent(first)
+        first.handle_STATUS(0, '')
+        self.failUnless(self.front.closing)
+        self.failUnlessEqual(self.sent(first), [('SHUTDOWN', 0, '')])
+        self.failUnlessEqual(self.sent(second), [('SHUTDOWN', 0, '')])
+
+if __name__ == '__main__': unittest.main()
@@ -14,8 +14,9 @@ import unittest
 from mock import Mock, patch
 
 import parlance.server
+from parlance.judge import JudgeMetrics
 from parlance.tokens import DRW, PNG, SLO, SMR, SPR, YES
-from parlance.watcher import Ladder, Watcher
+from parlance.watcher import JudgeStats, Ladder, Watcher
 from parlance.xtended import AUS, ENG, FRA, GER, ITA, RUS, TUR
 from parlance.test.server import ServerTestCase
 
@@ -69,6 +70,16 @@ class ServerWatchers(ServerTestCase):
             self.game.game_id, key)
         self.assertFalse(watcher.handle_broadcast_message.called)
         self.assertFalse(watcher.handle_server_message.called)
+    def test_judge_metrics(self):
+        self.connect_server()
+        self.start_game()
+        watcher = self.new_watcher()
+        self.game.run_judge()
+        metrics, game = watcher.handle_judge_metrics.call_args[0]
+        self.assertEqual(game, self.game.game_id)
+        self.assertEqual(metrics.variant, "standard")
+        self.assertEqual(metrics.decisions["Dislodge"], 22)
+        self.assertTrue(metrics.latency >= metrics.seconds)
 
 class TestLadder(unittest.TestCase):
     def new_ladder(self, scores=None):
@@ -121,4 +132,51 @@ class TestLadder(unittest.TestCase):
         ladder.handle_broadcast_message(SMR (SPR, 1910) % players, "game")
         ladder.store_scores.assert_called_with(ending)
 
+class TestJudgeStats(unittest.TestCase):
+    def new_metrics(self, seconds, variant="standard"):
+        metrics = JudgeMetrics(variant, (1901, 0), 0x20)
+        metrics.seconds = seconds
+        metrics.latency = seconds * 2
+        metrics.decisions = {"Move": 3, "Hold": 2}
+        metrics.paradoxes = 1
+        return metrics
+    
+    def test_totals(self):
+        stats = JudgeStats()
+        stats.handle_judge_metrics(self.new_metrics(0.5), "game")
+        stats.handle_judge_metrics(self.new_metrics(1.5), "game")
+        totals = stats.totals["standard"]
+        self.assertEqual(totals["runs"], 2)
+        self.assertEqual(totals["seconds"], 2)
+        self.assertEqual(totals["latency"], 4)
+        self.assertEqual(totals["decisions"], 10)
+        self.assertEqual(totals["paradoxes"], 2)
+    def test_average(self):
+        stats = JudgeStats()
+        stats.handle_judge_metrics(self.new_metrics(0.5), "game")
+        stats.handle_judge_metrics(self.new_metrics(1.5), "game")
+        self.assertEqual(stats.average("standard"), 1)
+        self.assertEqual(stats.average("standard", "decisions"), 5)
+    def test_average_unknown(self):
+        stats = JudgeStats()
+        self.assertEqual(stats.average("standard"), None)
+    def test_slowest(self):
+        stats = JudgeStats()
+        stats.handle_judge_metrics(self.new_metrics(1.5), "game")
+        stats.handle_judge_metrics(self.new_metrics(0.5), "game")
+        stats.handle_judge_metrics(self.new_metrics(0.1, "modern"), "game")
+        self.assertEqual(stats.slowest, {"standard": 1.5, "modern": 0.1})
+    def test_no_file(self):
+        stats = JudgeStats()
+        stats.record = Mock()
+        stats.handle_judge_metrics(self.new_metrics(0.5), "game")
+        self.assertFalse(stats.record.called)
+    def test_record_file(self):
+        stats = JudgeStats()
+        stats.options.judge_stats_file = "stats"
+        stats.record = Mock()
+        metrics = self.new_metrics(0.5)
+        stats.handle_judge_metrics(metrics, "game")
+        stats.record.assert_called_with(metrics, "game")
+
 if __name__ == '__main__': unittest.main()
@@ -27,6 +27,56 @@ def rindex(series, value):
     '''#'''
     return len(series) - series[::-1].index(value) - 1
 
+def strongly_connected(nodes, successors):
+    ''' Finds the strongly connected components of a directed graph.
+        successors maps each node to a list of the nodes it points to.
+        Yields each component as a list, in reverse topological order:
+        no component points to any component yielded after it.
+        Uses Tarjan's algorithm, without recursion.
+        
+        >>> graph = {1: [2], 2: [3], 3: [1, 4], 4: [5], 5: [4], 6: [1, 6]}
+        >>> for component in strongly_connected([1, 2, 3, 4, 5, 6], graph):
+        ...     print sorted(component)
+        ... 
+        [4, 5]
+        [1, 2, 3]
+        [6]
+    '''#'''
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    for root in nodes:
+        if root in index: continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors[root]))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors[child])))
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member is node: break
+                    yield component
+
 def s(count):
     if count == 1: return ''
     else: return 's'
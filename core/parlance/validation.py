@@ -25,6 +25,10 @@ class Validator(VerboseObject):
         when the game starts.
     '''#'''
     syntax = {}
+    compiled = {}
+    first_tokens = {}
+    balanced = {}
+    single_tokens = {}
     press_levels = {}
     trimmed = {}
     __section__ = 'syntax'
@@ -46,6 +50,7 @@ class Validator(VerboseObject):
     
     def read_syntax(self):
         levels = parse_file(self.options.syntax_file, self.parse_syntax_file)
+        self.compile_syntax()
         
         if levels:
             # Expand press levels to be useful to the Game class
@@ -222,15 +227,19 @@ class Validator(VerboseObject):
             >>> base_rep.options.squeeze_parens = squeeze
         '''#'''
         self.log_debug(20, "Validating %s against %r", msg, base_expression)
-        if msg.count(BRA) != msg.count(KET):
+        parser = self.parser(msg, True)
+        if parser.opened != parser.closed:
             if msg[0] == PRN:
                 return False
             else:
                 self.log_debug(17, "Bracket counts differ: %d != %d",
-                    msg.count(BRA), msg.count(KET))
+                    parser.opened, parser.closed)
                 return PRN(msg)
+        elif msg and self.match_first(parser, base_expression):
+            return False
         else:
-            index, valid = self.validate_expression(msg, base_expression)
+            parser = self.parser(msg)
+            index, valid = parser.expression(base_expression, 0, len(msg))
             if valid and index == len(msg): return False
             else:
                 if index < len(msg) and msg[index] == KET:
@@ -281,31 +290,7 @@ class Validator(VerboseObject):
             >>> validate_expression(m, 'message', 0)
             (71, True)
         '''#'''
-        if not isinstance(msg, list):
-            raise ValueError('message must be a list')
-        if not self.syntax.has_key(sub):
-            raise ValueError('unknown expression "%s"' % sub)
-        best = 0
-        valid = False
-        length = len(msg)
-        for level,sub_list in self.syntax[sub]:
-            if level <= self.syntax_level:
-                #self.spaces += 1
-                #self.log_debug(16, '%sChecking "%s" against %s',
-                #        ' ' * self.spaces, msg, sub_list)
-                result, good = self.validate_option(msg, sub_list)
-                #self.log_debug(16, '%sResult: %s, %s',
-                #        ' ' * self.spaces, result, good)
-                #self.spaces -= 1
-                if good == valid and result > best:
-                    best = result
-                    if valid and best == length: break
-                elif good and not valid:
-                    best = result
-                    valid = good
-                    if valid and best == length: break
-        return best, valid
-    
+        return self.parser(msg).expression(sub, 0, len(msg))
     def validate_option(self, msg, item_list):
         ''' Tries to match the message with the given expression list.
             Returns the number of tokens in the best match,
@@ -324,117 +309,437 @@ class Validator(VerboseObject):
             ...     ['repeat', 'sub', 'arrangement', 'sco_power'], 200)
             (4, True)
         '''#'''
-        index = 0
-        option = None
+        steps = self.compile_option(item_list)
+        return self.parser(msg).option(steps, 0, len(msg))
+    def count_subs(self, msg, sub, repeat):
+        ''' Tries to match the message with the given wrapped subexpression.
+            Returns a tuple: (index,valid) where index is the last matched
+            expression, and valid is whether it ended on an exact boundary.
+            
+            >>> def count_subs(msg, sub, repeat, level):
+            ...     return Validator(level).count_subs(msg, sub, repeat) 
+            >>> Eng = Token('ENG', 0x4101)
+            >>> Fra = Token('FRA', 0x4102)
+            >>> msg = [
+            ...     BRA, DRW, KET,
+            ...     BRA, XOY, BRA, Fra, KET, BRA, Eng, KET, KET,
+            ... KET ]
+            ... 
+            >>> count_subs(msg, 'arrangement', True, 40)
+            (4, False)
+            >>> count_subs(msg, 'arrangement', True, 120)
+            (12, True)
+        '''#'''
+        return self.parser(msg).subs(sub, 0, len(msg), repeat)
+    def count_string(self, msg):
+        # Count the number of tokens valid for the encoding.
+        return self.parser(msg).string(0, len(msg))
+    def match_first(self, parser, base_expression):
+        ''' Quickly checks whether the message is valid,
+            trying only the rules that can start the way it does.
+            The parser should be an exact one, from parser(msg, True).
+            A False result means only that the full check is needed;
+            the full check finds the position of the error.
+        '''#'''
+        starts, follows, others = self.rules_by_token(base_expression,
+            self.syntax_level, True)
+        length = len(parser.msg)
+        for steps in starts.get(parser.msg[0], others):
+            if parser.option(steps, 0, length) == (length, True):
+                return True
+        return False
+    @classmethod
+    def rules_by_token(klass, name, level, flatten=False):
+        ''' Sorts the rules available for an expression by first token.
+            A rule starting with any other token can't match at all.
+            If flatten is true, rules consisting of a single unwrapped
+            expression are replaced by that expression's own rules;
+            the best match for such a rule covers the whole message
+            exactly when one of them does.
+            Returns three items:
+                - A dict of first token -> list of rules
+                - A dict of the token that must follow a rule's first
+                  brackets -> list of rules that might start with BRA
+                - A list of rules that don't start with a token
+            The last list is included in the first dict for each token.
+            In the second dict, the None entry lists the rules with no
+            such token, and is included in the list for each token.
+        '''#'''
+        tables = klass.first_tokens.setdefault((level, flatten), {})
+        result = tables.get(name)
+        if result is None:
+            result = tables[name] = klass.index_rules(name, level, flatten)
+        return result
+    @classmethod
+    def index_rules(klass, name, level, flatten):
+        # Builds the tables for rules_by_token().
+        starts = {}
+        follows = {None: []}
+        others = []
+        def index(name, seen):
+            rules = klass.compiled.get(name)
+            if rules is None: rules = klass.compile_expression(name)
+            for rule_level, steps in rules:
+                if rule_level > level: continue
+                first = steps and steps[0] or ('empty',)
+                if (flatten and len(steps) == 1
+                        and first[0] == 'expression' and not first[2]):
+                    if first[1] not in seen:
+                        index(first[1], seen + (first[1],))
+                else:
+                    if first[0] == 'token':
+                        starts.setdefault(first[1], []).append(steps)
+                    else: others.append(steps)
+                    if first[0] != 'token' or first[1] == BRA:
+                        token = klass.bracketed_token(steps)
+                        follows.setdefault(token, []).append(steps)
+        index(name, (name,))
+        for rules in starts.itervalues(): rules.extend(others)
+        for token, rules in follows.iteritems():
+            if token is not None: rules.extend(follows[None])
+        return starts, follows, others
+    @classmethod
+    def bracketed_token(klass, steps):
+        ''' Finds the token that must follow the brackets starting a rule.
+            In a message with matching brackets, the rule can only be
+            valid if that token follows the KET matching its first BRA.
+            Returns None if the rule doesn't start with brackets,
+            or if anything in them might match unmatched brackets.
+        '''#'''
+        first = steps and steps[0] or ('empty',)
+        if first[0] == 'sub' and not first[2]: index = 1
+        elif first == ('token', BRA, False):
+            depth = index = 1
+            while index < len(steps) and depth:
+                step = steps[index]
+                if step[0] == 'token':
+                    if step[1] == BRA: depth += 1
+                    elif step[1] == KET: depth -= 1
+                index += 1
+            inner = steps[1:index - 1]
+            if depth or ('optional',) in inner: return None
+            if not klass.balanced_rule(inner, klass.balanced_expressions()):
+                return None
+        else: return None
+        if index < len(steps) and steps[index][0] == 'token':
+            return steps[index][1]
+        return None
+    @classmethod
+    def balanced_expressions(klass):
+        ''' Finds the expressions whose valid matches always contain
+            matching brackets, as a dict of name -> True.
+        '''#'''
+        if not klass.balanced:
+            names = dict([(name, True) for name in klass.syntax])
+            changed = True
+            while changed:
+                changed = False
+                for name in names.keys():
+                    rules = klass.compiled.get(name)
+                    if rules is None: rules = klass.compile_expression(name)
+                    for level, steps in rules:
+                        if not klass.balanced_rule(steps, names):
+                            del names[name]
+                            changed = True
+                            break
+            klass.balanced.update(names)
+        return klass.balanced
+    @staticmethod
+    def balanced_rule(steps, balanced):
+        ''' Checks whether every valid match of a rule
+            contains matching brackets, given the balanced expressions.
+        '''#'''
+        depth = 0
+        for step in steps:
+            kind = step[0]
+            if kind == 'token':
+                if step[1] in (BRA, KET):
+                    if step[2]: return False
+                    if step[1] == BRA: depth += 1
+                    else: depth -= 1
+                    if depth < 0: return False
+            elif kind == 'expression':
+                if not balanced.has_key(step[1]): return False
+            elif kind == 'cat':
+                if step[1](BRA) or step[1](KET): return False
+            elif kind == 'optional':
+                if depth: return False
+            elif kind == 'any': return False
+        return depth == 0
+    def parser(self, msg, exact=False):
+        if not isinstance(msg, list):
+            raise ValueError('message must be a list')
+        return Parser(self, msg, exact)
+    
+    # Compiling rules
+    @classmethod
+    def compile_syntax(klass):
+        ''' Translates each syntax rule into a list of matching steps.'''
+        klass.compiled.clear()
+        klass.first_tokens.clear()
+        klass.balanced.clear()
+        klass.single_tokens.clear()
+        for name in klass.syntax:
+            klass.compile_expression(name)
+    @classmethod
+    def compile_expression(klass, name):
+        ''' Compiles the rules for one expression, if it exists.
+            Returns a list of (level, steps) tuples.
+        '''#'''
+        if not klass.syntax.has_key(name):
+            raise ValueError('unknown expression "%s"' % name)
+        result = klass.compiled[name] = [(level, klass.compile_option(rule))
+            for level, rule in klass.syntax[name]]
+        return result
+    @classmethod
+    def compile_option(klass, item_list):
+        ''' Translates a syntax rule into a list of matching steps.
+            Each step is a tuple starting with its kind of match;
+            keywords such as 'repeat' are folded into the next step.
+            Expressions that always match exactly one token,
+            such as provinces, become a single category check.
+            
+            >>> Validator.compile_option(['repeat', 'sub', 'arrangement', YES])
+            [('sub', 'arrangement', True), ('token', YES, False)]
+        '''#'''
+        steps = []
         in_sub = in_cat = repeat = False
-        length = len(msg)
         for opt in item_list:
             if isinstance(opt, str):
-                if   opt == 'any':      return length, True
+                if   opt == 'any':      steps.append(('any',))
                 elif opt == 'sub':      in_sub = True
                 elif opt == 'cat':      in_cat = True
                 elif opt == 'repeat':   repeat = True
-                elif opt == 'optional': option = (index, True)
-                elif opt == 'string':
-                    result = self.count_string(msg[index:])
-                    if result: index += result
-                    else: break
+                elif opt == 'optional': steps.append(('optional',))
+                elif opt == 'string':   steps.append(('string',))
                 else:
                     if in_sub:
                         # Wrapped subexpression
-                        result, good = self.count_subs(msg[index:], opt, repeat)
-                        index += result
-                        if not (result and good): break
+                        steps.append(('sub', opt, repeat))
                     elif in_cat:
                         # Category name
-                        if protocol.token_cats.has_key(opt):
-                            num = protocol.token_cats[opt]
-                            if isinstance(num, tuple):
-                                check = lambda x: num[0] <= x.category <= num[1]
-                            else: check = lambda x: x.category == num
-                        elif opt == 'Token':
-                            check = lambda x: x not in (BRA, KET, ERR)
-                        else: raise ValueError('unknown category "%s"' % opt)
-                        result = count_valid(msg[index:], check, repeat)
-                        if result: index += result
-                        else: break
+                        try: check = category_check(opt)
+                        except ValueError, err:
+                            steps.append(('error', err))
+                        else: steps.append(('cat', check, repeat))
                     else:
                         # Unwrapped subexpression(s)
-                        result = self.validate_expression(msg[index:], opt)
-                        index += result[0]
-                        if not result[1]: break
-                        if repeat:
-                            while result[1]:
-                                result = self.validate_expression(msg[index:], opt)
-                                index += result[0]
+                        check = klass.token_check(opt)
+                        if check: steps.append(('cat', check, repeat))
+                        else: steps.append(('expression', opt, repeat))
                     in_sub = in_cat = repeat = False
             elif isinstance(opt, Token):
-                result = count_valid(msg[index:], lambda x: x == opt, repeat)
+                steps.append(('token', opt, repeat))
                 repeat = False
+            else: steps.append(('invalid',))
+        return steps
+    @classmethod
+    def token_check(klass, name):
+        ''' Returns a function to check whether a token matches
+            an expression consisting only of single tokens,
+            categories, and other such expressions, at any level.
+            Returns None for any other expression.
+        '''#'''
+        if not klass.single_tokens.has_key(name):
+            klass.single_tokens[name] = None
+            found = klass.single_token_sets(name)
+            if found:
+                categories, tokens = found
+                if tokens:
+                    check = lambda x: x.category in categories or x in tokens
+                else: check = lambda x: x.category in categories
+                klass.single_tokens[name] = check
+        return klass.single_tokens[name]
+    @classmethod
+    def single_token_sets(klass, name, seen=()):
+        ''' Collects the categories and tokens matched by an expression,
+            as dicts for quick lookup, if that is all it can match.
+        '''#'''
+        if name in seen or not klass.syntax.has_key(name): return None
+        categories = {}
+        tokens = {}
+        for level, rule in klass.syntax[name]:
+            if level > 0: return None
+            if len(rule) == 1 and isinstance(rule[0], Token):
+                tokens[rule[0]] = True
+            elif len(rule) == 1 and isinstance(rule[0], str):
+                found = klass.single_token_sets(rule[0], seen + (name,))
+                if not found: return None
+                categories.update(found[0])
+                tokens.update(found[1])
+            elif (len(rule) == 2 and rule[0] == 'cat'
+                    and protocol.token_cats.has_key(rule[1])):
+                num = protocol.token_cats[rule[1]]
+                if isinstance(num, tuple):
+                    for cat in range(num[0], num[1] + 1):
+                        categories[cat] = True
+                else: categories[num] = True
+            else: return None
+        return categories, tokens
+
+class Parser(object):
+    ''' Matches one message against the compiled syntax rules.
+        Positions are indices into the whole message; each match covers
+        a window of it, from start up to (but not including) stop.
+        The result for each expression and window is saved, so that
+        backtracking never matches the same expression twice.
+        An exact parser skips rules that can't produce a valid match,
+        so it finds the same valid matches with less work, but may
+        report shorter partial matches for invalid ones.
+    '''#'''
+    def __init__(self, validator, msg, exact=False):
+        self.validator = validator
+        self.exact = exact
+        self.level = validator.syntax_level
+        self.tables = validator.first_tokens.setdefault((self.level, False), {})
+        self.msg = msg
+        self.results = {}
+        
+        # Find the KET matching each BRA
+        self.kets = kets = {}
+        self.opened = self.closed = 0
+        unclosed = []
+        for index, token in enumerate(msg):
+            if token == BRA:
+                unclosed.append(index)
+                self.opened += 1
+            elif token == KET:
+                if unclosed: kets[unclosed.pop()] = index
+                self.closed += 1
+    
+    def expression(self, sub, start, stop):
+        ''' Matches the window with the named expression,
+            trying each of its rules allowed at this syntax level.
+            Returns the number of tokens in the best match,
+            and whether the full match is valid.
+        '''#'''
+        key = (sub, start, stop)
+        result = self.results.get(key)
+        if result is None:
+            result = self.results[key] = self.match_rules(sub, start, stop)
+        return result
+    def match_rules(self, sub, start, stop):
+        table = self.tables.get(sub)
+        if table is None:
+            table = self.validator.rules_by_token(sub, self.level)
+        starts, follows, rules = table
+        if start < stop:
+            token = self.msg[start]
+            if self.exact and token == BRA:
+                ket = self.kets.get(start)
+                if ket is not None and ket + 1 < stop:
+                    rules = follows.get(self.msg[ket + 1], follows[None])
+                else: rules = follows[None]
+            else: rules = starts.get(token, rules)
+        best = 0
+        valid = False
+        length = stop - start
+        for steps in rules:
+            result, good = self.option(steps, start, stop)
+            if good == valid and result > best:
+                best = result
+                if valid and best == length: break
+            elif good and not valid:
+                best = result
+                valid = good
+                if valid and best == length: break
+        return best, valid
+    def option(self, steps, start, stop):
+        ''' Matches the window with a compiled syntax rule.
+            Returns the number of tokens in the best match,
+            and whether the full match is valid.
+        '''#'''
+        msg = self.msg
+        index = start
+        option = None
+        for step in steps:
+            kind = step[0]
+            if kind == 'token':
+                token = step[1]
+                if index < stop and msg[index] == token:
+                    index += 1
+                    if step[2]:
+                        while index < stop and msg[index] == token:
+                            index += 1
+                else: break
+            elif kind == 'expression':
+                result, good = self.expression(step[1], index, stop)
+                index += result
+                if not good: break
+                if step[2]:
+                    while good:
+                        result, good = self.expression(step[1], index, stop)
+                        index += result
+            elif kind == 'sub':
+                result, good = self.subs(step[1], index, stop, step[2])
+                index += result
+                if not (result and good): break
+            elif kind == 'cat':
+                check = step[1]
+                if index < stop and check(msg[index]):
+                    index += 1
+                    if step[2]:
+                        while index < stop and check(msg[index]):
+                            index += 1
+                else: break
+            elif kind == 'string':
+                result = self.string(index, stop)
                 if result: index += result
                 else: break
+            elif kind == 'optional': option = (index - start, True)
+            elif kind == 'any': return stop - start, True
+            elif kind == 'error': raise step[1]
             else: raise UserWarning('Invalid State')
-        else: return index, True
-        return option or (index, False)
-    
-    def count_subs(self, msg, sub, repeat):
-        ''' Tries to match the message with the given wrapped subexpression.
+        else: return index - start, True
+        return option or (index - start, False)
+    def subs(self, sub, start, stop, repeat):
+        ''' Matches the window with the named expression in brackets.
             Returns a tuple: (index,valid) where index is the last matched
             expression, and valid is whether it ended on an exact boundary.
-            
-            >>> def count_subs(msg, sub, repeat, level):
-            ...     return Validator(level).count_subs(msg, sub, repeat) 
-            >>> Eng = Token('ENG', 0x4101)
-            >>> Fra = Token('FRA', 0x4102)
-            >>> msg = [
-            ...     BRA, DRW, KET,
-            ...     BRA, XOY, BRA, Fra, KET, BRA, Eng, KET, KET,
-            ... KET ]
-            ... 
-            >>> count_subs(msg, 'arrangement', True, 40)
-            (4, False)
-            >>> count_subs(msg, 'arrangement', True, 120)
-            (12, True)
         '''#'''
         # Check for the start of a subexpression
-        if not msg or msg[0] != BRA: return 0, False
+        if start >= stop or self.msg[start] != BRA: return 0, False
         
         # Find the matching KET
-        level = 1
-        sublen = 0
-        while level > 0:
-            sublen += 1
-            old_sublen = sublen
-            sublen += msg[sublen:].index(KET)
-            level += msg[old_sublen:sublen].count(BRA) - 1
+        ket = self.kets.get(start)
+        if ket is None or ket >= stop: return 0, False
         
-        result = self.validate_expression(msg[1:sublen], sub)
+        result = self.expression(sub, start + 1, ket)
         index = result[0] + 2
         if result[1]:
             if repeat:
-                result, valid = self.count_subs(msg[index:], sub, repeat)
+                result, valid = self.subs(sub, start + index, stop, repeat)
                 if result: return index + result, valid
             return index, True
         else: return index - 1, False
-    
-    def count_string(self, msg):
-        # Count the number of tokens valid for the encoding.
-        if not self.options.encoding:
-            return count_valid(msg, Token.is_text, True)
-        
-        length = len(msg)
-        index = 0
-        while index < length and msg[index].is_text():
+    def string(self, start, stop):
+        ''' Counts the number of tokens valid for the encoding.'''
+        msg = self.msg
+        index = start
+        while index < stop and msg[index].is_text():
             index += 1
-        while index:
-            text = "".join(t.text for t in msg[:index])
-            try:
-                text.decode(self.options.encoding)
-            except UnicodeDecodeError:
-                index -= 1
-            else:
-                break
-        return index
+        encoding = self.validator.options.encoding
+        if encoding:
+            while index > start:
+                text = "".join([t.text for t in msg[start:index]])
+                try:
+                    text.decode(encoding)
+                except UnicodeDecodeError:
+                    index -= 1
+                else:
+                    break
+        return index - start
+
+def category_check(name):
+    ''' Returns a function to check whether a token is in the category.'''
+    if protocol.token_cats.has_key(name):
+        num = protocol.token_cats[name]
+        if isinstance(num, tuple):
+            return lambda x: num[0] <= x.category <= num[1]
+        else: return lambda x: x.category == num
+    elif name == 'Token':
+        return lambda x: x not in (BRA, KET, ERR)
+    else: raise ValueError('unknown category "%s"' % name)
 
 def count_valid(msg, func, repeat):
     ''' Counts the number of tokens for which the given function returns True.
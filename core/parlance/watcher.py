@@ -4,6 +4,7 @@ r'''Parlance game watchers
     This module creates classes to listen in on all messages from all games.
     Such classes may implement ratings ladders or abuse monitors.
     They normally wouldn't actually interact with the clients.
+    They also hear how much work the judge did for each turn.
     
     Parlance may be used, modified, and/or redistributed under the terms of
     the Artistic License 2.0, as published by the Perl Foundation.
@@ -13,6 +14,7 @@ from __future__ import division
 
 from cPickle import dump, load
 from os import path
+from time import time
 
 from parlance.config import VerboseObject
 from parlance.tokens import HUH, NOT, REJ, YES
@@ -46,6 +48,13 @@ class Watcher(VerboseObject):
         '''#'''
         self.handle_message("handle_client", message, game, sender)
     
+    def handle_judge_metrics(self, metrics, game):
+        r'''Process the measurements of one run of a game's judge.
+            The metrics parameter will be a JudgeMetrics instance.
+            The game parameter will be a game name.
+        '''#'''
+        pass
+    
     def handle_message(self, prefix, message, *args):
         r'''Dispatch a message to the appropriate handler.
             Hands it off to a handle_sender_XXX() method, where sender is
@@ -111,7 +120,7 @@ class Ladder(Watcher):
         seen = set()
         players = []
         survivors = set()
-        for row in message.fold()[2:]:
+        for row in message.folded()[2:]:
             power, name, version = row[:3]
             if power not in seen:
                 players.append((power, name[0], version[0], 1))
@@ -176,3 +185,64 @@ class Ladder(Watcher):
         else:
             dump(scores, stream)
             stream.close()
+
+class JudgeStats(Watcher):
+    r'''Collects the cost of adjudication for each variant.
+        Keeps running totals, and optionally writes a line for each run
+        of the judge to a file, for graphs or other dashboards.
+        Each line has tab-separated fields: the time, variant, game,
+        turn key, phase, seconds in the judge, seconds waited for results,
+        decisions, sweeps, calculations, paradoxes, and convoy routes,
+        followed by step=seconds timings for the movement algorithm.
+    '''#'''
+    __options__ = (
+        ('judge_stats_file', file, '', 'judge statistics file',
+            'The file in which the JudgeStats observer records each turn.',
+            'Leave blank to keep the statistics in memory only.'),
+    )
+    
+    fields = ('runs', 'seconds', 'latency', 'decisions',
+        'calculations', 'paradoxes', 'routes')
+    
+    def __init__(self, **kwargs):
+        self.__super.__init__(**kwargs)
+        self.totals = {}
+        self.slowest = {}
+    
+    def handle_judge_metrics(self, metrics, game):
+        totals = self.totals.setdefault(metrics.variant,
+            dict.fromkeys(self.fields, 0))
+        totals['runs'] += 1
+        totals['seconds'] += metrics.seconds
+        totals['latency'] += metrics.latency or 0
+        totals['decisions'] += metrics.decision_count()
+        totals['calculations'] += metrics.calculations
+        totals['paradoxes'] += metrics.paradoxes
+        totals['routes'] += metrics.routes
+        if metrics.seconds > self.slowest.get(metrics.variant, 0):
+            self.slowest[metrics.variant] = metrics.seconds
+        
+        self.log.debug("Game %s judged in %.3f seconds",
+            game, metrics.seconds)
+        if self.options.judge_stats_file:
+            self.record(metrics, game)
+    
+    def average(self, variant, field='seconds'):
+        r'''The mean of a field per run of the judge for a variant.'''
+        totals = self.totals.get(variant)
+        if not totals: return None
+        return totals[field] / totals['runs']
+    
+    def record(self, metrics, game):
+        fields = [time(), metrics.variant, game, "%s.%s" % metrics.turn,
+            metrics.phase, metrics.seconds, metrics.latency,
+            metrics.decision_count(), metrics.sweeps, metrics.calculations,
+            metrics.paradoxes, metrics.routes]
+        fields.extend("%s=%s" % item for item in sorted(metrics.steps.items()))
+        try:
+            stream = open(self.options.judge_stats_file, 'a')
+        except IOError:
+            self.log.warning("Failed to open the judge statistics file.")
+        else:
+            stream.write(str.join("\t", [str(field) for field in fields]) + "\n")
+            stream.close()
@@ -28,12 +28,14 @@ setup(
     # Provided items
     name = "Parlance",
     version = __version__,
-    packages = ["parlance"],
+    packages = ["parlance", "parlance.test"],
     entry_points = {
         "console_scripts": [
             "parlance-server = parlance.server:Server.main",
+            "parlance-sharded-server = parlance.shard:ShardedServer.main",
             "parlance-holdbot = parlance.player:HoldBot.main",
             "parlance-config = parlance.config:ConfigPrinter.main",
+            "parlance-benchmark = parlance.benchmark:Benchmark.main",
             "parlance-raw-client = parlance.main:RawClient.main",
             "parlance-raw-server = parlance.main:RawServer.main",
         ],
@@ -50,6 +52,7 @@ setup(
         ],
         "parlance.watchers": [
             "ladder = parlance.watcher:Ladder",
+            "judge_stats = parlance.watcher:JudgeStats",
         ],
     },
     